@@ -0,0 +1,18 @@
+from grocery.data.preprocessing import ActionType, EventMappings, Preprocessor, encode_column, scan_events
+from grocery.data.sequences import (
+    CANDIDATES_SCHEMA, HISTORY_SCHEMA, build_candidates, build_finetune_data, build_histories, build_pretrain_data,
+)
+
+__all__ = [
+    "ActionType",
+    "EventMappings",
+    "Preprocessor",
+    "encode_column",
+    "scan_events",
+    "HISTORY_SCHEMA",
+    "CANDIDATES_SCHEMA",
+    "build_histories",
+    "build_pretrain_data",
+    "build_candidates",
+    "build_finetune_data",
+]
@@ -0,0 +1,234 @@
+import os
+from dataclasses import dataclass
+
+import numpy as np
+import polars as pl
+
+
+SECONDS_PER_DAY = 24 * 60 * 60
+EVENT_COLUMNS = ["action_type", "product_id", "source_type", "timestamp", "user_id", "request_id"]
+
+
+class ActionType:
+    VIEW = 'AT_View'
+    CLICK = 'AT_Click'
+    CART_UPDATE = 'AT_CartUpdate'
+    PURCHASE = 'AT_Purchase'
+
+
+def scan_events(source: str | list[str] | pl.DataFrame | pl.LazyFrame) -> pl.LazyFrame:
+    """
+    Lazy frame of the event columns, parquet files are scanned so only these columns are read.
+    """
+    if isinstance(source, pl.DataFrame):
+        source = source.lazy()
+    elif not isinstance(source, pl.LazyFrame):
+        source = pl.scan_parquet(source)
+    return source.select(EVENT_COLUMNS)
+
+
+def encode_column(frame: pl.LazyFrame, column: str, values: np.ndarray, dtype: pl.DataType = pl.Int64) -> pl.LazyFrame:
+    """
+    Replaces the column with the position of its value in `values` by a join with a (value, code) table.
+    Values missing from `values` become null, the row order is kept.
+    """
+    codes = pl.LazyFrame({column: values, "__code": np.arange(len(values))}).with_columns(pl.col("__code").cast(dtype))
+    names = frame.collect_schema().names()
+    return (
+        frame
+        .join(codes, on=column, how="left", maintain_order="left")
+        .with_columns(pl.col("__code").alias(column))
+        .select(names)
+    )
+
+
+@dataclass
+class EventMappings:
+    """
+    Sorted unique raw values of the encoded columns, the code of a value is its position.
+    Args:
+        product_ids (np.ndarray): raw product ids
+        user_ids (np.ndarray): raw user ids
+        source_types (np.ndarray): source type names, "" for a missing source
+    """
+    product_ids: np.ndarray
+    user_ids: np.ndarray
+    source_types: np.ndarray
+
+    @classmethod
+    def build(cls, events: pl.LazyFrame) -> "EventMappings":
+        uniques = pl.collect_all([
+            events.select(pl.col("product_id").unique().sort()),
+            events.select(pl.col("user_id").unique().sort()),
+            events.select(pl.col("source_type").fill_null("").unique().sort()),
+        ], engine="streaming")
+        return cls(*(frame.to_series().to_numpy() for frame in uniques))
+
+    def source_type_code(self, source_type: str) -> int:
+        code = int(np.searchsorted(self.source_types, source_type))
+        if code == len(self.source_types) or self.source_types[code] != source_type:
+            raise ValueError(f"unknown source type {source_type}")
+        return code
+
+    def save(self, path: str):
+        """
+        Writes one .npy file per mapping into the directory, see `load`.
+        """
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "product_ids.npy"), self.product_ids)
+        np.save(os.path.join(path, "user_ids.npy"), self.user_ids)
+        np.save(os.path.join(path, "source_types.npy"), self.source_types.astype(str))
+
+    @classmethod
+    def load(cls, path: str) -> "EventMappings":
+        return cls(*(np.load(os.path.join(path, f"{name}.npy")) for name in ("product_ids", "user_ids", "source_types")))
+
+
+class Preprocessor:
+    mapping_action_types = {
+        ActionType.VIEW: 0,
+        ActionType.CART_UPDATE: 1,
+        ActionType.CLICK: 2,
+        ActionType.PURCHASE: 3
+    }
+
+    def __init__(self,
+                 events: str | list[str] | pl.DataFrame | pl.LazyFrame,
+                 valid_days: int = 30,
+                 gap_days: int = 2,
+                 min_request_length: int = 10,
+                 mappings: EventMappings | None = None,
+                 ):
+        """
+        Lavka preprocessing as a lazy polars pipeline. Users, products and source types get dense codes,
+        requests with both views and cart updates become ranking targets, and the events and targets are
+        split by time into train and validation. Every step runs on polars' streaming engine.
+        Args:
+            events (str | list[str] | pl.DataFrame | pl.LazyFrame): train.parquet path(s) or the events
+            valid_days (int): length of the validation period at the end of the data
+            gap_days (int): days between the end of train and the start of validation
+            min_request_length (int): minimal number of distinct products of a target request
+            mappings (EventMappings | None): codes to reuse, built from the events by default
+        """
+        self.events = scan_events(events)
+        self.valid_days = valid_days
+        self.gap_days = gap_days
+        self.min_request_length = min_request_length
+        self.mappings = mappings
+
+    @property
+    def mapping_product_ids(self) -> np.ndarray:
+        return self.mappings.product_ids
+
+    @property
+    def mapping_user_ids(self) -> np.ndarray:
+        return self.mappings.user_ids
+
+    @property
+    def mapping_source_types(self) -> np.ndarray:
+        return self.mappings.source_types
+
+    def encode(self) -> pl.LazyFrame:
+        """
+        Events with product, user, source and action types replaced by their codes.
+        """
+        if self.mappings is None:
+            self.mappings = EventMappings.build(self.events)
+        events = self.events.with_columns(
+            pl.col("source_type").fill_null(""),
+            pl.col("action_type").replace_strict(self.mapping_action_types, return_dtype=pl.Int8),
+        )
+        events = encode_column(events, "product_id", self.mappings.product_ids)
+        events = encode_column(events, "user_id", self.mappings.user_ids)
+        return encode_column(events, "source_type", self.mappings.source_types, dtype=pl.Int8)
+
+    def extract_targets(self, events: pl.LazyFrame) -> pl.LazyFrame:
+        """
+        Per-request lists of products and their max action (0 view, 1 cart update) for catalogue-less
+        requests having both actions and at least `min_request_length` products, timestamped by the request start.
+        """
+        condition = pl.col("request_id").is_not_null() & pl.col("action_type").is_in([0, 1])
+        if "ST_Catalog" in self.mappings.source_types:
+            condition &= pl.col("source_type") != self.mappings.source_type_code("ST_Catalog")
+        targets = (
+            events
+            .filter(condition)
+            .group_by(["user_id", "request_id", "product_id"])
+            .agg([
+                pl.col("action_type").max(),
+                pl.col("timestamp").min(),
+                pl.col("source_type").mode().sort().first()
+            ])
+        )
+        requests_with_cartupdate_and_view = (
+            targets
+            .group_by("request_id")
+            .agg([
+                pl.col("action_type").max().alias("max_t"),
+                pl.col("action_type").min().alias("min_t"),
+                pl.len(),
+                pl.col("timestamp").min().alias("req_ts")
+            ])
+            .filter((pl.col("max_t") + pl.col("min_t") == 1) & (pl.col("len") >= self.min_request_length))
+            .select(["request_id", "req_ts"])
+        )
+        return (
+            targets
+            .drop("timestamp")
+            .join(requests_with_cartupdate_and_view, on="request_id", how="inner")
+            .rename({"req_ts": "timestamp"})
+            .group_by(["user_id", "request_id", "timestamp", "source_type"])
+            .agg([
+                pl.col("product_id"),
+                pl.col("action_type"),
+            ])
+        )
+
+    def split(self) -> tuple[pl.LazyFrame, pl.LazyFrame, pl.LazyFrame, pl.LazyFrame]:
+        """
+        Builds the lazy train history, validation history, train targets and validation targets.
+        Only the time boundaries are computed eagerly.
+        """
+        events = self.encode()
+        bounds = events.select(pl.col("timestamp").min().alias("start"), pl.col("timestamp").max().alias("end"))
+        bounds = bounds.collect(engine="streaming").row(0, named=True)
+        self.timesplit_valid_end = bounds["end"]
+        self.timesplit_valid_start = self.timesplit_valid_end - self.valid_days * SECONDS_PER_DAY
+        self.timesplit_train_end = self.timesplit_valid_start - self.gap_days * SECONDS_PER_DAY
+        self.timesplit_train_start = bounds["start"]
+
+        targets = self.extract_targets(events)
+        history = events.filter(pl.col("action_type") != 0).drop("request_id")
+        return (
+            history.filter(pl.col("timestamp") <= self.timesplit_train_end),
+            history.filter(pl.col("timestamp") > self.timesplit_train_end),
+            targets.filter(pl.col("timestamp") <= self.timesplit_train_end),
+            targets.filter(
+                (pl.col("timestamp") > self.timesplit_valid_start) &
+                (pl.col("timestamp") <= self.timesplit_valid_end)
+            ),
+        )
+
+    def run(self) -> tuple[pl.DataFrame, pl.DataFrame, pl.DataFrame, pl.DataFrame]:
+        """
+        Collects `split` with the streaming engine, the four frames share one scan of the events.
+        """
+        (self.train_history,
+         self.valid_history,
+         self.train_targets,
+         self.valid_targets) = pl.collect_all(self.split(), engine="streaming")
+        return self.train_history, self.valid_history, self.train_targets, self.valid_targets
+
+    def write(self, path: str):
+        """
+        Streams `split` into train_history, valid_history, train_targets and valid_targets parquet files
+        in the directory without collecting them, and saves the mappings into its `mappings` subdirectory.
+        """
+        os.makedirs(path, exist_ok=True)
+        names = ["train_history", "valid_history", "train_targets", "valid_targets"]
+        sinks = [
+            frame.sink_parquet(os.path.join(path, f"{name}.parquet"), lazy=True)
+            for name, frame in zip(names, self.split())
+        ]
+        pl.collect_all(sinks, engine="streaming")
+        self.mappings.save(os.path.join(path, "mappings"))
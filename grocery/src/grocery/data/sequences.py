@@ -0,0 +1,219 @@
+import polars as pl
+
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+HISTORY_SCHEMA = pl.Struct({
+    'source_type': pl.List(pl.Int64),
+    'action_type': pl.List(pl.Int64),
+    'product_id': pl.List(pl.Int64),
+    'position': pl.List(pl.Int64),
+    'targets_inds': pl.List(pl.Int64),
+    'targets_lengths': pl.List(pl.Int64),
+    'lengths': pl.List(pl.Int64),
+})
+CANDIDATES_SCHEMA = pl.Struct({
+    'source_type': pl.List(pl.Int64),
+    'action_type': pl.List(pl.Int64),
+    'product_id': pl.List(pl.Int64),
+    'lengths': pl.List(pl.Int64),
+    'num_requests': pl.List(pl.Int64),
+})
+
+
+def _lazy(frame: pl.DataFrame | pl.LazyFrame) -> pl.LazyFrame:
+    return frame.lazy() if isinstance(frame, pl.DataFrame) else frame
+
+
+def _like(result: pl.LazyFrame, *inputs: pl.DataFrame | pl.LazyFrame) -> pl.DataFrame | pl.LazyFrame:
+    return result if any(isinstance(frame, pl.LazyFrame) for frame in inputs) else result.collect()
+
+
+def sort_by_timestamp(frame: pl.LazyFrame) -> pl.LazyFrame:
+    """
+    Stable sort by user and timestamp, the order every builder relies on.
+    """
+    return frame.sort(["user_id", "timestamp"], maintain_order=True)
+
+
+def _is_set(frame: pl.LazyFrame, column: str) -> pl.Expr:
+    # the notebook's `if x[column]`: not null, not zero for numbers and not empty for strings
+    dtype = frame.collect_schema()[column]
+    if dtype == pl.String:
+        return pl.col(column).str.len_bytes() > 0
+    if dtype.is_numeric():
+        return pl.col(column) != 0
+    return pl.col(column).is_not_null()
+
+
+def _history_struct(targets_inds: pl.Expr) -> pl.Expr:
+    length = pl.col("product_id").list.len()
+    return pl.struct(
+        pl.col("source_type"),
+        pl.col("action_type"),
+        pl.col("product_id"),
+        pl.int_ranges(0, length).alias("position"),
+        targets_inds.alias("targets_inds"),
+        pl.concat_list(targets_inds.list.len()).alias("targets_lengths"),
+        pl.concat_list(length).alias("lengths"),
+    ).cast(HISTORY_SCHEMA).alias("history")
+
+
+def build_histories(events: pl.DataFrame | pl.LazyFrame,
+                    min_length: int = 5,
+                    max_length: int = 4096,
+                    ) -> pl.DataFrame | pl.LazyFrame:
+    """
+    One `HISTORY_SCHEMA` row per user with the last `max_length` events in timestamp order and the
+    positions of events with `target == 1` as `targets_inds`. Users with at most `min_length` events are dropped.
+    Args:
+        events (pl.DataFrame | pl.LazyFrame): user_id, timestamp, source_type, action_type, product_id
+        and target columns
+        min_length (int): users need more events than this
+        max_length (int): number of kept most recent events
+    Returns:
+        pl.DataFrame | pl.LazyFrame: `history` column, lazy when the input is lazy, ordered by user
+    """
+    result = (
+        sort_by_timestamp(_lazy(events))
+        .group_by("user_id", maintain_order=True)
+        .agg(pl.col("source_type", "action_type", "product_id", "target").tail(max_length))
+        .filter(pl.col("product_id").list.len() > min_length)
+        .select(_history_struct(pl.col("target").list.eval(pl.element().eq(1).arg_true())))
+    )
+    return _like(result, events)
+
+
+def build_pretrain_data(train_history: pl.DataFrame | pl.LazyFrame,
+                        valid_history: pl.DataFrame | pl.LazyFrame,
+                        min_length: int = 5,
+                        max_length: int = 4096,
+                        ) -> tuple[pl.DataFrame | pl.LazyFrame, pl.DataFrame | pl.LazyFrame]:
+    """
+    Pretraining histories: every train event is a target for train, only the validation events for validation.
+    """
+    train_data = build_histories(_lazy(train_history).with_columns(target=pl.lit(1)), min_length, max_length)
+    valid_data = build_histories(
+        pl.concat([
+            _lazy(train_history).with_columns(target=pl.lit(0)),
+            _lazy(valid_history).with_columns(target=pl.lit(1)),
+        ], how='diagonal'),
+        min_length,
+        max_length,
+    )
+    return _like(train_data, train_history, valid_history), _like(valid_data, train_history, valid_history)
+
+
+def build_candidates(history: pl.DataFrame | pl.LazyFrame,
+                     targets: pl.DataFrame | pl.LazyFrame,
+                     min_length: int = 5,
+                     max_length: int = 4096,
+                     history_length: int = 512,
+                     lag_days: tuple[int, int] | None = None,
+                     seed: int = 0,
+                     ) -> pl.DataFrame | pl.LazyFrame:
+    """
+    One row per user with a `HISTORY_SCHEMA` history of the last `history_length` events and a
+    `CANDIDATES_SCHEMA` group of the last `max_length` target requests. A request points with
+    `targets_inds` to the last history event at or before its timestamp, minus a random lag of
+    [lag_days[0], lag_days[1]) days when `lag_days` is given; requests without such an event, with an
+    empty product list or a zero, empty or missing request_id are dropped. Users need more than `min_length`
+    requests and history events. The lag is a hash of (user_id, request_id, timestamp, seed), independent
+    of the row order and reproducible for a seed within one polars version; polars does not keep hashes
+    stable across versions.
+    Args:
+        history (pl.DataFrame | pl.LazyFrame): user_id, timestamp, source_type, action_type, product_id events
+        targets (pl.DataFrame | pl.LazyFrame): requests with user_id, request_id, timestamp, source_type
+        and product_id and action_type lists
+        min_length (int): users need more requests and history events than this
+        max_length (int): number of kept most recent requests
+        history_length (int): number of kept most recent history events
+        lag_days (tuple[int, int] | None): random lag range, no lag by default
+        seed (int): seed of the lag
+    Returns:
+        pl.DataFrame | pl.LazyFrame: `history` and `candidates` columns, lazy when an input is lazy, ordered by user
+    """
+    events = (
+        sort_by_timestamp(_lazy(history))
+        .filter(pl.int_range(pl.len()).reverse().over("user_id") < history_length)
+        .with_columns(pl.int_range(pl.len()).over("user_id").alias("target_ind"))
+    )
+    latest = (
+        events
+        .group_by("user_id", "timestamp")
+        .agg(pl.col("target_ind").max())
+        .sort("timestamp")
+    )
+    max_time = pl.col("timestamp")
+    if lag_days is not None:
+        lag = pl.struct("user_id", "request_id", "timestamp").hash(seed) % (lag_days[1] - lag_days[0]) + lag_days[0]
+        max_time = max_time - lag.cast(pl.Int64) * SECONDS_PER_DAY
+    lazy_targets = _lazy(targets)
+    requests = (
+        sort_by_timestamp(lazy_targets)
+        .filter(pl.col("action_type").list.len() > 0)
+        .with_row_index("order")
+        .with_columns(max_time.alias("max_time"))
+        .sort("max_time")
+        .join_asof(latest, left_on="max_time", right_on="timestamp", by="user_id", check_sortedness=False,
+                   suffix="_history")
+        .filter(pl.col("target_ind").is_not_null() & _is_set(lazy_targets, "request_id"))
+        .sort("order")
+        .filter(pl.int_range(pl.len()).reverse().over("user_id") < max_length)
+    )
+    candidates = (
+        requests
+        .group_by("user_id", maintain_order=True)
+        .agg(
+            pl.col("target_ind").alias("targets_inds"),
+            pl.col("source_type").alias("candidate_source_type"),
+            pl.col("action_type").explode().alias("candidate_action_type"),
+            pl.col("product_id").explode().alias("candidate_product_id"),
+            pl.col("action_type").list.len().alias("candidate_lengths"),
+            pl.len().alias("num_requests"),
+        )
+        .select(
+            "user_id",
+            "targets_inds",
+            pl.struct(
+                pl.col("candidate_source_type").alias("source_type"),
+                pl.col("candidate_action_type").alias("action_type"),
+                pl.col("candidate_product_id").alias("product_id"),
+                pl.col("candidate_lengths").alias("lengths"),
+                pl.concat_list("num_requests").alias("num_requests"),
+            ).alias("candidates"),
+        )
+    )
+    result = (
+        events
+        .group_by("user_id", maintain_order=True)
+        .agg(pl.col("source_type", "action_type", "product_id"))
+        .join(candidates, on="user_id", how="inner", maintain_order="left")
+        .filter(
+            (pl.col("targets_inds").list.len() > min_length) &
+            (pl.col("product_id").list.len() > min_length)
+        )
+        .select(
+            _history_struct(pl.col("targets_inds")),
+            pl.col("candidates").cast(CANDIDATES_SCHEMA),
+        )
+    )
+    return _like(result, history, targets)
+
+
+def build_finetune_data(train_history: pl.DataFrame | pl.LazyFrame,
+                        train_targets: pl.DataFrame | pl.LazyFrame,
+                        valid_targets: pl.DataFrame | pl.LazyFrame,
+                        min_length: int = 5,
+                        max_length: int = 4096,
+                        history_length: int = 512,
+                        lag_days: tuple[int, int] = (2, 32),
+                        seed: int = 0,
+                        ) -> tuple[pl.DataFrame | pl.LazyFrame, pl.DataFrame | pl.LazyFrame]:
+    """
+    Finetuning rows over the train history: train requests look at the history `lag_days` before them,
+    validation requests at the history before their timestamp, see `build_candidates`.
+    """
+    train_data = build_candidates(train_history, train_targets, min_length, max_length, history_length, lag_days, seed)
+    valid_data = build_candidates(train_history, valid_targets, min_length, max_length, history_length)
+    return train_data, valid_data
@@ -1,10 +1,11 @@
-from grocery.metrics.base import Evaluator
+from grocery.metrics.base import Evaluator, HitMatrix
 from grocery.metrics.quality import Precision, Recall, MAP, NDCG, DCG, AUC
 from grocery.metrics.aspects import Novelty, Serendipity, CategoryDiversity
 
 
 __all__ = [
     "Evaluator",
+    "HitMatrix",
     "Precision",
     "Recall",
     "MAP",
@@ -1,10 +1,66 @@
+import numpy as np
 import polars as pl
 
 from grocery.recommender.primitives import Candidate
-from grocery.metrics.base import Metric
+from grocery.metrics.base import HitMatrix, Metric, row_sum
+
+
+def _dense_table(ids: np.ndarray, values: np.ndarray, default, dtype) -> np.ndarray:
+    """
+    Id-indexed array of the values, `default` for the ids in between.
+    """
+    assert not len(ids) or ids.min() >= 0, "ids have to be non-negative"
+    table = np.full(int(ids.max()) + 1 if len(ids) else 0, default, dtype=dtype)
+    table[ids] = values
+    return table
+
+
+def _lookup(table: np.ndarray, ids: np.ndarray, default) -> np.ndarray:
+    ids = np.asarray(ids, dtype=np.int64)
+    if not len(table):
+        return np.full(ids.shape, default, dtype=table.dtype)
+    known = (ids >= 0) & (ids < len(table))
+    return np.where(known, table[np.where(known, ids, 0)], default)
+
+
+def build_csr(rows: np.ndarray, values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Builds an id-indexed CSR structure (indptr, indices) from (row, value) pairs sorted by row and value.
+    """
+    assert not len(rows) or rows.min() >= 0, "ids have to be non-negative"
+    counts = np.bincount(rows, minlength=int(rows.max()) + 1 if len(rows) else 0)
+    return np.concatenate([[0], np.cumsum(counts)]), values
+
+
+def csr_contains(indptr: np.ndarray, indices: np.ndarray, rows: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """
+    Vectorized membership test of `values[i]` in the sorted row `rows[i]` of a CSR structure.
+    Rows outside the structure are empty.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    values = np.asarray(values, dtype=np.int64)
+    if not len(indices):
+        return np.zeros(len(rows), dtype=bool)
+    known = (rows >= 0) & (rows < len(indptr) - 1)
+    rows = np.where(known, rows, 0)
+    lo = np.where(known, indptr[rows], 0)
+    hi = np.where(known, indptr[rows + 1], 0)
+    end = hi.copy()
+    # binary search inside every row at once
+    while True:
+        active = lo < hi
+        if not active.any():
+            break
+        mid = (lo + hi) // 2
+        go_right = indices[np.where(active, mid, 0)] < values
+        lo = np.where(active & go_right, mid + 1, lo)
+        hi = np.where(active & ~go_right, mid, hi)
+    return (lo < end) & (indices[np.minimum(lo, len(indices) - 1)] == values)
 
 
 class Novelty(Metric):
+    vectorized = True
+
     def __init__(self, interactions: pl.DataFrame, k: int | None = None):
         name = "novelty" if k is None else f"novelty@{k}"
         super().__init__(k, "mean", name)
@@ -16,9 +72,8 @@ class Novelty(Metric):
             .with_columns((1 - (pl.col("popularity") / num_users)).alias("novelty"))
             .select("item_id", "novelty")
         )
-        self.item_novelty = {}
-        for item_id, val in novelty_df.iter_rows():
-            self.item_novelty[item_id] = val
+        self.item_novelty = _dense_table(
+            novelty_df["item_id"].to_numpy(), novelty_df["novelty"].to_numpy(), 1.0, np.float64)
 
     def compute(self,
                 predictions: list[Candidate],
@@ -29,22 +84,30 @@ class Novelty(Metric):
             return 0
         if self.k is not None:
             predictions = predictions[:self.k]
-        numer = sum(self.item_novelty.get(p.id, 1) for p in predictions)
+        numer = sum(_lookup(self.item_novelty, [p.id for p in predictions], 1.0).tolist())
         denom = len(predictions)
         return numer / denom
 
+    def compute_batch(self, hits: HitMatrix) -> np.ndarray:
+        mask = hits.mask[:, :self.k]
+        numer = row_sum(np.where(mask, _lookup(self.item_novelty, hits.ids[:, :self.k], 1.0), 0.0))
+        denom = hits.lengths_at(self.k)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(denom > 0, numer / denom, 0.0)
+
 
 class Serendipity(Metric):
+    vectorized = True
+
     def __init__(self, interactions: pl.DataFrame, k: int | None = None):
         name = "serendipity" if k is None else f"serendipity@{k}"
         super().__init__(k, "mean", name)
-        self.user_history = {}
-        for user_id, history in (
-            interactions
-            .group_by("user_id")
-            .agg(pl.col("item_id").unique().alias("history"))
-        ).iter_rows():
-            self.user_history[user_id] = set(history)
+        history = interactions.select("user_id", "item_id").unique().sort("user_id", "item_id")
+        self.history_indptr, self.history_indices = build_csr(
+            history["user_id"].to_numpy().astype(np.int64), history["item_id"].to_numpy().astype(np.int64))
+
+    def _seen(self, user_ids: np.ndarray, item_ids: np.ndarray) -> np.ndarray:
+        return csr_contains(self.history_indptr, self.history_indices, user_ids, item_ids)
 
     def compute(self,
                 predictions: list[Candidate],
@@ -55,25 +118,45 @@ class Serendipity(Metric):
             return 0
         if self.k is not None:
             predictions = predictions[:self.k]
-        seen = self.user_history[user_id]
-        numer, denom = 0, 0
-        for p in predictions:
-            numer += int(p.id not in seen and p.id in positives)
-            denom += int(p.id in positives)
+        item_ids = np.array([p.id for p in predictions], dtype=np.int64)
+        relevant = np.isin(item_ids, np.asarray(positives, dtype=np.int64))
+        seen = self._seen(np.full(len(item_ids), user_id), item_ids)
+        numer = int((relevant & ~seen).sum())
+        denom = int(relevant.sum())
         return numer / denom if denom else 0
 
+    def compute_batch(self, hits: HitMatrix) -> np.ndarray:
+        relevant = hits.relevant[:, :self.k]
+        ids = hits.ids[:, :self.k]
+        seen = self._seen(np.broadcast_to(hits.user_ids[:, None], ids.shape).reshape(-1), ids.reshape(-1))
+        numer = (relevant & ~seen.reshape(ids.shape)).sum(axis=1)
+        denom = relevant.sum(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(denom > 0, numer / denom, 0.0)
+
 
 class CategoryDiversity(Metric):
+    vectorized = True
+    unknown_category = -1
+
     def __init__(self, interactions: pl.DataFrame, k: int | None = None):
+        """
+        Share of distinct categories among the predictions. Items without a category, or with
+        a null one, count as one shared unknown category.
+        """
         name = "category_diversity" if k is None else f"category_diversity@{k}"
         super().__init__(k, "mean", name)
-        self.categories = {}
-        for item_id, category_id in (
+        categories = (
             interactions
             .select("item_id", "product_category")
-            .unique()
-        ).iter_rows():
-            self.categories[item_id] = category_id
+            .unique(subset="item_id", keep="last", maintain_order=True)
+            .with_columns(
+                pl.col("product_category").rank("dense").cast(pl.Int32)
+                .fill_null(self.unknown_category).alias("category_code")
+            )
+        )
+        self.categories = _dense_table(
+            categories["item_id"].to_numpy(), categories["category_code"].to_numpy(), self.unknown_category, np.int32)
 
     def compute(self,
                 predictions: list[Candidate],
@@ -84,5 +167,19 @@ class CategoryDiversity(Metric):
             return 0
         if self.k is not None:
             predictions = predictions[:self.k]
-        unique_categories = len(set(self.categories[p.id] for p in predictions))
-        return unique_categories / len(predictions)
+        codes = _lookup(self.categories, [p.id for p in predictions], self.unknown_category)
+        return len(np.unique(codes)) / len(predictions)
+
+    def compute_batch(self, hits: HitMatrix) -> np.ndarray:
+        padding = self.unknown_category - 1
+        mask = hits.mask[:, :self.k]
+        codes = np.where(mask, _lookup(self.categories, hits.ids[:, :self.k], self.unknown_category), padding)
+        codes = np.sort(codes, axis=1)
+        if not codes.shape[1]:
+            return np.zeros(len(codes))
+        # padding sorts first, count the starts of runs of real codes
+        starts = (codes[:, 1:] != codes[:, :-1]) & (codes[:, 1:] != padding)
+        unique_categories = (codes[:, 0] != padding) + starts.sum(axis=1)
+        denom = hits.lengths_at(self.k)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(denom > 0, unique_categories / denom, 0.0)
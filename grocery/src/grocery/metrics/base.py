@@ -1,16 +1,106 @@
-from typing import Callable, TypeAlias
+import math
+import os
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass
+from itertools import chain
+from typing import TYPE_CHECKING, Callable, TypeAlias
 from abc import ABC, abstractmethod
 
+import numpy as np
 import polars as pl
 from tqdm import tqdm
 
 from grocery.recommender.primitives import Candidate
 
+if TYPE_CHECKING:
+    from grocery.recommender.recommender import BaseRecommender
+
 # recommend(user_id, num_items) -> list[candidate]
 RecommendHandle: TypeAlias = Callable[[int, int], list[Candidate]]
 
 
+def row_sum(values: np.ndarray) -> np.ndarray:
+    """
+    Sums the rows left to right like the per-request metrics do, np.sum would reorder the additions.
+    """
+    if not values.shape[1]:
+        return np.zeros(len(values))
+    return np.cumsum(values, axis=1)[:, -1]
+
+
+@dataclass
+class HitMatrix:
+    """
+    Predictions of many requests matched against their positives, padded to a common width.
+    Args:
+        ids (np.ndarray): (n_requests, width) predicted ids, -1 in the padding
+        mask (np.ndarray): (n_requests, width) True for real predictions
+        relevant (np.ndarray): (n_requests, width) the prediction is one of the positives
+        first_hits (np.ndarray): (n_requests, width) relevant and not predicted earlier in the request
+        lengths (np.ndarray): number of predictions per request
+        num_positives (np.ndarray): number of positives per request, duplicates included
+        num_unique_positives (np.ndarray): number of distinct positives per request
+        user_ids (np.ndarray | None): user id of every request
+    """
+    ids: np.ndarray
+    mask: np.ndarray
+    relevant: np.ndarray
+    first_hits: np.ndarray
+    lengths: np.ndarray
+    num_positives: np.ndarray
+    num_unique_positives: np.ndarray
+    user_ids: np.ndarray | None = None
+
+    @classmethod
+    def build(cls,
+              predictions: list[list[Candidate]],
+              positives: list[list[int]],
+              user_ids: list[int] | None = None,
+              ) -> "HitMatrix":
+        n = len(predictions)
+        lengths = np.fromiter((len(p) for p in predictions), dtype=np.int64, count=n)
+        num_positives = np.fromiter((len(p) for p in positives), dtype=np.int64, count=n)
+        total = int(lengths.sum())
+        width = int(lengths.max()) if n else 0
+        flat_ids = np.fromiter((c.id for p in predictions for c in p), dtype=np.int64, count=total)
+        flat_positives = np.fromiter(chain.from_iterable(positives[:n]), dtype=np.int64, count=int(num_positives.sum()))
+        rows = np.repeat(np.arange(n), lengths)
+        cols = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        vocabulary, codes = np.unique(np.concatenate([flat_ids, flat_positives]), return_inverse=True)
+        codes = codes.reshape(-1)
+        prediction_keys = rows * len(vocabulary) + codes[:total]
+        positive_keys = np.unique(np.repeat(np.arange(n), num_positives) * len(vocabulary) + codes[total:])
+        relevant = np.zeros(total, dtype=bool)
+        if len(positive_keys):
+            found = np.minimum(np.searchsorted(positive_keys, prediction_keys), len(positive_keys) - 1)
+            relevant = positive_keys[found] == prediction_keys
+        first = np.zeros(total, dtype=bool)
+        first[np.unique(prediction_keys, return_index=True)[1]] = True
+
+        def dense(values, fill):
+            matrix = np.full((n, width), fill, dtype=np.asarray(values).dtype)
+            matrix[rows, cols] = values
+            return matrix
+
+        return cls(
+            ids=dense(flat_ids, -1),
+            mask=dense(np.ones(total, dtype=bool), False),
+            relevant=dense(relevant, False),
+            first_hits=dense(relevant & first, False),
+            lengths=lengths,
+            num_positives=num_positives,
+            num_unique_positives=np.bincount(positive_keys // max(len(vocabulary), 1), minlength=n),
+            user_ids=None if user_ids is None else np.asarray(user_ids[:n], dtype=np.int64),
+        )
+
+    def lengths_at(self, k: int | None) -> np.ndarray:
+        return self.lengths if k is None else np.minimum(self.lengths, k)
+
+
 class Metric(ABC):
+    vectorized = False
+
     def __init__(self, k: int | None = None, reduce_function: str = "mean", name: str = "Metric"):
         self.k = k
         self.reduce_function = reduce_function
@@ -20,6 +110,12 @@ class Metric(ABC):
     def compute(self, predictions: list[Candidate], positives: list[int], user_id: int | None = None) -> float:
         pass
 
+    def compute_batch(self, hits: HitMatrix) -> np.ndarray:
+        """
+        Per-request values for all the requests at once, available when `vectorized` is set.
+        """
+        raise NotImplementedError
+
 
 class Evaluator:
     def __init__(self, metrics: list[Metric]):
@@ -49,8 +145,10 @@ class Evaluator:
 
 
     @staticmethod
-    def aggregate(values: list[float], reduce_function: str) -> float:
+    def aggregate(values: list[float] | np.ndarray, reduce_function: str) -> float:
         assert reduce_function in ["mean", "sum", "max", "min"]
+        if isinstance(values, np.ndarray):
+            values = values.tolist()
         if reduce_function == "mean":
             return sum(values) / len(values)
         elif reduce_function == "sum":
@@ -75,25 +173,198 @@ class Evaluator:
         Returns:
             dict[str, float]: dictionary of metric values, aggregated by the metric's reduce function
         """
+        predictions = self.predict(self.requests, recommend_callable, batch_size)
+        return self.compute_metrics(predictions)
+
+    def predict(self,
+                requests: list[tuple[int, list[int]]],
+                recommend_callable: RecommendHandle,
+                batch_size: int = 1,
+                progress: bool = True,
+                ) -> list[list[Candidate]]:
+        """
+        Calls the function for every request, or for every `batch_size` requests with a list of user ids.
+        """
         if batch_size == 1:
-            predictions = [
+            return [
                 recommend_callable(user_id, self.max_k)
-                for user_id, _ in tqdm(self.requests)
-            ]
-        else:
-            batched_requests = [
-                list(map(lambda x: x[0], self.requests[i * batch_size : (i + 1) * batch_size]))
-                for i in range(0, len(self.requests) // batch_size + 1)
+                for user_id, _ in tqdm(requests, disable=not progress)
             ]
-            predictions = []
-            for batch in tqdm(batched_requests):
-                predictions.extend(recommend_callable(batch, self.max_k))
+        batched_requests = [
+            [user_id for user_id, _ in requests[i:i + batch_size]]
+            for i in range(0, len(requests), batch_size)
+        ]
+        predictions = []
+        for batch in tqdm(batched_requests, disable=not progress):
+            predictions.extend(recommend_callable(batch, self.max_k))
+        return predictions
+
+    def compute_metrics(self, predictions: list[list[Candidate]]) -> dict[str, float]:
+        """
+        Computes the metrics for the predictions of the loaded requests, in the same order.
+        Vectorized metrics share one `HitMatrix`, the others are computed per request.
+        """
+        values = self.metric_values(predictions, self.requests[:len(predictions)])
+        return {metric.name: self.aggregate(values[metric.name], metric.reduce_function) for metric in self.metrics}
+
+    def metric_values(self,
+                      predictions: list[list[Candidate]],
+                      requests: list[tuple[int, list[int]]],
+                      ) -> dict[str, list[float] | np.ndarray]:
+        hits = None
+        if any(metric.vectorized for metric in self.metrics):
+            hits = HitMatrix.build(
+                predictions,
+                [positives for _, positives in requests],
+                [user_id for user_id, _ in requests],
+            )
         metrics = {}
         for metric in self.metrics:
-            values = []
-            for sample in zip(predictions, self.requests):
-                prediction, (user_id, positives) = sample
-                value = metric.compute(prediction, positives, user_id)
-                values.append(value)
-            metrics[metric.name] = self.aggregate(values, metric.reduce_function)
+            if metric.vectorized:
+                values = metric.compute_batch(hits)
+            else:
+                values = []
+                for sample in zip(predictions, requests):
+                    prediction, (user_id, positives) = sample
+                    value = metric.compute(prediction, positives, user_id)
+                    values.append(value)
+            metrics[metric.name] = values
         return metrics
+
+    @staticmethod
+    def partial_aggregate(values: list[float] | np.ndarray) -> tuple[float, int, float, float]:
+        """
+        Summary of a chunk of values that any reduce function can be finished from: (sum, count, max, min).
+        """
+        if isinstance(values, np.ndarray):
+            values = values.tolist()
+        if not values:
+            return 0.0, 0, -math.inf, math.inf
+        return sum(values), len(values), max(values), min(values)
+
+    @staticmethod
+    def combine_partials(left: tuple[float, int, float, float],
+                         right: tuple[float, int, float, float],
+                         ) -> tuple[float, int, float, float]:
+        return left[0] + right[0], left[1] + right[1], max(left[2], right[2]), min(left[3], right[3])
+
+    @staticmethod
+    def finalize(partial: tuple[float, int, float, float], reduce_function: str) -> float:
+        assert reduce_function in ["mean", "sum", "max", "min"]
+        total, count, maximum, minimum = partial
+        if count == 0:
+            return math.nan
+        if reduce_function == "mean":
+            return total / count
+        elif reduce_function == "sum":
+            return total
+        elif reduce_function == "max":
+            return maximum
+        elif reduce_function == "min":
+            return minimum
+
+    def evaluate_chunk(self,
+                       requests: list[tuple[int, list[int]]],
+                       recommend_callable: RecommendHandle,
+                       batch_size: int = 1,
+                       ) -> dict[str, tuple[float, int, float, float]]:
+        predictions = self.predict(requests, recommend_callable, batch_size, progress=False)
+        values = self.metric_values(predictions, requests)
+        return {name: self.partial_aggregate(metric_values) for name, metric_values in values.items()}
+
+    def evaluate_stream(self,
+                        actions: pl.LazyFrame | pl.DataFrame | str,
+                        recommend_callable: RecommendHandle | None = None,
+                        recommender_factory: Callable[[], "BaseRecommender"] | None = None,
+                        batch_size: int = 1,
+                        chunk_size: int = 100_000,
+                        num_workers: int = 1,
+                        ) -> dict[str, float]:
+        """
+        Evaluates without holding the whole test set or all the predictions in memory.
+        Requests are read in chunks of about `chunk_size` from the actions, every chunk is
+        predicted and reduced to partial sums, which are combined by the metric's reduce function.
+        Args:
+            actions (pl.LazyFrame | pl.DataFrame | str): test actions with (request_id, user_id, item_id) columns,
+            or a parquet path or glob; it is read once and sorted by request_id into a temporary parquet file
+            recommend_callable (Callable | None): same as in `evaluate`, used when `num_workers` is 1
+            recommender_factory (Callable[[], BaseRecommender] | None): picklable function building a recommender,
+            called once per worker process; `recommend` or `recommend_batch` is used according to `batch_size`
+            batch_size (int): number of users per call, 1 means per-user calls
+            chunk_size (int): number of requests per chunk
+            num_workers (int): number of processes evaluating chunks in parallel
+        Returns:
+            dict[str, float]: dictionary of metric values, aggregated by the metric's reduce function,
+            NaN when the test set is empty
+        """
+        assert (recommend_callable is None) != (recommender_factory is None), \
+            "pass either recommend_callable or recommender_factory"
+        assert num_workers == 1 or recommender_factory is not None, "worker processes need a recommender_factory"
+        chunks = _request_chunks(actions, chunk_size)
+        partials = {}
+        if num_workers == 1:
+            if recommend_callable is None:
+                recommend_callable = _recommend_handle(recommender_factory(), batch_size)
+            results = (self.evaluate_chunk(chunk, recommend_callable, batch_size) for chunk in chunks)
+            for result in tqdm(results):
+                partials = self._merge_partials(partials, result)
+        else:
+            with ProcessPoolExecutor(num_workers, initializer=_init_worker,
+                                     initargs=(self.metrics, recommender_factory, batch_size)) as executor:
+                pending = set()
+                for chunk in tqdm(chunks):
+                    # a bounded number of chunks in flight keeps the memory flat
+                    if len(pending) >= 2 * num_workers:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            partials = self._merge_partials(partials, future.result())
+                    pending.add(executor.submit(_evaluate_chunk_in_worker, chunk))
+                for future in pending:
+                    partials = self._merge_partials(partials, future.result())
+        empty = self.partial_aggregate([])
+        return {metric.name: self.finalize(partials.get(metric.name, empty), metric.reduce_function)
+                for metric in self.metrics}
+
+    def _merge_partials(self, partials: dict, result: dict) -> dict:
+        return {name: self.combine_partials(partials[name], value) if name in partials else value
+                for name, value in result.items()}
+
+
+def _request_chunks(actions: pl.LazyFrame | pl.DataFrame | str, chunk_size: int):
+    """
+    Requests ordered by request_id in chunks of `chunk_size`. The source is aggregated and sorted once
+    into a temporary parquet file with one row group per chunk, which is then read chunk by chunk.
+    """
+    if isinstance(actions, str):
+        actions = pl.scan_parquet(actions)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "requests.parquet")
+        (
+            actions.lazy()
+            .group_by("request_id", "user_id")
+            .agg(pl.col("item_id").alias("item_ids"))
+            .sort("request_id", "user_id")
+            .select("user_id", "item_ids")
+            .sink_parquet(path, row_group_size=chunk_size)
+        )
+        requests = pl.scan_parquet(path)
+        num_requests = requests.select(pl.len()).collect().item()
+        for start in range(0, num_requests, chunk_size):
+            yield list(requests.slice(start, chunk_size).collect().iter_rows())
+
+
+def _recommend_handle(recommender: "BaseRecommender", batch_size: int) -> RecommendHandle:
+    return recommender.recommend if batch_size == 1 else recommender.recommend_batch
+
+
+_worker_state = {}
+
+
+def _init_worker(metrics: list[Metric], recommender_factory: Callable[[], "BaseRecommender"], batch_size: int):
+    _worker_state["evaluator"] = Evaluator(metrics)
+    _worker_state["recommend"] = _recommend_handle(recommender_factory(), batch_size)
+    _worker_state["batch_size"] = batch_size
+
+
+def _evaluate_chunk_in_worker(requests: list[tuple[int, list[int]]]) -> dict[str, tuple[float, int, float, float]]:
+    return _worker_state["evaluator"].evaluate_chunk(requests, _worker_state["recommend"], _worker_state["batch_size"])
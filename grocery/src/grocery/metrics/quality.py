@@ -1,11 +1,23 @@
 import math
 from catboost.utils import eval_metric
+import numpy as np
 
 from grocery.recommender.primitives import Candidate
-from grocery.metrics.base import Metric
+from grocery.metrics.base import HitMatrix, Metric, row_sum
+
+
+def _check_nonzero(denominators: np.ndarray, message: str):
+    if (denominators == 0).any():
+        raise ZeroDivisionError(message)
+
+
+def _discounts(width: int) -> np.ndarray:
+    return np.array([math.log(i + 2) for i in range(width)], dtype=np.float64)
 
 
 class Precision(Metric):
+    vectorized = True
+
     def __init__(self, k: int | None = None):
         name = "precision" if k is None else f"precision@{k}"
         super().__init__(k, "mean", name)
@@ -21,8 +33,15 @@ class Precision(Metric):
         num_relevant = len({p.id for p in predictions} & set(positives))
         return num_relevant / num_retrieved
 
+    def compute_batch(self, hits: HitMatrix) -> np.ndarray:
+        num_retrieved = hits.lengths_at(self.k)
+        _check_nonzero(num_retrieved, "precision of a request without predictions")
+        return hits.first_hits[:, :self.k].sum(axis=1) / num_retrieved
+
 
 class Recall(Metric):
+    vectorized = True
+
     def __init__(self, k: int | None = None):
         name = "recall" if k is None else f"recall@{k}"
         super().__init__(k, "mean", name)
@@ -38,18 +57,26 @@ class Recall(Metric):
         num_relevant = float(len({p.id for p in predictions} & set(positives)))
         return num_relevant / num_retrieved
 
+    def compute_batch(self, hits: HitMatrix) -> np.ndarray:
+        _check_nonzero(hits.num_positives, "recall of a request without positives")
+        return hits.first_hits[:, :self.k].sum(axis=1) / hits.num_positives
+
 
 class MAP(Metric):
+    vectorized = True
+
     def __init__(self, k: int | None = None):
         name = "MAP" if k is None else f"MAP@{k}"
         super().__init__(k, "mean", name)
 
     def _apk(self, predicted: list[int], actual: set[int]):
         score, num_hits = 0, 0
+        seen = set()
         for i, p in enumerate(predicted):
-            if p in actual and p not in predicted[:i]:
+            if p in actual and p not in seen:
                 num_hits += 1
                 score += num_hits / (i + 1)
+            seen.add(p)
         if not actual:
             return 1
         elif min(len(actual), self.k) == 0:
@@ -66,12 +93,24 @@ class MAP(Metric):
             predictions = predictions[:self.k]
         return self._apk(predicted=[p.id for p in predictions], actual=set(positives))
 
+    def compute_batch(self, hits: HitMatrix) -> np.ndarray:
+        first_hits = hits.first_hits[:, :self.k]
+        precisions = np.cumsum(first_hits, axis=1) / np.arange(1, first_hits.shape[1] + 1)
+        scores = row_sum(np.where(first_hits, precisions, 0.0))
+        num_actual = hits.num_unique_positives
+        denominators = num_actual if self.k is None else np.minimum(num_actual, self.k)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            values = np.where(denominators > 0, scores / denominators, 0.0)
+        return np.where(num_actual == 0, 1.0, values)
+
 
 def _dcg(relevance: list[int]):
     return sum(r / math.log(i + 2) for i, r in enumerate(relevance))
     
 
 class DCG(Metric):
+    vectorized = True
+
     def __init__(self, k: int | None = None):
         name = "DCG" if k is None else f"DCG@{k}"
         super().__init__(k, "mean", name)
@@ -86,8 +125,14 @@ class DCG(Metric):
         relevance = [int(p.id in positives) for p in predictions]
         return _dcg(relevance)
 
+    def compute_batch(self, hits: HitMatrix) -> np.ndarray:
+        relevant = hits.relevant[:, :self.k]
+        return row_sum(relevant / _discounts(relevant.shape[1]))
+
 
 class NDCG(Metric):
+    vectorized = True
+
     def __init__(self, k: int | None = None):
         name = "NDCG" if k is None else f"NDCG@{k}"
         super().__init__(k, "mean", name)
@@ -104,8 +149,20 @@ class NDCG(Metric):
         denom = _dcg(sorted(relevance, reverse=True))
         return numer / denom if denom else 0
 
+    def compute_batch(self, hits: HitMatrix) -> np.ndarray:
+        relevant = hits.relevant[:, :self.k]
+        discounts = _discounts(relevant.shape[1])
+        numer = row_sum(relevant / discounts)
+        # the ideal ordering puts the relevant predictions first
+        ideal = np.concatenate([[0.0], np.cumsum(1 / discounts)])
+        denom = ideal[relevant.sum(axis=1)]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(denom > 0, numer / denom, 0.0)
+
 
 class AUC(Metric):
+    vectorized = True
+
     def __init__(self, k: int | None = None):
         name = "AUC" if k is None else f"AUC@{k}"
         super().__init__(k, "mean", name)
@@ -120,3 +177,19 @@ class AUC(Metric):
         relevance = [int(p.id in positives) for p in predictions]
         predicted_order = [i for i in range(len(predictions), 0, -1)]
         return eval_metric(relevance, predicted_order, 'AUC:type=Ranking')[0]
+
+    def compute_batch(self, hits: HitMatrix) -> np.ndarray:
+        """
+        Closed form of the ranking AUC for a strictly decreasing score: one minus the share of
+        (positive, negative) pairs where the negative is ranked above. Like CatBoost it is 0
+        when all the predictions are positive or all are negative.
+        """
+        relevant = hits.relevant[:, :self.k]
+        negative = hits.mask[:, :self.k] & ~relevant
+        num_positive = relevant.sum(axis=1)
+        num_negative = negative.sum(axis=1)
+        negatives_above = np.cumsum(negative, axis=1) - negative
+        discordant = (negatives_above * relevant).sum(axis=1)
+        num_pairs = num_positive * num_negative
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(num_pairs > 0, 1 - discordant / num_pairs, 0.0)
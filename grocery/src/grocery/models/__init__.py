@@ -1,5 +1,9 @@
-from grocery.models.als import ALS
+from grocery.models.als import ALS, ImplicitALS
+from grocery.models.out_of_core import DiskCSR, OutOfCoreALS
 
 __all__ = [
-    'ALS'
+    'ALS',
+    'ImplicitALS',
+    'DiskCSR',
+    'OutOfCoreALS',
 ]
@@ -1,11 +1,153 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import polars as pl
+import scipy as sp
 from tqdm import trange
 
-from grocery.utils.dataset import build_matrix_with_mappings
+from grocery.recommender.primitives import EmbeddingTable
+from grocery.utils.dataset import build_matrix_with_mappings, coordinates_to_matrix, ids_to_indices
+
+
+def _resize_rows(R: sp.sparse.csr_array, shape: tuple[int, int]) -> sp.sparse.csr_array:
+    # appended rows are empty, appended columns need no change of the CSR arrays
+    if R.shape == shape:
+        return R
+    indptr = np.concatenate([R.indptr, np.full(shape[0] - R.shape[0], R.indptr[-1], dtype=R.indptr.dtype)])
+    return sp.sparse.csr_array((R.data, R.indices, indptr), shape=shape)
+
+
+def _splice_rows(R: sp.sparse.csr_array, rows: np.ndarray, new_rows: sp.sparse.csr_array) -> sp.sparse.csr_array:
+    """
+    Replaces the sorted `rows` of R with the rows of `new_rows`, copying the untouched spans as they are.
+    """
+    indices, data = [], []
+    span_start = 0
+    for i, row in enumerate(rows):
+        span_stop = R.indptr[row]
+        indices += [R.indices[span_start:span_stop], new_rows.indices[new_rows.indptr[i]:new_rows.indptr[i + 1]]]
+        data += [R.data[span_start:span_stop], new_rows.data[new_rows.indptr[i]:new_rows.indptr[i + 1]]]
+        span_start = R.indptr[row + 1]
+    indices.append(R.indices[span_start:])
+    data.append(R.data[span_start:])
+    lengths = np.diff(R.indptr)
+    lengths[rows] = np.diff(new_rows.indptr)
+    indptr = np.concatenate([[0], np.cumsum(lengths)])
+    index_dtype = np.result_type(R.indices.dtype, new_rows.indices.dtype)
+    return sp.sparse.csr_array(
+        (np.concatenate(data), np.concatenate(indices).astype(index_dtype, copy=False), indptr.astype(index_dtype)),
+        shape=R.shape,
+    )
+
+
+class _FoldInMixin:
+    """
+    Fold-in of new and updated users or items into a trained factorization: their rows of R are
+    updated and re-solved against the frozen opposite factors, new ids are appended to the mappings.
+    Only the touched rows are rebuilt and spliced into `R` and its transposed copy `Rt`, made on the
+    first fold-in, and the Gram matrices of the factors are cached and updated with the re-solved rows.
+    Models provide `R`, `additive_feedback`, `user_ids`, `item_ids`, `user_vectors`, `item_vectors`,
+    `_solver_gram` and `_solve_rows`, and reset `Rt` and `_factor_grams` when fitted.
+    """
+    user_sorter = None
+    item_sorter = None
+    Rt = None
+    _factor_grams = None
+
+    def fold_in_users(self, interactions: pl.DataFrame, batch_size: int = 4096) -> np.ndarray:
+        """
+        Adds (user_id, item_id, rating) interactions of new or known users and re-solves these users.
+        Interactions with unknown items are ignored.
+        Returns:
+            np.ndarray: indices of the updated users in `user_ids` and `user_vectors`
+        """
+        self.R, self.Rt, self.user_ids, self.user_sorter, self.user_vectors, rows = self._fold_in(
+            interactions["user_id"].to_numpy(), interactions["item_id"].to_numpy(), interactions["rating"].to_numpy(),
+            self.R, self._transposed(), self.user_ids, self.user_sorter, self.user_vectors,
+            self.item_ids, self.item_sorter, self.item_vectors, batch_size, users=True,
+        )
+        self.n_users = len(self.user_ids)
+        return rows
+
+    def fold_in_items(self, interactions: pl.DataFrame, batch_size: int = 4096) -> np.ndarray:
+        """
+        Adds (user_id, item_id, rating) interactions of new or known items and re-solves these items.
+        Interactions with unknown users are ignored.
+        Returns:
+            np.ndarray: indices of the updated items in `item_ids` and `item_vectors`
+        """
+        self.Rt, self.R, self.item_ids, self.item_sorter, self.item_vectors, rows = self._fold_in(
+            interactions["item_id"].to_numpy(), interactions["user_id"].to_numpy(), interactions["rating"].to_numpy(),
+            self._transposed(), self.R, self.item_ids, self.item_sorter, self.item_vectors,
+            self.user_ids, self.user_sorter, self.user_vectors, batch_size, users=False,
+        )
+        self.n_items = len(self.item_ids)
+        return rows
+
+    def _transposed(self) -> sp.sparse.csr_array:
+        if self.Rt is None:
+            self.Rt = self.R.T.tocsr()
+        return self.Rt
+
+    def _factor_gram(self, Y: np.ndarray, users: bool) -> np.ndarray:
+        if self._factor_grams is None:
+            self._factor_grams = {}
+        if users not in self._factor_grams:
+            Y = np.asarray(Y, dtype=np.float64)
+            self._factor_grams[users] = Y.T @ Y
+        return self._factor_grams[users]
+
+    def _update_factor_gram(self, users: bool, old_rows: np.ndarray, new_rows: np.ndarray):
+        if self._factor_grams is not None and users in self._factor_grams:
+            old_rows, new_rows = np.asarray(old_rows, dtype=np.float64), np.asarray(new_rows, dtype=np.float64)
+            self._factor_grams[users] += new_rows.T @ new_rows - old_rows.T @ old_rows
+
+    def _update_rows(self, R, row_idx, col_idx, ratings, shape) -> tuple[sp.sparse.csr_array, np.ndarray]:
+        R = _resize_rows(R, shape)
+        rows = np.unique(row_idx)
+        local_idx = np.searchsorted(rows, row_idx)
+        block_shape = (len(rows), shape[1])
+        old_rows = R[rows]
+        update = coordinates_to_matrix(local_idx, col_idx, ratings, block_shape, self.additive_feedback, R.dtype)
+        if not self.additive_feedback:
+            # new ratings replace the stored ones, zeros remove them
+            touched = coordinates_to_matrix(local_idx, col_idx, np.ones(len(local_idx)), block_shape, True, R.dtype)
+            touched.data[:] = 1
+            old_rows = old_rows - old_rows.multiply(touched)
+        new_rows = (old_rows + update).tocsr()
+        new_rows.eliminate_zeros()
+        new_rows.sort_indices()
+        return _splice_rows(R, rows, new_rows), rows
 
+    def _fold_in(self, row_values, col_values, ratings, R, Rt, row_ids, row_sorter, X, col_ids, col_sorter, Y,
+                 batch_size, users):
+        col_idx = ids_to_indices(col_ids, col_values, col_sorter)
+        known = col_idx >= 0
+        row_values, col_idx, ratings = row_values[known], col_idx[known], ratings[known]
+        new_ids = np.setdiff1d(row_values, row_ids)
+        if len(new_ids):
+            row_ids = np.concatenate([row_ids, new_ids.astype(row_ids.dtype)])
+            row_sorter = np.argsort(row_ids, kind="stable")
+            X = np.concatenate([X, np.zeros((len(new_ids), X.shape[1]), dtype=X.dtype)])
+            self._append_rows(len(new_ids), users)
+        row_idx = ids_to_indices(row_ids, row_values, row_sorter)
+        R, rows = self._update_rows(R, row_idx, col_idx, ratings, (len(row_ids), len(col_ids)))
+        Rt, _ = self._update_rows(Rt, col_idx, row_idx, ratings, (len(col_ids), len(row_ids)))
+        gram = self._solver_gram(self._factor_gram(Y, not users))
+        old_rows = X[rows]
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            X[batch] = self._solve_rows(R[batch], X[batch], Y, gram)
+        self._update_factor_gram(users, old_rows, X[rows])
+        return R, Rt, row_ids, row_sorter, X, rows
 
-class ALS:
+    def _append_rows(self, num_rows: int, users: bool):
+        pass
+
+
+class ALS(_FoldInMixin):
     def __init__(self, dim: int, max_iter: int, lr: float, reg_embeddings: float):
         self.lr = lr
         self.dim = dim
@@ -13,12 +155,10 @@ class ALS:
         self.reg_embeddings = reg_embeddings
 
     def _init_parameters(self, ratings: pl.DataFrame, additive_feedback=False):
-        self.R, (
-            self.user_id2idx,
-            self.item_id2idx,
-            self.user_idx2id,
-            self.item_idx2id
-        ) = build_matrix_with_mappings(ratings, additive=additive_feedback)
+        self.additive_feedback = additive_feedback
+        self.R, (self.user_ids, self.item_ids) = build_matrix_with_mappings(ratings, additive=additive_feedback)
+        self.user_sorter, self.item_sorter = None, None
+        self.Rt, self._factor_grams = None, None
         self.n_users, self.n_items = self.R.shape
         self.user_vectors = np.random.normal(size=(self.n_users, self.dim))
         self.item_vectors = np.random.normal(size=(self.n_items, self.dim))
@@ -35,20 +175,255 @@ class ALS:
             
             ppti = (self.user_vectors.T @ self.user_vectors + self.lambda_eye)
             self.item_vectors = self.R.T @ self.user_vectors @ np.linalg.inv(ppti)
-            
+
+    def _solver_gram(self, YtY: np.ndarray) -> np.ndarray:
+        return np.linalg.inv(YtY + self.lambda_eye)
+
+    def _solve_rows(self, R_rows: sp.sparse.csr_array, X_rows: np.ndarray, Y: np.ndarray, gram: np.ndarray) -> np.ndarray:
+        return R_rows @ Y @ gram
+
+    def _append_rows(self, num_rows: int, users: bool):
+        if users:
+            self.user_biases = np.concatenate([self.user_biases, np.zeros((num_rows, 1))])
+        else:
+            self.item_biases = np.concatenate([self.item_biases, np.zeros((num_rows, 1))])
+
+    def extract_embedding_tables(self) -> dict[str, EmbeddingTable]:
+        """
+        User and item factors as float32 tables, e.g. `DotProductKNN(**model.extract_embedding_tables())`.
+        """
+        return {
+            "left_embeddings": EmbeddingTable(self.user_ids, self.user_vectors),
+            "right_embeddings": EmbeddingTable(self.item_ids, self.item_vectors),
+        }
+
+    def extract_model_to_dicts(self):
+        user_ids, item_ids = self.user_ids.tolist(), self.item_ids.tolist()
+        return {
+            "left_embeddings": dict(zip(user_ids, self.user_vectors)),
+            "right_embeddings": dict(zip(item_ids, self.item_vectors)),
+            "left_biases": dict(zip(user_ids, self.user_biases)),
+            "right_biases": dict(zip(item_ids, self.item_biases)),
+        }
+
+
+def _row_dot(left: np.ndarray, right: np.ndarray) -> np.ndarray:
+    return np.einsum("nd,nd->n", left, right)
+
+
+def _row_blocks(indptr: np.ndarray, block_nnz: int, block_rows: int) -> list[tuple[int, int]]:
+    """
+    Splits the rows into consecutive blocks of about `block_nnz` nonzeros and at most `block_rows` rows.
+    """
+    num_rows = len(indptr) - 1
+    blocks, start = [], 0
+    while start < num_rows:
+        stop = int(np.searchsorted(indptr, indptr[start] + block_nnz, side="right")) - 1
+        stop = min(max(stop, start + 1), start + block_rows, num_rows)
+        blocks.append((start, stop))
+        start = stop
+    return blocks
+
+
+def conjugate_gradient_block(confidence: sp.sparse.csr_array,
+                             start: int,
+                             stop: int,
+                             X: np.ndarray,
+                             Y: np.ndarray,
+                             YtY: np.ndarray,
+                             cg_steps: int,
+                             ):
+    """
+    Updates rows start:stop of X in place with a few conjugate gradient steps on the implicit ALS
+    normal equations (YtY + Yt (C_u - I) Y) x_u = Yt C_u p_u, where p_u is 1 on the nonzeros of
+    row u of `confidence` and C_u holds their confidences 1 + alpha * r. YtY already includes the
+    regularization. The Gram-matrix trick keeps the cost proportional to the nonzeros of the block.
+    """
+    indptr = confidence.indptr[start:stop + 1] - confidence.indptr[start]
+    nonzeros = slice(confidence.indptr[start], confidence.indptr[stop])
+    indices = confidence.indices[nonzeros]
+    conf = confidence.data[nonzeros]
+    shape = (stop - start, len(Y))
+    rows = np.repeat(np.arange(stop - start), np.diff(indptr))
+    Yi = Y[indices]
+
+    def weighted_sum(weights: np.ndarray) -> np.ndarray:
+        return sp.sparse.csr_array((weights, indices, indptr), shape=shape) @ Y
+
+    x = X[start:stop]
+    r = weighted_sum(conf - (conf - 1) * _row_dot(Yi, x[rows])) - x @ YtY
+    p = r.copy()
+    rs_old = _row_dot(r, r)
+    for _ in range(cg_steps):
+        active = rs_old > 1e-20
+        if not active.any():
+            break
+        Ap = p @ YtY + weighted_sum((conf - 1) * _row_dot(Yi, p[rows]))
+        pAp = _row_dot(p, Ap)
+        step = np.where(active, rs_old / np.where(active & (pAp != 0), pAp, 1), 0).astype(X.dtype)
+        x += step[:, None] * p
+        r -= step[:, None] * Ap
+        rs_new = _row_dot(r, r)
+        p = r + np.where(active, rs_new / np.where(active, rs_old, 1), 0).astype(X.dtype)[:, None] * p
+        rs_old = rs_new
+    X[start:stop] = x
+
+
+class ImplicitALS(_FoldInMixin):
+    def __init__(self,
+                 dim: int = 64,
+                 max_iter: int = 15,
+                 reg: float = 0.01,
+                 alpha: float = 40.0,
+                 cg_steps: int = 3,
+                 num_threads: int | None = None,
+                 block_nnz: int = 1 << 17,
+                 block_rows: int = 4096,
+                 dtype: np.dtype = np.float32,
+                 early_stopping_rounds: int | None = None,
+                 tol: float = 0.0,
+                 random_state: int | None = None,
+                 fold_in_cg_steps: int = 10,
+                 ):
+        """
+        Implicit-feedback ALS (Hu, Koren, Volinsky) with confidence 1 + alpha * rating, solved by
+        conjugate gradient over blocks of rows on a thread pool.
+        Args:
+            dim (int): embedding size
+            max_iter (int): maximal number of alternating iterations
+            reg (float): L2 regularization of the factors
+            alpha (float): confidence scale of the ratings
+            cg_steps (int): conjugate gradient steps per row and half-iteration
+            num_threads (int | None): size of the thread pool, all cores by default
+            block_nnz (int): approximate number of nonzeros per block, bounds the per-thread memory
+            to about block_nnz * dim values
+            block_rows (int): maximal number of rows per block
+            dtype (np.dtype): factor and matrix type
+            early_stopping_rounds (int | None): stop when the held-out loss has not improved by `tol`
+            for this many iterations, the best factors are kept
+            tol (float): minimal improvement of the held-out loss
+            random_state (int | None): seed of the factor initialization
+            fold_in_cg_steps (int): conjugate gradient steps per row in `fold_in_users` and `fold_in_items`
+        """
+        self.dim = dim
+        self.max_iter = max_iter
+        self.reg = reg
+        self.alpha = alpha
+        self.cg_steps = cg_steps
+        self.num_threads = num_threads or os.cpu_count()
+        self.block_nnz = block_nnz
+        self.block_rows = block_rows
+        self.dtype = dtype
+        self.early_stopping_rounds = early_stopping_rounds
+        self.tol = tol
+        self.random_state = random_state
+        self.fold_in_cg_steps = fold_in_cg_steps
+
+    def _confidence(self, R: sp.sparse.csr_array) -> sp.sparse.csr_array:
+        confidence = R.copy()
+        confidence.data = (1 + self.alpha * confidence.data).astype(self.dtype)
+        return confidence
+
+    def _init_parameters(self, ratings: pl.DataFrame):
+        self.additive_feedback = True
+        self.R, (self.user_ids, self.item_ids) = build_matrix_with_mappings(ratings, additive=True, dtype=self.dtype)
+        self.user_sorter, self.item_sorter = None, None
+        self.Rt, self._factor_grams = None, None
+        self.n_users, self.n_items = self.R.shape
+        rng = np.random.default_rng(self.random_state)
+        self.user_vectors = (rng.standard_normal((self.n_users, self.dim)) * 0.01).astype(self.dtype)
+        self.item_vectors = (rng.standard_normal((self.n_items, self.dim)) * 0.01).astype(self.dtype)
+
+    def _solver_gram(self, YtY: np.ndarray) -> np.ndarray:
+        return (YtY + self.reg * np.eye(self.dim)).astype(self.dtype)
+
+    def _gram(self, Y: np.ndarray) -> np.ndarray:
+        return self._solver_gram(Y.T @ Y)
+
+    def _half_step(self, executor: ThreadPoolExecutor, confidence: sp.sparse.csr_array, X: np.ndarray, Y: np.ndarray):
+        YtY = self._gram(Y)
+        blocks = _row_blocks(confidence.indptr, self.block_nnz, self.block_rows)
+        futures = [
+            executor.submit(conjugate_gradient_block, confidence, start, stop, X, Y, YtY, self.cg_steps)
+            for start, stop in blocks
+        ]
+        for future in futures:
+            future.result()
+
+    def _solve_rows(self, R_rows: sp.sparse.csr_array, X_rows: np.ndarray, Y: np.ndarray, gram: np.ndarray) -> np.ndarray:
+        X_rows = X_rows.copy()
+        conjugate_gradient_block(self._confidence(R_rows), 0, len(X_rows), X_rows, Y, gram, self.fold_in_cg_steps)
+        return X_rows
+
+    def _validation_matrix(self, validation: pl.DataFrame) -> sp.sparse.coo_array:
+        user_idx = ids_to_indices(self.user_ids, validation["user_id"].to_numpy(), self.user_sorter)
+        item_idx = ids_to_indices(self.item_ids, validation["item_id"].to_numpy(), self.item_sorter)
+        known = (user_idx >= 0) & (item_idx >= 0)
+        V = sp.sparse.coo_array(
+            (validation["rating"].to_numpy()[known].astype(self.dtype), (user_idx[known], item_idx[known])),
+            shape=(self.n_users, self.n_items),
+        ).tocsr()
+        V.sum_duplicates()
+        return V.tocoo()
+
+    def heldout_loss(self, V: sp.sparse.coo_array, seed: int = 0) -> float:
+        """
+        Sampled pairwise logistic loss on held-out interactions: every held-out item is compared
+        with a random item of the catalogue, -mean(log sigmoid(s_pos - s_random)). It follows the
+        held-out ranking quality, unlike the weighted squared loss, which keeps growing with
+        the scale of the training fit.
+        """
+        if not V.nnz:
+            return float("nan")
+        negatives = np.random.default_rng(seed).integers(0, self.n_items, V.nnz)
+        X = self.user_vectors[V.row]
+        margin = _row_dot(X, self.item_vectors[V.col]) - _row_dot(X, self.item_vectors[negatives])
+        return float(np.logaddexp(0, -margin.astype(np.float64)).mean())
+
+    def fit(self, ratings: pl.DataFrame, validation: pl.DataFrame | None = None):
+        """
+        Trains on (user_id, item_id, rating) interactions, repeated pairs are summed.
+        With `validation` interactions of the same format the held-out loss is tracked in
+        `history` and used for early stopping.
+        """
+        self._init_parameters(ratings)
+        V = self._validation_matrix(validation) if validation is not None else None
+        user_confidence = self._confidence(self.R)
+        item_confidence = self._confidence(self.R.T.tocsr())
+        self.history = []
+        best_loss, best_iteration, best_factors = float("inf"), -1, None
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            for iteration in trange(self.max_iter):
+                start = time.perf_counter()
+                self._half_step(executor, user_confidence, self.user_vectors, self.item_vectors)
+                self._half_step(executor, item_confidence, self.item_vectors, self.user_vectors)
+                record = {"iteration": iteration, "seconds": time.perf_counter() - start}
+                if V is not None:
+                    record["validation_loss"] = self.heldout_loss(V)
+                    if record["validation_loss"] < best_loss - self.tol:
+                        best_loss, best_iteration = record["validation_loss"], iteration
+                        if self.early_stopping_rounds is not None:
+                            best_factors = (self.user_vectors.copy(), self.item_vectors.copy())
+                self.history.append(record)
+                if (self.early_stopping_rounds is not None and V is not None
+                        and iteration - best_iteration >= self.early_stopping_rounds):
+                    break
+        if best_factors is not None:
+            self.user_vectors, self.item_vectors = best_factors
+        return self
+
+    def extract_embedding_tables(self) -> dict[str, EmbeddingTable]:
+        """
+        User and item factors as float32 tables, e.g. `DotProductKNN(**model.extract_embedding_tables())`.
+        """
+        return {
+            "left_embeddings": EmbeddingTable(self.user_ids, self.user_vectors),
+            "right_embeddings": EmbeddingTable(self.item_ids, self.item_vectors),
+        }
 
     def extract_model_to_dicts(self):
-        left_biases, left_embeddings = {}, {}
-        for user_id, user_idx in self.user_id2idx.items():
-            left_embeddings[user_id] = self.user_vectors[user_idx]
-            left_biases[user_id] = self.user_biases[user_idx]
-        right_biases, right_embeddings = {}, {}
-        for item_id, item_idx in self.item_id2idx.items():
-            right_embeddings[item_id] = self.item_vectors[item_idx]
-            right_biases[item_id] = self.item_biases[item_idx]
+        user_ids, item_ids = self.user_ids.tolist(), self.item_ids.tolist()
         return {
-            "left_embeddings": left_embeddings,
-            "right_embeddings": right_embeddings,
-            "left_biases": left_biases,
-            "right_biases": right_biases,
-        }
\ No newline at end of file
+            "left_embeddings": dict(zip(user_ids, self.user_vectors)),
+            "right_embeddings": dict(zip(item_ids, self.item_vectors)),
+        }
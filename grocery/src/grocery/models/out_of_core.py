@@ -0,0 +1,281 @@
+import json
+import math
+import shutil
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+import scipy as sp
+from tqdm import trange
+
+from grocery.models.als import _row_blocks
+from grocery.recommender.primitives import EmbeddingTable
+from grocery.utils.io import write_json
+
+
+def _scan(ratings: pl.DataFrame | pl.LazyFrame | str | list[str]) -> pl.LazyFrame:
+    if isinstance(ratings, pl.DataFrame):
+        return ratings.lazy()
+    if isinstance(ratings, pl.LazyFrame):
+        return ratings
+    return pl.scan_parquet(ratings)
+
+
+def _fingerprint(ratings: pl.DataFrame | pl.LazyFrame | str | list[str]) -> dict:
+    # order-independent summary of the interactions, tells a resumed job that its input has changed
+    sums = [pl.col(name).cast(pl.Float64).sum().alias(f"{name}_sum") for name in ("user_id", "item_id", "rating")]
+    return _scan(ratings).select(pl.len().alias("num_ratings"), *sums).collect().row(0, named=True)
+
+
+def _same_fingerprint(left: dict, right: dict) -> bool:
+    return left.keys() == right.keys() and all(math.isclose(left[key], right[key], rel_tol=1e-9) for key in left)
+
+
+class DiskCSR:
+    def __init__(self, path: str | Path):
+        """
+        Read-only CSR matrix stored as `indptr.npy`, `indices.npy` and `data.npy` in a directory and
+        memory-mapped, rows are materialized block by block with `rows`. Built by `DiskCSR.build`.
+        """
+        self.path = Path(path)
+        meta = json.loads((self.path / "meta.json").read_text())
+        self.shape = tuple(meta["shape"])
+        self.indptr = np.load(self.path / "indptr.npy", mmap_mode="r")
+        self.indices = np.load(self.path / "indices.npy", mmap_mode="r")
+        self.data = np.load(self.path / "data.npy", mmap_mode="r")
+
+    @classmethod
+    def build(cls,
+              ratings: pl.DataFrame | pl.LazyFrame | str | list[str],
+              path: str | Path,
+              row_ids: np.ndarray,
+              col_ids: np.ndarray,
+              row: str = "user_id",
+              col: str = "item_id",
+              additive: bool = False,
+              dtype: np.dtype = np.float32,
+              chunk_size: int = 1 << 22,
+              ) -> "DiskCSR":
+        """
+        Writes the (row x col) rating matrix of (user_id, item_id, rating) interactions without
+        materializing it: the interactions are aggregated and sorted by polars into a temporary parquet
+        file, which is then copied into the memory-mapped arrays `chunk_size` rows at a time.
+        Args:
+            ratings (pl.DataFrame | pl.LazyFrame | str | list[str]): interactions or parquet file paths
+            path (str | Path): output directory
+            row_ids (np.ndarray): sorted ids of the rows, ids missing from it are dropped
+            col_ids (np.ndarray): sorted ids of the columns, ids missing from it are dropped
+            row (str): column of the row ids, "item_id" builds the transposed matrix
+            col (str): column of the column ids
+            additive (bool): sum the repeated ratings instead of keeping the last one
+            dtype (np.dtype): value type of the matrix
+            chunk_size (int): number of nonzeros copied at once
+        Returns:
+            DiskCSR: the opened matrix
+        """
+        path = Path(path)
+        shutil.rmtree(path, ignore_errors=True)
+        path.mkdir(parents=True)
+        rating = pl.col("rating").sum() if additive else pl.col("rating").sort_by("order").last()
+        sorted_path = path / "coordinates.parquet"
+        (
+            _scan(ratings)
+            .select(row, col, "rating")
+            .with_row_index("order")
+            .join(pl.LazyFrame({row: row_ids, "row_idx": np.arange(len(row_ids))}), on=row)
+            .join(pl.LazyFrame({col: col_ids, "col_idx": np.arange(len(col_ids))}), on=col)
+            .group_by("row_idx", "col_idx")
+            .agg(rating)
+            .filter(pl.col("rating") != 0)
+            .sort("row_idx", "col_idx")
+            .sink_parquet(sorted_path)
+        )
+        coordinates = pl.scan_parquet(sorted_path)
+        counts = coordinates.group_by("row_idx").len().collect()
+        lengths = np.bincount(counts["row_idx"].to_numpy(), counts["len"].to_numpy(), minlength=len(row_ids))
+        indptr = np.concatenate([[0], np.cumsum(lengths.astype(np.int64))])
+        nnz = int(indptr[-1])
+        index_dtype = np.int32 if max(len(row_ids), len(col_ids), nnz) < np.iinfo(np.int32).max else np.int64
+        np.save(path / "indptr.npy", indptr.astype(index_dtype))
+        indices = np.lib.format.open_memmap(path / "indices.npy", mode="w+", dtype=index_dtype, shape=(nnz,))
+        data = np.lib.format.open_memmap(path / "data.npy", mode="w+", dtype=dtype, shape=(nnz,))
+        for start in range(0, nnz, chunk_size):
+            chunk = coordinates.slice(start, chunk_size).select("col_idx", "rating").collect()
+            indices[start:start + len(chunk)] = chunk["col_idx"].to_numpy()
+            data[start:start + len(chunk)] = chunk["rating"].to_numpy()
+        indices.flush()
+        data.flush()
+        del indices, data
+        sorted_path.unlink()
+        write_json(path / "meta.json", {"shape": [len(row_ids), len(col_ids)], "nnz": nnz})
+        return cls(path)
+
+    @property
+    def nnz(self) -> int:
+        return int(self.indptr[-1])
+
+    def rows(self, start: int, stop: int) -> sp.sparse.csr_array:
+        lo, hi = self.indptr[start], self.indptr[stop]
+        return sp.sparse.csr_array(
+            (np.asarray(self.data[lo:hi]), np.asarray(self.indices[lo:hi]), np.asarray(self.indptr[start:stop + 1] - lo)),
+            shape=(stop - start, self.shape[1]),
+        )
+
+
+class OutOfCoreALS:
+    def __init__(self,
+                 path: str | Path,
+                 dim: int = 64,
+                 max_iter: int = 15,
+                 reg_embeddings: float = 0.1,
+                 memory_budget: int = 1 << 30,
+                 dtype: np.dtype = np.float32,
+                 additive_feedback: bool = False,
+                 random_state: int | None = None,
+                 ):
+        """
+        ALS with the same updates as `ALS`, trained out of core. R and its transpose live in `path`
+        as `DiskCSR` matrices, user and item factors as .npy memory maps; rows are processed in blocks
+        sized to `memory_budget`. The state is checkpointed after every half-sweep, so `fit` on the same
+        `path` resumes a killed job where it stopped.
+        Args:
+            path (str | Path): working directory of the matrices, factors and checkpoint
+            dim (int): embedding size
+            max_iter (int): number of alternating iterations
+            reg_embeddings (float): L2 regularization of the factors
+            memory_budget (int): approximate bytes of rating blocks and factor blocks held in memory at once;
+            the opposite factors are read through the page cache
+            dtype (np.dtype): factor and matrix type
+            additive_feedback (bool): sum the repeated ratings instead of keeping the last one
+            random_state (int | None): seed of the factor initialization
+        """
+        assert memory_budget > 0
+        self.path = Path(path)
+        self.dim = dim
+        self.max_iter = max_iter
+        self.reg_embeddings = reg_embeddings
+        self.memory_budget = memory_budget
+        self.dtype = np.dtype(dtype)
+        self.additive_feedback = additive_feedback
+        self.random_state = random_state
+
+    @property
+    def _checkpoint_path(self) -> Path:
+        return self.path / "checkpoint.json"
+
+    def _config(self) -> dict:
+        return {"dim": self.dim, "dtype": self.dtype.str, "reg_embeddings": self.reg_embeddings,
+                "additive_feedback": self.additive_feedback}
+
+    def _block_sizes(self, R: DiskCSR) -> tuple[int, int]:
+        """
+        Half of the budget goes to the nonzeros of a block, half to its float64 products and output rows.
+        """
+        nnz_bytes = R.indices.itemsize + R.data.itemsize + 8
+        row_bytes = self.dim * (2 * 8 + self.dtype.itemsize)
+        return max(self.memory_budget // 2 // nnz_bytes, 1), max(self.memory_budget // 2 // row_bytes, 1)
+
+    def _factor_blocks(self, num_rows: int) -> list[tuple[int, int]]:
+        step = max(self.memory_budget // (self.dim * 8 * 2), 1)
+        return [(start, min(start + step, num_rows)) for start in range(0, num_rows, step)]
+
+    def _reset(self):
+        for name in ("R", "Rt"):
+            shutil.rmtree(self.path / name, ignore_errors=True)
+        for name in ("checkpoint.json", "user_ids.npy", "item_ids.npy", "user_vectors.npy", "item_vectors.npy"):
+            (self.path / name).unlink(missing_ok=True)
+
+    def _init_parameters(self, ratings: pl.DataFrame | pl.LazyFrame | str | list[str]):
+        self.path.mkdir(parents=True, exist_ok=True)
+        lazy = _scan(ratings)
+        self.fingerprint = _fingerprint(lazy)
+        self.user_ids = lazy.select(pl.col("user_id").unique().sort()).collect()["user_id"].to_numpy()
+        self.item_ids = lazy.select(pl.col("item_id").unique().sort()).collect()["item_id"].to_numpy()
+        np.save(self.path / "user_ids.npy", self.user_ids)
+        np.save(self.path / "item_ids.npy", self.item_ids)
+        self.R = DiskCSR.build(lazy, self.path / "R", self.user_ids, self.item_ids,
+                               additive=self.additive_feedback, dtype=self.dtype)
+        self.Rt = DiskCSR.build(lazy, self.path / "Rt", self.item_ids, self.user_ids, row="item_id", col="user_id",
+                                additive=self.additive_feedback, dtype=self.dtype)
+        self.n_users, self.n_items = self.R.shape
+        self.user_vectors = np.lib.format.open_memmap(
+            self.path / "user_vectors.npy", mode="w+", dtype=self.dtype, shape=(self.n_users, self.dim))
+        self.item_vectors = np.lib.format.open_memmap(
+            self.path / "item_vectors.npy", mode="w+", dtype=self.dtype, shape=(self.n_items, self.dim))
+        rng = np.random.default_rng(self.random_state)
+        for start, stop in self._factor_blocks(self.n_items):
+            self.item_vectors[start:stop] = rng.standard_normal((stop - start, self.dim))
+        self.user_vectors.flush()
+        self.item_vectors.flush()
+        self._save_checkpoint(0)
+
+    def _load(self) -> int:
+        checkpoint = json.loads(self._checkpoint_path.read_text())
+        if checkpoint["config"] != self._config():
+            raise ValueError(f"checkpoint in {self.path} was written with {checkpoint['config']}, not {self._config()}")
+        self.fingerprint = checkpoint["ratings"]
+        self.user_ids = np.load(self.path / "user_ids.npy")
+        self.item_ids = np.load(self.path / "item_ids.npy")
+        self.R = DiskCSR(self.path / "R")
+        self.Rt = DiskCSR(self.path / "Rt")
+        self.n_users, self.n_items = self.R.shape
+        self.user_vectors = np.load(self.path / "user_vectors.npy", mmap_mode="r+")
+        self.item_vectors = np.load(self.path / "item_vectors.npy", mmap_mode="r+")
+        return checkpoint["half_steps"]
+
+    def _save_checkpoint(self, half_steps: int):
+        write_json(self._checkpoint_path, {"half_steps": half_steps, "config": self._config(), "ratings": self.fingerprint})
+
+    def _gram(self, Y: np.ndarray) -> np.ndarray:
+        gram = self.reg_embeddings * np.eye(self.dim)
+        for start, stop in self._factor_blocks(len(Y)):
+            block = np.asarray(Y[start:stop], dtype=np.float64)
+            gram += block.T @ block
+        return gram
+
+    def _half_step(self, R: DiskCSR, X: np.ndarray, Y: np.ndarray):
+        inverse = np.linalg.inv(self._gram(Y))
+        for start, stop in _row_blocks(R.indptr, *self._block_sizes(R)):
+            X[start:stop] = R.rows(start, stop) @ Y @ inverse
+        X.flush()
+
+    def fit(self, ratings: pl.DataFrame | pl.LazyFrame | str | list[str] | None = None, resume: bool = True):
+        """
+        Trains on (user_id, item_id, rating) interactions given as a dataframe, a lazy frame or parquet
+        paths. With `resume` and a checkpoint in `path` the stored matrices and factors are reused and
+        `ratings` may be None; given ratings have to be the ones the checkpoint was trained on, compared
+        by their count and sums, otherwise a ValueError is raised.
+        """
+        if resume and self._checkpoint_path.exists():
+            half_steps = self._load()
+            if ratings is not None and not _same_fingerprint(_fingerprint(ratings), self.fingerprint):
+                raise ValueError(f"ratings differ from the ones of the checkpoint in {self.path}, "
+                                 "pass resume=False to train on them from scratch")
+        else:
+            assert ratings is not None, f"no checkpoint in {self.path}, ratings are required"
+            self._reset()
+            self._init_parameters(ratings)
+            half_steps = 0
+        for half_step in trange(half_steps, 2 * self.max_iter, initial=half_steps, total=2 * self.max_iter):
+            if half_step % 2 == 0:
+                self._half_step(self.R, self.user_vectors, self.item_vectors)
+            else:
+                self._half_step(self.Rt, self.item_vectors, self.user_vectors)
+            self._save_checkpoint(half_step + 1)
+        return self
+
+    def extract_embedding_tables(self) -> dict[str, EmbeddingTable]:
+        """
+        User and item factors as tables over the memory-mapped files, without copying for float32.
+        """
+        return {
+            "left_embeddings": EmbeddingTable(self.user_ids, self.user_vectors),
+            "right_embeddings": EmbeddingTable(self.item_ids, self.item_vectors),
+        }
+
+    def extract_model_to_dicts(self):
+        user_ids, item_ids = self.user_ids.tolist(), self.item_ids.tolist()
+        return {
+            "left_embeddings": dict(zip(user_ids, self.user_vectors)),
+            "right_embeddings": dict(zip(item_ids, self.item_vectors)),
+        }
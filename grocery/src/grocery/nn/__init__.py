@@ -0,0 +1,27 @@
+try:
+    import torch  # noqa: F401
+except ImportError as error:
+    raise ImportError("grocery.nn requires torch, install it with `pip install grocery[nn]`") from error
+
+from grocery.nn.dataset import JaggedDataset, collate_fn, narrowest_dtype
+from grocery.nn.inference import export_item_embeddings, export_user_embeddings
+from grocery.nn.ranking import CalibratedPairwiseLogistic, make_groups, make_pairs, make_ranked_pairs, segmented_ndcg
+from grocery.nn.sampler import TokenBudgetBatchSampler
+from grocery.nn.benchmark import batching_throughput_report, encoder_train_step, padded_history
+
+__all__ = [
+    "JaggedDataset",
+    "collate_fn",
+    "narrowest_dtype",
+    "TokenBudgetBatchSampler",
+    "CalibratedPairwiseLogistic",
+    "make_groups",
+    "make_pairs",
+    "make_ranked_pairs",
+    "segmented_ndcg",
+    "export_item_embeddings",
+    "export_user_embeddings",
+    "batching_throughput_report",
+    "encoder_train_step",
+    "padded_history",
+]
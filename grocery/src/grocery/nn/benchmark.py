@@ -0,0 +1,97 @@
+import time
+from typing import Callable
+
+import numpy as np
+import polars as pl
+import torch
+from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import BatchSampler, DataLoader, RandomSampler
+
+from grocery.nn.dataset import JaggedDataset, collate_fn
+from grocery.nn.sampler import TokenBudgetBatchSampler
+
+
+def padded_history(batch: dict) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Product ids of the collated histories padded to the longest one, with the padding mask.
+    """
+    lengths = batch["history"]["lengths"]
+    product_ids = pad_sequence(torch.split(batch["history"]["product_id"], lengths.tolist()), batch_first=True)
+    mask = torch.arange(product_ids.shape[1])[None, :] >= lengths[:, None]
+    return product_ids, mask
+
+
+def encoder_train_step(num_items: int, dim: int = 64, num_heads: int = 2, seed: int = 0) -> Callable[[dict], None]:
+    """
+    Forward and backward pass of a one layer transformer over the padded histories, a stand-in for
+    the history tower when measuring batching.
+    """
+    torch.manual_seed(seed)
+    embeddings = torch.nn.Embedding(num_items, dim)
+    encoder = torch.nn.TransformerEncoderLayer(dim, num_heads, dim_feedforward=2 * dim, batch_first=True)
+    optimizer = torch.optim.Adam([*embeddings.parameters(), *encoder.parameters()], lr=1e-3)
+
+    def step(batch: dict):
+        product_ids, mask = padded_history(batch)
+        outputs = encoder(embeddings(product_ids), src_key_padding_mask=mask)
+        loss = outputs.masked_fill(mask[..., None], 0).pow(2).mean()
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    return step
+
+
+def batching_throughput_report(dataset: JaggedDataset,
+                               max_tokens: int,
+                               batch_size: int,
+                               step: Callable[[dict], None] | None = None,
+                               bucket_size: int = 4096,
+                               max_batches: int | None = None,
+                               seed: int = 0,
+                               ) -> pl.DataFrame:
+    """
+    Compares uniformly shuffled batches of `batch_size` histories with `TokenBudgetBatchSampler`
+    batches of up to `max_tokens` padded history tokens over one epoch of training steps.
+    Args:
+        dataset (JaggedDataset): rows with a `history` struct, e.g. written from `build_pretrain_data`
+        max_tokens (int): token budget of the bucketed batches
+        batch_size (int): number of rows of the uniform batches
+        step (Callable[[dict], None] | None): training step on a collated batch, `encoder_train_step` by default
+        bucket_size (int): bucket size of the sampler
+        max_batches (int | None): stop an epoch after this many batches
+        seed (int): seed of both orders
+    Returns:
+        pl.DataFrame: one row per sampler with batch statistics, the padding share and history tokens per second
+    """
+    lengths = dataset.row_lengths()
+    if step is None:
+        step = encoder_train_step(int(dataset.values[("history", "product_id")].max()) + 1, seed=seed)
+    samplers = {
+        "uniform": BatchSampler(RandomSampler(dataset, generator=torch.Generator().manual_seed(seed)), batch_size, drop_last=False),
+        "token_budget": TokenBudgetBatchSampler(lengths, max_tokens, bucket_size=bucket_size, seed=seed),
+    }
+    rows = []
+    for mode, sampler in samplers.items():
+        loader = DataLoader(dataset, batch_sampler=sampler, collate_fn=collate_fn)
+        sizes, tokens, padded_tokens = [], 0, 0
+        start = time.perf_counter()
+        for batch in loader:
+            step(batch)
+            batch_lengths = batch["history"]["lengths"].numpy()
+            sizes.append(len(batch_lengths))
+            tokens += int(batch_lengths.sum())
+            padded_tokens += len(batch_lengths) * int(batch_lengths.max())
+            if max_batches is not None and len(sizes) >= max_batches:
+                break
+        elapsed = time.perf_counter() - start
+        rows.append({
+            "mode": mode,
+            "num_batches": len(sizes),
+            "mean_batch_size": float(np.mean(sizes)),
+            "tokens": tokens,
+            "padding_share": 1 - tokens / padded_tokens,
+            "seconds": elapsed,
+            "tokens_per_second": tokens / elapsed,
+        })
+    return pl.DataFrame(rows)
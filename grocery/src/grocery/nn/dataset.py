@@ -0,0 +1,161 @@
+import json
+import os
+
+import numpy as np
+import polars as pl
+import torch
+from torch.utils.data import Dataset
+
+
+JAGGED_FORMAT = "grocery.jagged_dataset"
+JAGGED_FORMAT_VERSION = 1
+INTEGER_DTYPES = (np.int8, np.int16, np.int32, np.int64)
+
+
+def narrowest_dtype(values: np.ndarray) -> np.dtype:
+    """
+    Smallest signed integer type holding all the values, float32 for floating point values.
+    """
+    if values.dtype.kind == "f":
+        return np.dtype(np.float32)
+    if not len(values):
+        return np.dtype(np.int8)
+    low, high = values.min(), values.max()
+    return next(np.dtype(dtype) for dtype in INTEGER_DTYPES if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max)
+
+
+def _list_fields(schema: pl.Schema) -> list[tuple[str, ...]]:
+    fields = []
+    for name, dtype in schema.items():
+        if isinstance(dtype, pl.Struct):
+            fields.extend((name, field.name) for field in dtype.fields if isinstance(field.dtype, pl.List))
+        elif isinstance(dtype, pl.List):
+            fields.append((name,))
+    return fields
+
+
+def _field_expr(field: tuple[str, ...]) -> pl.Expr:
+    expr = pl.col(field[0])
+    return expr.struct.field(field[1]) if len(field) > 1 else expr
+
+
+class JaggedDataset(Dataset):
+    def __init__(self, path: str, mmap: bool = True):
+        """
+        Training rows stored column-wise: every list field is one flat values array and an offsets array,
+        row `i` is `values[offsets[i]:offsets[i + 1]]`. The arrays are memory-mapped copy-on-write, so
+        `__getitem__` returns zero-copy tensors and DataLoader workers share the pages. Written by `write`.
+        Args:
+            path (str): dataset directory
+            mmap (bool): memory-map the arrays instead of reading them into memory
+        """
+        with open(os.path.join(path, "manifest.json")) as f:
+            manifest = json.load(f)
+        if manifest.get("format") != JAGGED_FORMAT or manifest.get("version") != JAGGED_FORMAT_VERSION:
+            raise ValueError(f"unsupported dataset format in {path}")
+        mmap_mode = "c" if mmap else None
+        self.path = path
+        self.mmap = mmap
+        self.num_rows = manifest["num_rows"]
+        self.fields = [tuple(field["name"]) for field in manifest["fields"]]
+        self.values = {}
+        self.offsets = {}
+        for field, meta in zip(self.fields, manifest["fields"]):
+            self.values[field] = np.load(os.path.join(path, meta["values"]), mmap_mode=mmap_mode)
+            self.offsets[field] = np.load(os.path.join(path, meta["offsets"]), mmap_mode=mmap_mode)
+
+    @staticmethod
+    def write(frame: pl.DataFrame | pl.LazyFrame, path: str):
+        """
+        Writes the list columns and the list fields of struct columns, e.g. `history` and `candidates`
+        of the `grocery.data` builders. Values get the narrowest integer type, offsets int32 when they fit.
+        A lazy frame is executed once, its list fields are streamed into a temporary parquet file in `path`
+        and read back one field at a time. Null lists are written as empty lists, null elements inside
+        a list raise a ValueError.
+        """
+        os.makedirs(path, exist_ok=True)
+        lazy = frame.lazy()
+        fields = _list_fields(lazy.collect_schema())
+        columns = lazy.select(_field_expr(field).alias(str(i)) for i, field in enumerate(fields))
+        tmp_path = os.path.join(path, "fields.tmp.parquet")
+        if isinstance(frame, pl.LazyFrame) and fields:
+            columns.sink_parquet(tmp_path)
+            columns = pl.scan_parquet(tmp_path)
+        manifest_fields, num_rows = [], 0
+        for i, field in enumerate(fields):
+            column = columns.select(str(i)).collect()[str(i)]
+            lengths = column.list.len().fill_null(0).to_numpy()
+            if i and len(lengths) != num_rows:
+                raise ValueError(f"field {field} has {len(lengths)} rows, the previous fields {num_rows}")
+            values = column.list.explode(empty_as_null=False, keep_nulls=False)
+            if values.null_count():
+                raise ValueError(f"field {field} has null elements inside its lists")
+            values = values.to_numpy()
+            offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+            offsets_dtype = np.int32 if offsets[-1] <= np.iinfo(np.int32).max else np.int64
+            entry = {"name": list(field), "values": f"{i}.values.npy", "offsets": f"{i}.offsets.npy"}
+            np.save(os.path.join(path, entry["values"]), values.astype(narrowest_dtype(values)))
+            np.save(os.path.join(path, entry["offsets"]), offsets.astype(offsets_dtype))
+            manifest_fields.append(entry)
+            num_rows = len(lengths)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        manifest = {"format": JAGGED_FORMAT, "version": JAGGED_FORMAT_VERSION, "num_rows": num_rows, "fields": manifest_fields}
+        with open(os.path.join(path, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=2)
+
+    @classmethod
+    def from_dataframe(cls, frame: pl.DataFrame | pl.LazyFrame, path: str) -> "JaggedDataset":
+        cls.write(frame, path)
+        return cls(path)
+
+    def __len__(self) -> int:
+        return self.num_rows
+
+    def row_lengths(self, *fields: tuple[str, ...]) -> np.ndarray:
+        """
+        Number of values of every row summed over the fields, read from the offsets alone.
+        Args:
+            fields (tuple[str, ...]): field names such as ("history", "product_id"), the history
+            product ids by default
+        Returns:
+            np.ndarray: int64 lengths of the rows
+        """
+        lengths = np.zeros(self.num_rows, dtype=np.int64)
+        for field in fields or [("history", "product_id")]:
+            lengths += np.diff(self.offsets[tuple(field)])
+        return lengths
+
+    def __getstate__(self) -> dict:
+        # spawned loader workers reopen the memory maps instead of receiving a copy of the arrays
+        return {"path": self.path, "mmap": self.mmap} if self.mmap else self.__dict__
+
+    def __setstate__(self, state: dict):
+        if "values" in state:
+            self.__dict__.update(state)
+        else:
+            self.__init__(state["path"], state["mmap"])
+
+    def __getitem__(self, idx: int) -> dict:
+        item = {}
+        for field in self.fields:
+            offsets = self.offsets[field]
+            values = torch.from_numpy(self.values[field][offsets[idx]:offsets[idx + 1]])
+            if len(field) > 1:
+                item.setdefault(field[0], {})[field[1]] = values
+            else:
+                item[field[0]] = values
+        return item
+
+
+def collate_fn(batch: list[dict]) -> dict:
+    """
+    Concatenates the tensors of the same keys across the samples, nested dicts are collated recursively
+    and other values gathered into lists. Integer tensors are returned as int64, as embedding layers expect.
+    """
+    if isinstance(batch[0], dict):
+        return {key: collate_fn([item[key] for item in batch]) for key in batch[0]}
+    if isinstance(batch[0], torch.Tensor):
+        result = torch.cat(batch, dim=0)
+        return result.long() if not result.is_floating_point() and result.dtype != torch.bool else result
+    return batch
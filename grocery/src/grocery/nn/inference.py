@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from grocery.nn.dataset import JaggedDataset, collate_fn
+from grocery.nn.sampler import TokenBudgetBatchSampler
+from grocery.recommender.primitives import EmbeddingTable
+from grocery.utils.io import write_json
+
+
+def _eval(tower: Callable) -> Callable:
+    if isinstance(tower, torch.nn.Module):
+        tower.eval()
+    return tower
+
+
+def _encode(tower: Callable, inputs) -> np.ndarray:
+    with torch.inference_mode():
+        return tower(inputs).float().cpu().numpy()
+
+
+def _fingerprint(dataset: JaggedDataset, user_ids: np.ndarray) -> str:
+    # the offsets change with any row length, cheaper than hashing all the values
+    digest = hashlib.sha256(user_ids.tobytes())
+    for field in dataset.fields:
+        digest.update(repr(field).encode())
+        digest.update(np.ascontiguousarray(dataset.offsets[field]).tobytes())
+    return digest.hexdigest()
+
+
+def _finish(path: Path, ids: np.ndarray) -> EmbeddingTable:
+    # ids.npy is written last, a directory with it holds a complete table
+    np.save(path / "ids.tmp.npy", ids)
+    os.replace(path / "ids.tmp.npy", path / "ids.npy")
+    (path / "progress.json").unlink(missing_ok=True)
+    return EmbeddingTable.load(str(path))
+
+
+def export_item_embeddings(item_tower: Callable[[torch.Tensor], torch.Tensor],
+                           item_ids: np.ndarray,
+                           path: str,
+                           batch_size: int = 65536,
+                           ) -> EmbeddingTable:
+    """
+    Encodes the whole item vocabulary once into an `EmbeddingTable` directory.
+    Args:
+        item_tower (Callable[[torch.Tensor], torch.Tensor]): maps int64 item ids to (n, dim) embeddings
+        item_ids (np.ndarray): unique item ids, encoded in sorted order
+        path (str): output directory
+        batch_size (int): number of items per forward pass
+    Returns:
+        EmbeddingTable: memory-mapped table of the written files
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    item_tower = _eval(item_tower)
+    item_ids = np.unique(np.asarray(item_ids, dtype=np.int64))
+    vectors = None
+    for start in range(0, len(item_ids), batch_size):
+        embeddings = _encode(item_tower, torch.from_numpy(item_ids[start:start + batch_size]))
+        if vectors is None:
+            vectors = np.lib.format.open_memmap(path / "vectors.npy", mode="w+", dtype=np.float32,
+                                                shape=(len(item_ids), embeddings.shape[1]))
+        vectors[start:start + len(embeddings)] = embeddings
+    if vectors is not None:
+        vectors.flush()
+        del vectors
+    return _finish(path, item_ids)
+
+
+def export_user_embeddings(user_tower: Callable[[dict], torch.Tensor],
+                           dataset: JaggedDataset,
+                           user_ids: np.ndarray,
+                           path: str,
+                           max_tokens: int = 65536,
+                           chunk_size: int = 65536,
+                           num_workers: int = 1,
+                           num_threads: int | None = None,
+                           resume: bool = True,
+                           version: str | None = None,
+                           ) -> EmbeddingTable:
+    """
+    Restartable bulk inference of the user tower over the histories of a `JaggedDataset`, written into
+    a float32 `EmbeddingTable` directory. Rows are processed in chunks of `chunk_size`, inside a chunk
+    in batches of similar length of up to `max_tokens` padded history tokens; the embeddings go straight
+    into the memory-mapped `vectors.npy` and the progress is saved after every chunk, so memory stays
+    bounded by a chunk and an interrupted job continues from the last finished chunk.
+    Args:
+        user_tower (Callable[[dict], torch.Tensor]): maps a `collate_fn` batch to (batch_size, dim) embeddings
+        dataset (JaggedDataset): one row per user with a `history` struct, see `build_histories`
+        user_ids (np.ndarray): increasing user ids of the dataset rows
+        path (str): output directory
+        max_tokens (int): token budget of a batch, see `TokenBudgetBatchSampler`
+        chunk_size (int): number of rows between checkpoints
+        num_workers (int): number of batches encoded concurrently in a thread pool
+        num_threads (int | None): torch intra-op threads, unchanged by default
+        resume (bool): continue an interrupted job in `path`; the job has to use the same dataset, user ids,
+        chunk size, `version` and embedding dim, otherwise a ValueError is raised
+        version (str | None): identifies the tower weights, e.g. a checkpoint name, a job resumed with another
+        version is rejected instead of mixing the embeddings of two models
+    Returns:
+        EmbeddingTable: memory-mapped table of the written files
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    user_ids = np.asarray(user_ids, dtype=np.int64)
+    if len(user_ids) != len(dataset):
+        raise ValueError(f"got {len(user_ids)} user_ids for {len(dataset)} dataset rows")
+    if not (user_ids[1:] > user_ids[:-1]).all():
+        raise ValueError("user_ids have to be increasing")
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    user_tower = _eval(user_tower)
+    lengths = dataset.row_lengths()
+    progress_path = path / "progress.json"
+    config = {"num_rows": len(dataset), "chunk_size": chunk_size, "version": version,
+              "dataset": _fingerprint(dataset, user_ids)}
+    done, vectors = 0, None
+    if resume and progress_path.exists():
+        progress = json.loads(progress_path.read_text())
+        if progress["config"] != config:
+            raise ValueError(f"progress in {path} was written with {progress['config']}, not {config}")
+        done = progress["done"]
+        vectors = np.load(path / "vectors.npy", mmap_mode="r+")
+    (path / "ids.npy").unlink(missing_ok=True)
+
+    def encode(rows: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        return rows, _encode(user_tower, collate_fn([dataset[row] for row in rows]))
+
+    with ThreadPoolExecutor(num_workers) as pool, tqdm(total=len(dataset), initial=done) as progress_bar:
+        for start in range(done, len(dataset), chunk_size):
+            stop = min(start + chunk_size, len(dataset))
+            sampler = TokenBudgetBatchSampler(lengths[start:stop], max_tokens, bucket_size=stop - start, shuffle=False)
+            for rows, embeddings in pool.map(encode, (start + batch for batch in sampler.batches())):
+                if vectors is None:
+                    vectors = np.lib.format.open_memmap(path / "vectors.npy", mode="w+", dtype=np.float32,
+                                                        shape=(len(dataset), embeddings.shape[1]))
+                elif embeddings.shape[1] != vectors.shape[1]:
+                    raise ValueError(f"the tower returns {embeddings.shape[1]}-dim embeddings, "
+                                     f"{path / 'vectors.npy'} holds {vectors.shape[1]}-dim ones")
+                vectors[rows] = embeddings
+            vectors.flush()
+            write_json(progress_path, {"done": stop, "config": config})
+            progress_bar.update(stop - start)
+    if vectors is None:
+        vectors = np.lib.format.open_memmap(path / "vectors.npy", mode="w+", dtype=np.float32, shape=(0, 0))
+    del vectors
+    return _finish(path, user_ids)
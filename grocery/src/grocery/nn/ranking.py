@@ -0,0 +1,127 @@
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+
+def make_groups(lengths: torch.Tensor) -> torch.Tensor:
+    """
+    Group index of every element of consecutive groups, e.g. [2, 3, 1] -> [0, 0, 1, 1, 1, 2].
+    """
+    return torch.repeat_interleave(torch.arange(len(lengths), device=lengths.device), lengths)
+
+
+def make_pairs(lengths: torch.Tensor) -> torch.Tensor:
+    """
+    All the lengths ** 2 ordered pairs inside every group as a (2, num_pairs) tensor of global indices.
+    Quadratic in memory, `make_ranked_pairs` builds only the pairs a pairwise loss uses.
+    """
+    num_pairs_per_group = lengths ** 2
+    group_idx = make_groups(num_pairs_per_group)
+    pair_offsets = torch.cumsum(num_pairs_per_group, dim=0) - num_pairs_per_group
+    local_pair_idx = torch.arange(int(num_pairs_per_group.sum()), device=lengths.device) - pair_offsets[group_idx]
+    offsets = (torch.cumsum(lengths, dim=0) - lengths)[group_idx]
+    return torch.stack([local_pair_idx // lengths[group_idx] + offsets, local_pair_idx % lengths[group_idx] + offsets])
+
+
+def _sort_within_groups(groups: torch.Tensor, values: torch.Tensor) -> torch.Tensor:
+    # descending by value inside a group, ties broken by the larger index first
+    order = torch.arange(len(values) - 1, -1, -1, device=values.device)
+    order = order[torch.sort(values[order], descending=True, stable=True).indices]
+    return order[torch.sort(groups[order], stable=True).indices]
+
+
+def make_ranked_pairs(targets: torch.Tensor,
+                      lengths: torch.Tensor,
+                      max_pairs_per_group: int | None = None,
+                      generator: torch.Generator | None = None,
+                      ) -> torch.Tensor:
+    """
+    Pairs (i, j) of the same group with `targets[i] > targets[j]`, built without enumerating all the pairs:
+    sorted by target inside a group, the partners of an element are a contiguous tail of the group,
+    so a pair number decodes into (i, j) with one `searchsorted`.
+    Args:
+        targets (torch.Tensor): relevance of every element
+        lengths (torch.Tensor): sizes of consecutive groups
+        max_pairs_per_group (int | None): groups with more pairs get this many pairs sampled uniformly
+        with replacement
+        generator (torch.Generator | None): random generator of the sampling
+    Returns:
+        torch.Tensor: (2, num_pairs) global indices, the more relevant element first
+    """
+    device = targets.device
+    groups = make_groups(lengths)
+    order = _sort_within_groups(groups, targets)
+    sorted_groups, sorted_targets = groups[order], targets[order]
+    # end of the run of equal targets of every element, its partners are [run_end, group_end)
+    is_last = torch.ones(len(order), dtype=torch.bool, device=device)
+    is_last[:-1] = (sorted_groups[1:] != sorted_groups[:-1]) | (sorted_targets[1:] != sorted_targets[:-1])
+    run_ends = torch.nonzero(is_last).squeeze(1) + 1
+    run_end = run_ends[torch.cumsum(is_last, dim=0) - is_last.long()]
+    group_end = torch.cumsum(lengths, dim=0)[sorted_groups]
+    counts = group_end - run_end
+    pair_ends = torch.cumsum(counts, dim=0)
+    group_pairs = torch.zeros(len(lengths), dtype=pair_ends.dtype, device=device).index_add_(0, sorted_groups, counts)
+    group_offsets = torch.cumsum(group_pairs, dim=0) - group_pairs
+    if max_pairs_per_group is None:
+        pair_ids = torch.arange(int(pair_ends[-1]) if len(pair_ends) else 0, device=device)
+    else:
+        num_samples = torch.clamp(group_pairs, max=max_pairs_per_group)
+        sample_groups = make_groups(num_samples)
+        local = torch.arange(int(num_samples.sum()), device=device) - (torch.cumsum(num_samples, dim=0) - num_samples)[sample_groups]
+        sampled = (torch.rand(len(local), generator=generator, device=device) * group_pairs[sample_groups]).long()
+        capped = group_pairs[sample_groups] > max_pairs_per_group
+        pair_ids = group_offsets[sample_groups] + torch.where(capped, torch.minimum(sampled, group_pairs[sample_groups] - 1), local)
+    first = torch.searchsorted(pair_ends, pair_ids, right=True)
+    second = run_end[first] + pair_ids - (pair_ends - counts)[first]
+    return torch.stack([order[first], order[second]])
+
+
+class CalibratedPairwiseLogistic(nn.Module):
+    def __init__(self, max_pairs_per_group: int | None = None, generator: torch.Generator | None = None):
+        """
+        Pairwise logistic loss that keeps the logits calibrated as probabilities: for a pair with a more
+        relevant first element it is -log sigmoid(l_i) + log(sigmoid(l_i) + sigmoid(l_j)).
+        Args:
+            max_pairs_per_group (int | None): cap on the pairs of a group, see `make_ranked_pairs`
+            generator (torch.Generator | None): random generator of the pair sampling
+        """
+        super().__init__()
+        self.max_pairs_per_group = max_pairs_per_group
+        self.generator = generator
+
+    def forward(self, logits: torch.Tensor, targets: torch.Tensor, lengths: torch.Tensor) -> torch.Tensor:
+        max_pairs_per_group = self.max_pairs_per_group if self.training else None
+        pairs = make_ranked_pairs(targets, lengths, max_pairs_per_group, self.generator)
+        if pairs.shape[1] == 0:
+            return logits.new_tensor(0.0)
+        ci, cj = logits[pairs[0]], logits[pairs[1]]
+        loss = F.softplus(-ci) + torch.logaddexp(-F.softplus(-ci), -F.softplus(-cj))
+        return torch.mean(loss)
+
+
+def segmented_ndcg(scores: torch.Tensor, targets: torch.Tensor, lengths: torch.Tensor, k: int = 10) -> torch.Tensor:
+    """
+    NDCG@k of every group of consecutive elements in one pass. When the scores of a group are distinct
+    it equals `sklearn.metrics.ndcg_score(targets[None], scores[None], k=k, ignore_ties=True)`; tied
+    scores are ranked by the larger index first, so the result can differ from sklearn on ties.
+    Groups without relevant elements score 0.
+    Args:
+        scores (torch.Tensor): predicted scores
+        targets (torch.Tensor): non-negative relevance
+        lengths (torch.Tensor): sizes of consecutive groups
+        k (int): cutoff
+    Returns:
+        torch.Tensor: float64 NDCG per group, e.g. `segmented_ndcg(...)[lengths > 1].mean()`
+    """
+    groups = make_groups(lengths)
+    starts = (torch.cumsum(lengths, dim=0) - lengths)[groups]
+    ranks = torch.arange(len(groups), device=groups.device) - starts
+    discounts = torch.where(ranks < k, 1 / torch.log2(ranks.double() + 2), torch.zeros((), dtype=torch.float64, device=groups.device))
+    gains = targets.double()
+
+    def dcg(order: torch.Tensor) -> torch.Tensor:
+        result = torch.zeros(len(lengths), dtype=torch.float64, device=groups.device)
+        return result.index_add_(0, groups, gains[order] * discounts)
+
+    actual, ideal = dcg(_sort_within_groups(groups, scores)), dcg(_sort_within_groups(groups, targets))
+    return torch.where(ideal > 0, actual / torch.where(ideal > 0, ideal, 1), 0)
@@ -0,0 +1,93 @@
+import numpy as np
+from torch.utils.data import Sampler
+
+
+class TokenBudgetBatchSampler(Sampler[list[int]]):
+    def __init__(self,
+                 lengths: np.ndarray,
+                 max_tokens: int,
+                 bucket_size: int = 4096,
+                 padded: bool = True,
+                 max_batch_size: int | None = None,
+                 shuffle: bool = True,
+                 seed: int = 0,
+                 ):
+        """
+        Batches of samples of similar length whose token count stays under `max_tokens`. Every epoch the
+        samples are shuffled, split into buckets of `bucket_size` samples, sorted by length inside a bucket
+        and cut greedily into batches; the batch order is shuffled too. Use as
+        `DataLoader(dataset, batch_sampler=TokenBudgetBatchSampler(dataset.row_lengths(), max_tokens), ...)`.
+        Args:
+            lengths (np.ndarray): token count of every sample, e.g. history plus candidate lengths
+            max_tokens (int): token budget of a batch, a longer sample gets a batch of its own
+            bucket_size (int): number of samples sorted together, larger buckets waste less padding
+            but batches of similar length repeat more often across epochs
+            padded (bool): count batch_size * max_length tokens as a padded model does, the sum of the
+            lengths otherwise
+            max_batch_size (int | None): maximal number of samples in a batch
+            shuffle (bool): randomise the buckets and the batch order, a new order every epoch
+            seed (int): base seed, the order of epoch e is seeded with (seed, e)
+        """
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.max_tokens = max_tokens
+        self.bucket_size = bucket_size
+        self.padded = padded
+        self.max_batch_size = max_batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self._batches = None
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+        self._batches = None
+
+    def _split(self, order: np.ndarray) -> list[np.ndarray]:
+        lengths = self.lengths[order]
+        cumsum = np.concatenate([[0], np.cumsum(lengths)])
+
+        def tokens(start: int, stop: int) -> int:
+            if self.padded:
+                # lengths are ascending inside a bucket, so the padded size of order[start:stop] is (stop - start) * lengths[stop - 1]
+                return (stop - start) * lengths[stop - 1]
+            return cumsum[stop] - cumsum[start]
+
+        batches, start = [], 0
+        max_size = self.max_batch_size or len(order)
+        while start < len(order):
+            # binary search for the largest batch under the budget, token counts grow with the batch end
+            low, high = start + 1, min(start + max_size, len(order))
+            while low < high:
+                middle = (low + high + 1) // 2
+                if tokens(start, middle) <= self.max_tokens:
+                    low = middle
+                else:
+                    high = middle - 1
+            batches.append(order[start:low])
+            start = low
+        return batches
+
+    def batches(self) -> list[np.ndarray]:
+        """
+        Batches of the current epoch.
+        """
+        if self._batches is None:
+            rng = np.random.default_rng((self.seed, self.epoch))
+            order = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+            batches = []
+            for start in range(0, len(order), self.bucket_size):
+                bucket = order[start:start + self.bucket_size]
+                batches.extend(self._split(bucket[np.argsort(self.lengths[bucket], kind="stable")]))
+            if self.shuffle:
+                batches = [batches[i] for i in rng.permutation(len(batches))]
+            self._batches = batches
+        return self._batches
+
+    def __len__(self) -> int:
+        return len(self.batches())
+
+    def __iter__(self):
+        batches = self.batches()
+        self.set_epoch(self.epoch + 1)
+        for batch in batches:
+            yield batch.tolist()
@@ -1,13 +1,22 @@
-from grocery.recommender.candidates import DotProductKNN, CandidateGenerator
-from grocery.recommender.recommender import BaseRecommender
+from grocery.recommender.candidates import DotProductKNN, HNSWCandidateGenerator, CandidateGenerator
+from grocery.recommender.recommender import BaseRecommender, PipelineRecommender
 from grocery.recommender.features import FeatureStorage, FeatureExtractor, StaticFeatureExtractor, FeatureManager
-from grocery.recommender.reranking import Ranker, GroceryCatboostRanker, SoftmaxSampler
+from grocery.recommender.reranking import Ranker, GroceryCatboostRanker, SoftmaxSampler, RankingPipeline
+from grocery.recommender.primitives import Candidate, CandidateBatch, EmbeddingTable
+from grocery.recommender.serving import BatchingRecommender, BatchingStats
 
 
 __all__ = [
+    "Candidate",
+    "CandidateBatch",
+    "EmbeddingTable",
     "BaseRecommender",
+    "PipelineRecommender",
+    "BatchingRecommender",
+    "BatchingStats",
     "CandidateGenerator",
     "DotProductKNN",
+    "HNSWCandidateGenerator",
     "FeatureStorage",
     "FeatureExtractor",
     "StaticFeatureExtractor",
@@ -15,4 +24,5 @@ __all__ = [
     "Ranker",
     "GroceryCatboostRanker",
     "SoftmaxSampler",
+    "RankingPipeline",
 ]
\ No newline at end of file
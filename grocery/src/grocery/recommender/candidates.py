@@ -1,11 +1,159 @@
+import json
+import mmap
+import os
+import tempfile
 from abc import abstractmethod
 
 import numpy as np
+from voyager import Index, Space
 
-from grocery.recommender.primitives import Candidate, Embedding
+from grocery.recommender.primitives import Candidate, CandidateBatch, Embedding, EmbeddingTable, as_embedding_table
+
+
+# upper bound for the (queries x items) score block materialised at once
+SCORES_BUFFER_BYTES = 64 * 1024 * 1024
+
+
+class QuantizedMatrix:
+    def __init__(self, matrix: np.ndarray, dtype: str = "int8", scale_mode: str = "row", chunk_rows: int = 4096):
+        """
+        Compressed item matrix for brute-force scoring. Rows are decoded to float32 in chunks of
+        `chunk_rows` into one reused buffer that stays in cache while it is scored, so neither the
+        full float32 matrix nor a fresh float32 copy of every chunk is ever allocated.
+        Args:
+            matrix (np.ndarray): item matrix of shape (n_items, dim)
+            dtype (str): storage type, "float16" or "int8"
+            scale_mode (str): int8 scales, "row" for one per item or "dim" for one per dimension
+            chunk_rows (int): number of rows decoded at once
+        """
+        assert dtype in ["float16", "int8"]
+        assert scale_mode in ["row", "dim"]
+        self.dtype = dtype
+        self.scale_mode = scale_mode
+        self.chunk_rows = chunk_rows
+        self.scales = None
+        if dtype == "float16":
+            self.data = matrix.astype(np.float16)
+        else:
+            axis = 1 if scale_mode == "row" else 0
+            scales = np.abs(matrix).max(axis=axis).astype(np.float32) / 127
+            scales[scales == 0] = 1
+            scales_shape = (-1, 1) if scale_mode == "row" else (1, -1)
+            self.data = np.round(matrix / scales.reshape(scales_shape)).astype(np.int8)
+            self.scales = scales
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    @property
+    def nbytes(self) -> int:
+        return self.data.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def score(self, queries: np.ndarray) -> np.ndarray:
+        queries = queries.astype(np.float32, copy=False)
+        row_scales = self.scales if self.scale_mode == "row" else None
+        if self.scales is not None and self.scale_mode == "dim":
+            queries = queries * self.scales
+        scores = np.empty((len(queries), len(self.data)), dtype=np.float32)
+        buffer = np.empty((min(self.chunk_rows, len(self.data)), self.data.shape[1]), dtype=np.float32)
+        # row scales go into the decoded rows or into the scores, whichever is smaller
+        scale_rows = row_scales is not None and len(queries) > self.data.shape[1]
+        for start in range(0, len(self.data), self.chunk_rows):
+            rows = self.data[start:start + self.chunk_rows]
+            chunk, block = buffer[:len(rows)], scores[:, start:start + len(rows)]
+            if self.dtype == "float16":
+                _decode_float16(rows, chunk)
+            elif scale_rows:
+                np.multiply(rows, row_scales[start:start + len(rows), None], out=chunk)
+            else:
+                np.copyto(chunk, rows)
+            np.matmul(queries, chunk.T, out=block)
+            if row_scales is not None and not scale_rows:
+                block *= row_scales[start:start + len(rows)]
+        return scores
+
+
+def _decode_float16(rows: np.ndarray, out: np.ndarray):
+    # bit-level float16 -> float32 for finite values, several times faster than `astype`:
+    # the sign-extended bits shifted into float32 position, the copies of the sign cleared from
+    # the exponent, and the exponent bias corrected by a multiplication, which also handles subnormals
+    bits = out.view(np.int32)
+    np.copyto(bits, rows.view(np.int16))
+    bits <<= 13
+    bits &= np.int32(-0x70000001)
+    out *= np.float32(2.0 ** 112)
+
+
+def _on_disk(matrix: np.ndarray) -> np.ndarray:
+    """
+    The matrix itself when it is memory-mapped already, otherwise a copy in an anonymous
+    temporary file, removed by the system together with the last reference to it.
+    """
+    base = matrix
+    while base is not None:
+        if isinstance(base, (np.memmap, mmap.mmap)):
+            return matrix
+        base = getattr(base, "base", None)
+    if not matrix.size:
+        return matrix
+    copy = np.memmap(tempfile.TemporaryFile(), dtype=matrix.dtype, mode="w+", shape=matrix.shape)
+    copy[:] = matrix
+    copy.flush()
+    return copy
+
+
+def _score(queries: np.ndarray, matrix: np.ndarray | QuantizedMatrix) -> np.ndarray:
+    if isinstance(matrix, QuantizedMatrix):
+        return matrix.score(queries)
+    return queries @ matrix.T
+
+
+def top_k(queries: np.ndarray,
+          matrix: np.ndarray | QuantizedMatrix,
+          k: int,
+          exclude: np.ndarray | None = None,
+          buffer_bytes: int = SCORES_BUFFER_BYTES,
+          ) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Top-k inner product search, processed in query blocks so that the score buffer
+    never exceeds `buffer_bytes`. Ordering inside the top k is exact w.r.t. the scores.
+    Args:
+        queries (np.ndarray): query matrix of shape (n_queries, dim)
+        matrix (np.ndarray | QuantizedMatrix): item matrix of shape (n_items, dim)
+        k (int): number of items to return per query, clipped to n_items
+        exclude (np.ndarray | None): per-query item row to skip, -1 means nothing to skip
+        buffer_bytes (int): memory budget for one block of scores
+    Returns:
+        tuple[np.ndarray, np.ndarray]: item rows and scores of shape (n_queries, k),
+        ordered by descending score
+    """
+    n_queries, n_items = len(queries), len(matrix)
+    k = min(k, n_items)
+    indices = np.empty((n_queries, k), dtype=np.int64)
+    scores = np.empty((n_queries, k), dtype=np.float32)
+    if k == 0:
+        return indices, scores
+    step = max(1, buffer_bytes // (4 * n_items))
+    for start in range(0, n_queries, step):
+        stop = min(start + step, n_queries)
+        block = _score(queries[start:stop], matrix)
+        if exclude is not None:
+            rows = np.flatnonzero(exclude[start:stop] >= 0)
+            block[rows, exclude[start:stop][rows]] = -np.inf
+        if k < n_items:
+            part = np.argpartition(block, n_items - k, axis=1)[:, n_items - k:]
+        else:
+            part = np.broadcast_to(np.arange(n_items), block.shape)
+        part_scores = np.take_along_axis(block, part, axis=1)
+        order = np.argsort(-part_scores, axis=1, kind="stable")
+        indices[start:stop] = np.take_along_axis(part, order, axis=1)
+        scores[start:stop] = np.take_along_axis(part_scores, order, axis=1)
+    return indices, scores
 
 
 class CandidateGenerator:
+    score_feature_name = "retrieval_score"
+
     @abstractmethod
     def __init__(self):
         pass
@@ -14,43 +162,237 @@ class CandidateGenerator:
     def extract_candidates(self, object_id: int, n: int = 10) -> list[Candidate]:
         pass
 
+    def batch_extract_candidates(self, object_ids: list[int], n: int = 10) -> list[list[Candidate]]:
+        return [self.extract_candidates(object_id, n) for object_id in object_ids]
+
+    def extract_candidate_batch(self, object_ids: list[int], n: int = 10) -> CandidateBatch:
+        return CandidateBatch.from_candidates(self.batch_extract_candidates(object_ids, n), object_ids=object_ids)
+
 
 class DotProductKNN(CandidateGenerator):
     def __init__(self,
-                 left_embeddings: dict[int, Embedding],
-                 right_embeddings: dict[int, Embedding],
+                 left_embeddings: EmbeddingTable | dict[int, Embedding],
+                 right_embeddings: EmbeddingTable | dict[int, Embedding],
+                 remove_self: bool | None = None,
+                 buffer_bytes: int = SCORES_BUFFER_BYTES,
+                 storage: str = "float32",
+                 scale_mode: str = "row",
+                 rescore: int = 0,
                  ):
+        """
+        Brute-force inner product retrieval over the right-hand embeddings.
+        Args:
+            left_embeddings (EmbeddingTable | dict[int, Embedding]): query embeddings by object id
+            right_embeddings (EmbeddingTable | dict[int, Embedding]): item embeddings by item id,
+            the float32 matrix of a table is used without copying
+            remove_self (bool | None): exclude the query id from its own results,
+            defaults to True when both sides are the same mapping
+            buffer_bytes (int): memory budget for one block of scores
+            storage (str): item matrix type, "float32", "float16" or "int8"
+            scale_mode (str): int8 scales, "row" or "dim", see `QuantizedMatrix`
+            rescore (int): for compressed storage, over-fetch `rescore * n` items and
+            re-rank them with exact float32 scores; 0 disables re-scoring. Only the ids and the
+            compressed matrix are retained in memory, the float32 rows for re-scoring are memory-mapped
+            (a temporary file unless they are mapped already) and only the shortlisted rows are read
+        """
         super().__init__()
-        self.left_embeddings = left_embeddings
-        self.right_embeddings = right_embeddings
-        self.matrix = []
-        self.right_id_map = {}
-        for idx, ID in enumerate(right_embeddings):
-            self.right_id_map[idx] = ID
-            self.matrix.append(right_embeddings[ID])
-        self.matrix = np.array(self.matrix)
-        self.remove_self = (left_embeddings == right_embeddings)
+        if remove_self is None:
+            remove_self = left_embeddings is right_embeddings
+        self.left_embeddings = as_embedding_table(left_embeddings)
+        right_embeddings = as_embedding_table(right_embeddings)
+        self.right_ids = right_embeddings.ids
+        matrix = right_embeddings.vectors
+        self.remove_self = remove_self
+        self.buffer_bytes = buffer_bytes
+        assert storage in ["float32", "float16", "int8"]
+        self.rescore = rescore if storage != "float32" else 0
+        self.exact_matrix = _on_disk(matrix) if self.rescore else None
+        self.matrix = matrix if storage == "float32" else QuantizedMatrix(matrix, storage, scale_mode)
 
-    def extract_candidates(self, object_id: int, n: int = 10) -> list[Candidate]:
-        query_embedding = self.left_embeddings[object_id]
-        distances = self.matrix @ query_embedding
-        sorted_indices = np.argsort(distances)[::-1]
-        top_n_candidates = [Candidate(id=self.right_id_map[idx]) for idx in sorted_indices[:n]]
-        if self.remove_self:
-            top_n_candidates = list(filter(lambda x: x.id != object_id, top_n_candidates))
-        return top_n_candidates
-    
-    def batch_extract_candidates(self, object_ids: list[int], n: int = 10) -> list[Candidate]:
-        query_embeddings = np.array([self.left_embeddings[oid] for oid in object_ids]).T
-        distances = (self.matrix @ query_embeddings).T
-        sorted_indices = np.argsort(distances, axis=1)[:, ::-1]
-        top_n_candidates = [
-            [Candidate(id=self.right_id_map[idx]) for idx in sorted_indices[i, :n]]
-            for i in range(len(object_ids))
-        ]
+    @property
+    def nbytes(self) -> int:
+        """
+        Bytes of the item side held in memory: ids and the scoring matrix. The memory-mapped
+        float32 rows for re-scoring are not counted.
+        """
+        return self.right_ids.nbytes + self.matrix.nbytes
+
+    def _query_matrix(self, object_ids: list[int]) -> np.ndarray:
+        return self.left_embeddings.lookup(object_ids)
+
+    def _right_rows(self, object_ids: np.ndarray) -> np.ndarray:
+        if not len(self.right_ids):
+            return np.full(object_ids.shape, -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.right_ids, object_ids), len(self.right_ids) - 1)
+        return np.where(self.right_ids[positions] == object_ids, positions, -1)
+
+    def batch_top_k(self, object_ids: list[int], n: int = 10) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Array-returning batch retrieval without building any `Candidate` objects.
+        Args:
+            object_ids (list[int]): query ids
+            n (int): number of items per query
+        Returns:
+            tuple[np.ndarray, np.ndarray]: item ids and scores of shape (n_queries, n),
+            ordered by descending score. The query itself is never among the results
+            when `remove_self` is set
+        """
+        queries = self._query_matrix(object_ids)
+        exclude = None
         if self.remove_self:
-            top_n_candidates = [
-                list(filter(lambda x: x.id != object_id, top_n_candidates))
-                for object_id in object_ids
-            ]
-        return top_n_candidates
+            exclude = self._right_rows(np.asarray(object_ids, dtype=np.int64))
+            n = min(n, len(self.right_ids) - 1)
+        if not self.rescore:
+            rows, scores = top_k(queries, self.matrix, n, exclude=exclude, buffer_bytes=self.buffer_bytes)
+            return self.right_ids[rows], scores
+        num_shortlisted = min(n * self.rescore, len(self.right_ids) - int(self.remove_self))
+        shortlist, _ = top_k(queries, self.matrix, num_shortlisted, exclude=exclude, buffer_bytes=self.buffer_bytes)
+        rows, scores = self._rescore(queries, shortlist, n)
+        return self.right_ids[rows], scores
+
+    def _rescore(self, queries: np.ndarray, shortlist: np.ndarray, n: int) -> tuple[np.ndarray, np.ndarray]:
+        rows = np.empty((len(queries), n), dtype=np.int64)
+        scores = np.empty((len(queries), n), dtype=np.float32)
+        step = max(1, self.buffer_bytes // max(1, self.exact_matrix.itemsize * shortlist.shape[1] * queries.shape[1]))
+        for start in range(0, len(queries), step):
+            block = shortlist[start:start + step]
+            exact_scores = np.einsum("qkd,qd->qk", self.exact_matrix[block], queries[start:start + step])
+            order = np.argsort(-exact_scores, axis=1, kind="stable")[:, :n]
+            rows[start:start + step] = np.take_along_axis(block, order, axis=1)
+            scores[start:start + step] = np.take_along_axis(exact_scores, order, axis=1)
+        return rows, scores
+
+    def extract_candidates(self, object_id: int, n: int = 10) -> list[Candidate]:
+        return self.batch_extract_candidates([object_id], n)[0]
+
+    def batch_extract_candidates(self, object_ids: list[int], n: int = 10) -> list[list[Candidate]]:
+        ids, _ = self.batch_top_k(object_ids, n)
+        return [[Candidate(id=item_id) for item_id in row] for row in ids.tolist()]
+
+    def extract_candidate_batch(self, object_ids: list[int], n: int = 10) -> CandidateBatch:
+        ids, scores = self.batch_top_k(object_ids, n)
+        return CandidateBatch.from_arrays(ids, object_ids=object_ids, columns={self.score_feature_name: scores})
+
+
+class HNSWCandidateGenerator(CandidateGenerator):
+    def __init__(self,
+                 left_embeddings: EmbeddingTable | dict[int, Embedding],
+                 right_embeddings: EmbeddingTable | dict[int, Embedding] | None = None,
+                 index: Index | None = None,
+                 M: int = 12,
+                 ef_construction: int = 200,
+                 ef: int = 100,
+                 num_threads: int = -1,
+                 remove_self: bool | None = None,
+                 random_seed: int = 1,
+                 ):
+        """
+        Approximate inner product retrieval over an HNSW graph built with voyager.
+        Item ids are used as index ids, so they have to be non-negative.
+        Args:
+            left_embeddings (EmbeddingTable | dict[int, Embedding]): query embeddings by object id
+            right_embeddings (EmbeddingTable | dict[int, Embedding] | None): item embeddings to build the index from
+            index (Index | None): prebuilt index, used instead of `right_embeddings`
+            M (int): number of graph links per element
+            ef_construction (int): search depth while building the index
+            ef (int): search depth at query time, trades recall for latency
+            num_threads (int): threads for building and batch queries, -1 for one per core
+            remove_self (bool | None): exclude the query id from its own results,
+            defaults to True when both sides are the same mapping
+            random_seed (int): seed of the graph construction
+        """
+        super().__init__()
+        if index is None and right_embeddings is None:
+            raise ValueError("either right_embeddings or index has to be provided")
+        self.ef = ef
+        self.num_threads = num_threads
+        if remove_self is None:
+            remove_self = left_embeddings is right_embeddings
+        self.remove_self = remove_self
+        self.left_embeddings = as_embedding_table(left_embeddings)
+        if index is None:
+            right_embeddings = as_embedding_table(right_embeddings)
+            right_ids, matrix = right_embeddings.ids, right_embeddings.vectors
+            if len(right_ids) and right_ids[0] < 0:
+                raise ValueError("HNSW index requires non-negative item ids")
+            index = Index(
+                Space.InnerProduct,
+                num_dimensions=matrix.shape[1],
+                M=M,
+                ef_construction=ef_construction,
+                random_seed=random_seed,
+                max_elements=len(right_ids),
+            )
+            index.add_items(matrix, ids=right_ids, num_threads=num_threads)
+        self.index = index
+
+    def save(self, path: str):
+        """
+        Writes the voyager index to `path` and the `remove_self` setting next to it, see `load`.
+        """
+        self.index.save(path)
+        with open(path + ".json", "w") as f:
+            json.dump({"remove_self": bool(self.remove_self)}, f)
+
+    @classmethod
+    def load(cls,
+             path: str,
+             left_embeddings: EmbeddingTable | dict[int, Embedding],
+             ef: int = 100,
+             num_threads: int = -1,
+             remove_self: bool | None = None,
+             ) -> "HNSWCandidateGenerator":
+        """
+        Opens an index written by `save`. `remove_self` defaults to the saved setting,
+        and to False for a bare voyager index file.
+        """
+        if remove_self is None:
+            remove_self = False
+            if os.path.exists(path + ".json"):
+                with open(path + ".json") as f:
+                    remove_self = json.load(f)["remove_self"]
+        return cls(
+            left_embeddings,
+            index=Index.load(path),
+            ef=ef,
+            num_threads=num_threads,
+            remove_self=remove_self,
+        )
+
+    def batch_top_k(self, object_ids: list[int], n: int = 10) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Array-returning batch retrieval, same contract as `DotProductKNN.batch_top_k`.
+        Args:
+            object_ids (list[int]): query ids
+            n (int): number of items per query
+        Returns:
+            tuple[np.ndarray, np.ndarray]: item ids and scores of shape (n_queries, n),
+            ordered by descending score
+        """
+        queries = self.left_embeddings.lookup(object_ids)
+        n_items = self.index.num_elements
+        n = min(n, n_items - 1) if self.remove_self else min(n, n_items)
+        k = min(n + 1, n_items) if self.remove_self else n
+        if n <= 0:
+            return np.empty((len(object_ids), 0), dtype=np.int64), np.empty((len(object_ids), 0), dtype=np.float32)
+        ids, distances = self.index.query(queries, k=k, num_threads=self.num_threads, query_ef=max(self.ef, k))
+        ids = ids.astype(np.int64)
+        # voyager reports inner product distance as 1 - <q, x>
+        scores = 1 - distances
+        if self.remove_self and k > n:
+            keep = ids != np.asarray(object_ids, dtype=np.int64)[:, None]
+            keep[keep.all(axis=1), -1] = False
+            ids = ids[keep].reshape(len(object_ids), n)
+            scores = scores[keep].reshape(len(object_ids), n)
+        return ids, scores
+
+    def extract_candidates(self, object_id: int, n: int = 10) -> list[Candidate]:
+        return self.batch_extract_candidates([object_id], n)[0]
+
+    def batch_extract_candidates(self, object_ids: list[int], n: int = 10) -> list[list[Candidate]]:
+        ids, _ = self.batch_top_k(object_ids, n)
+        return [[Candidate(id=item_id) for item_id in row] for row in ids.tolist()]
+
+    def extract_candidate_batch(self, object_ids: list[int], n: int = 10) -> CandidateBatch:
+        ids, scores = self.batch_top_k(object_ids, n)
+        return CandidateBatch.from_arrays(ids, object_ids=object_ids, columns={self.score_feature_name: scores})
@@ -1,41 +1,384 @@
+import json
+import os
+import pickle
 import joblib
 from abc import abstractmethod, ABC
 from typing import Iterator, Callable, TypeAlias
-from collections import defaultdict
 
-from grocery.recommender.primitives import Candidate, Feature
+import numpy as np
+
+from grocery.recommender.primitives import Candidate, CandidateBatch, EmbeddingTable, Feature
 
 
 FeatureStorageKey: TypeAlias = tuple[int, int] | int
 FeatureName: TypeAlias = str
 
+STORAGE_FORMAT = "grocery.feature_storage"
+MANAGER_FORMAT = "grocery.feature_manager"
+STORAGE_FORMAT_VERSION = 1
+
+# pair keys (left, right) are packed into one int64 as left << PAIR_KEY_BITS | right
+PAIR_KEY_BITS = 32
+
+
+def encode_keys(keys, pair: bool) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Packs storage keys into int64 codes.
+    Args:
+        keys: int keys as a sequence or array, or pair keys as a sequence of tuples,
+        an array of shape (n, 2) or a tuple of two arrays
+        pair (bool): whether the keys are (int, int) pairs
+    Returns:
+        tuple[np.ndarray, np.ndarray]: key codes and a mask of keys that can be encoded
+    """
+    if not pair:
+        codes = np.asarray(keys, dtype=np.int64)
+        if codes.ndim != 1 and codes.size:
+            raise ValueError(f"int keys must be one-dimensional, got shape {codes.shape}")
+        codes = codes.reshape(-1)
+        return codes, np.ones(len(codes), dtype=bool)
+    if isinstance(keys, tuple) and len(keys) == 2 and np.ndim(keys[0]) == 1:
+        left, right = keys
+        left = np.asarray(left, dtype=np.int64)
+        right = np.asarray(right, dtype=np.int64)
+    else:
+        pairs = np.asarray(keys, dtype=np.int64)
+        if (pairs.ndim != 2 or pairs.shape[1] != 2) and pairs.size:
+            raise ValueError(f"pair keys must have shape (n, 2), got {pairs.shape}")
+        pairs = pairs.reshape(-1, 2)
+        left, right = pairs[:, 0], pairs[:, 1]
+    left, right = np.broadcast_arrays(left, right)
+    valid = (left >= 0) & (left < 2 ** (63 - PAIR_KEY_BITS)) & (right >= 0) & (right < 2 ** PAIR_KEY_BITS)
+    codes = np.where(valid, (left << PAIR_KEY_BITS) | right, -1)
+    return codes, valid
+
+
+def _is_pair_key(key) -> bool:
+    return isinstance(key, tuple)
+
+
+def _keys_are_pairs(keys) -> bool:
+    if isinstance(keys, tuple) and len(keys) == 2 and np.ndim(keys[0]) == 1:
+        return True
+    if isinstance(keys, np.ndarray):
+        return keys.ndim == 2
+    return _is_pair_key(keys[0])
+
+
+def _num_keys(keys) -> int:
+    if isinstance(keys, tuple) and len(keys) == 2 and np.ndim(keys[0]) == 1:
+        return len(keys[0])
+    return len(keys)
+
 
 class FeatureStorage:
     def __init__(self):
-        self.fmap: defaultdict[int, dict[str, Feature]] = defaultdict(dict)
+        """
+        Columnar feature storage. Keys are kept as a sorted array of int64 codes (see `encode_keys`),
+        every feature is one typed column aligned with the keys plus a mask of keys that have a value.
+        Lookups return the feature default for keys without a value; a None default is NaN in numeric
+        columns, integer features with a None default are stored as float64.
+        Scalar features are stored as numeric or object (strings) columns, embeddings as 2D float32 columns.
+        """
+        self.keys: np.ndarray = np.empty(0, dtype=np.int64)
+        self.pair_keys: bool | None = None
+        self.columns: dict[str, np.ndarray] = {}
+        self.masks: dict[str, np.ndarray] = {}
         self.names: list[str] = []
         self.defaults: dict[str, Feature] = {}
 
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def lookup(self, keys) -> np.ndarray:
+        """
+        Returns row positions of the keys in the storage, -1 for unknown keys.
+        """
+        if self.pair_keys is None:
+            return np.full(_num_keys(keys), -1, dtype=np.int64)
+        codes, valid = encode_keys(keys, self.pair_keys)
+        if not len(self.keys):
+            return np.full(len(codes), -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.keys, codes), len(self.keys) - 1)
+        return np.where(valid & (self.keys[pos] == codes), pos, -1)
+
     def __getitem__(self, idx: FeatureStorageKey) -> dict[FeatureName, Feature]:
-        return self.fmap.get(idx, {})
-    
+        if self.pair_keys is None or _is_pair_key(idx) != self.pair_keys:
+            return {}
+        pos = self.lookup([idx])[0]
+        if pos < 0:
+            return {}
+        result = {}
+        for name in self.names:
+            if self.masks[name][pos]:
+                value = self.columns[name][pos]
+                result[name] = value.item() if isinstance(value, np.generic) else value
+        return result
+
+    @staticmethod
+    def _fill_column(column: np.ndarray, default: Feature):
+        if default is None:
+            if column.dtype == object:
+                column[:] = None
+            elif column.dtype.kind == "f":
+                column[:] = np.nan
+        elif column.dtype == object or np.ndim(default) == column.ndim - 1:
+            column[:] = default
+
+    @staticmethod
+    def _column_dtype(dtype: np.dtype, default: Feature) -> np.dtype:
+        # integers have no missing value, a None default needs NaN
+        if default is None and dtype.kind in "iub":
+            return np.dtype(np.float64)
+        return dtype
+
+    @classmethod
+    def _missing_value(cls, dtype: np.dtype, default: Feature, shape: tuple = ()) -> np.ndarray:
+        missing = np.zeros((1, *shape), dtype=dtype)
+        cls._fill_column(missing, default)
+        return missing[0]
+
+    def _extend_keys(self, codes: np.ndarray):
+        keys = np.union1d(self.keys, codes)
+        if len(keys) == len(self.keys):
+            return
+        pos = np.searchsorted(keys, self.keys)
+        for name in self.names:
+            column = self.columns[name]
+            extended = np.zeros((len(keys), *column.shape[1:]), dtype=column.dtype)
+            self._fill_column(extended, self.defaults[name])
+            extended[pos] = column
+            mask = np.zeros(len(keys), dtype=bool)
+            mask[pos] = self.masks[name]
+            self.columns[name] = extended
+            self.masks[name] = mask
+        self.keys = keys
+
+    @staticmethod
+    def _to_column(values, default: Feature) -> np.ndarray:
+        if isinstance(values, list) and values and isinstance(values[0], np.ndarray):
+            return np.stack(values).astype(np.float32, copy=False)
+        column = np.asarray(values) if len(values) else np.empty(0, dtype=np.float64)
+        if column.ndim > 1:
+            return column.astype(np.float32, copy=False)
+        if column.dtype.kind in "USO" or isinstance(default, str):
+            return column.astype(object)
+        if default is not None:
+            column = column.astype(np.result_type(column.dtype, np.min_scalar_type(default)), copy=False)
+        return column
+
     def add_feature(self, name: str, values: dict[int, Feature], default: Feature):
-        self.names.append(name)
-        for object_id, value in values.items():
-            self.fmap[object_id][name] = value
+        self.add_feature_array(name, list(values.keys()), list(values.values()), default)
+
+    def add_feature_array(self, name: str, keys, values, default: Feature):
+        """
+        Bulk version of `add_feature` taking aligned keys and values.
+        Args:
+            name (str): feature name, values of an existing feature are updated
+            keys: int keys or pair keys, see `encode_keys`
+            values: values as a sequence, a 1D array or a 2D array for embeddings
+            default (Feature): value for keys without the feature
+        """
+        if _num_keys(keys):
+            pair = _keys_are_pairs(keys)
+            if self.pair_keys is None:
+                self.pair_keys = pair
+            elif self.pair_keys != pair:
+                raise ValueError("FeatureStorage keys have to be either all ints or all (int, int) pairs")
+            codes, valid = encode_keys(keys, self.pair_keys)
+            if not valid.all():
+                raise ValueError(f"pair keys have to be non-negative and fit into {PAIR_KEY_BITS} bits")
+            self._extend_keys(codes)
+            pos = np.searchsorted(self.keys, codes)
+        else:
+            pos = np.empty(0, dtype=np.int64)
+        data = self._to_column(values, default)
+        data = data.astype(self._column_dtype(data.dtype, default), copy=False)
+        if name in self.columns:
+            column = self.columns[name]
+            if np.result_type(data, column) != column.dtype:
+                column = column.astype(np.result_type(data, column))
+            elif not column.flags.writeable:
+                column = column.copy()
+            if not self.masks[name].flags.writeable:
+                self.masks[name] = self.masks[name].copy()
+        else:
+            self.names.append(name)
+            column = np.zeros((len(self.keys), *data.shape[1:]), dtype=data.dtype)
+            self._fill_column(column, default)
+            self.masks[name] = np.zeros(len(self.keys), dtype=bool)
+        if len(pos):
+            column[pos] = data
+            self.masks[name][pos] = True
+        self.columns[name] = column
         self.defaults[name] = default
 
+    def add_embedding_table(self, name: str, table: EmbeddingTable, default: Feature | None = None):
+        """
+        Adds the table as an embedding feature keyed by its ids, zeros by default for missing keys.
+        An empty storage, or one with exactly the table's ids, takes the table arrays without copying.
+        """
+        if default is None:
+            default = np.zeros(table.dim, dtype=np.float32)
+        if not self.names or self.pair_keys is False and np.array_equal(self.keys, table.ids):
+            self.pair_keys = False
+            self.keys = table.ids
+            if name not in self.columns:
+                self.names.append(name)
+            self.columns[name] = table.vectors
+            self.masks[name] = np.ones(len(table.ids), dtype=bool)
+            self.defaults[name] = default
+            return
+        self.add_feature_array(name, table.ids, table.vectors, default)
+
     def get_feature_default(self, name):
         return self.defaults[name]
 
+    def _found(self, pos: np.ndarray, name: FeatureName) -> tuple[np.ndarray, np.ndarray]:
+        # positions of keys that have a value of the feature and a mask of such keys
+        found = pos >= 0
+        if not len(self.columns[name]):
+            return np.zeros(len(pos), dtype=np.int64), np.zeros(len(pos), dtype=bool)
+        safe_pos = np.where(found, pos, 0)
+        return safe_pos, found & self.masks[name][safe_pos]
+
+    def _gather(self, pos: np.ndarray, name: FeatureName) -> np.ndarray:
+        column, default = self.columns[name], self.defaults[name]
+        dtype = self._column_dtype(column.dtype, default)
+        safe_pos, found = self._found(pos, name)
+        if len(column):
+            result = column[safe_pos].astype(dtype, copy=False)
+        else:
+            result = np.empty((len(pos), *column.shape[1:]), dtype=dtype)
+        if not found.all():
+            result[~found] = self._missing_value(dtype, default, column.shape[1:])
+        return result
+
+    def get_column(self, keys, name: FeatureName) -> np.ndarray:
+        """
+        Gathers one feature for a batch of keys, unknown keys get the feature default.
+        Returns an array of shape (n_keys,) or (n_keys, dim) for embeddings.
+        """
+        return self._gather(self.lookup(keys), name)
+
+    def get_columns(self, keys, feature_names: list[FeatureName]) -> dict[FeatureName, np.ndarray]:
+        """
+        Same as `get_column` for several features, the keys are looked up once.
+        """
+        pos = self.lookup(keys)
+        return {name: self._gather(pos, name) for name in feature_names}
+
+    def get_batch(self, keys, feature_names: list[FeatureName]) -> np.ndarray:
+        """
+        Gathers scalar features for a batch of keys in one vectorized call.
+        Args:
+            keys: int keys or pair keys, see `encode_keys`
+            feature_names (list[FeatureName]): features to gather, in column order
+        Returns:
+            np.ndarray: matrix of shape (n_keys, n_features), missing values replaced with defaults.
+            The dtype is numeric when all the features are numeric and object otherwise
+        """
+        pos = self.lookup(keys)
+        columns = [self.columns[name] for name in feature_names]
+        if any(column.ndim > 1 for column in columns):
+            raise ValueError("get_batch supports scalar features only, use get_column for embeddings")
+        dtypes = [self._column_dtype(column.dtype, self.defaults[name]) for name, column in zip(feature_names, columns)]
+        dtype = np.result_type(*dtypes) if columns else np.float64
+        result = np.empty((len(pos), len(feature_names)), dtype=dtype)
+        for i, (name, column) in enumerate(zip(feature_names, columns)):
+            safe_pos, found = self._found(pos, name)
+            if len(column):
+                result[:, i] = column[safe_pos]
+            result[~found, i] = self._missing_value(dtype, self.defaults[name])
+        return result
+
+    def __setstate__(self, state: dict):
+        if "fmap" not in state:
+            self.__dict__.update(state)
+            return
+        # storages pickled before the columnar layout keep one dict of features per key
+        self.__init__()
+        for name in dict.fromkeys(state["names"]):
+            values = {key: features[name] for key, features in state["fmap"].items() if name in features}
+            self.add_feature(name, values, state["defaults"][name])
+
     def save(self, path: str):
-        with open(path, "wb") as f:
-            joblib.dump(self, f, compress=3)
+        """
+        Writes the storage as a directory with a json manifest and one .npy file per array,
+        see `load`. Object columns of strings and None are stored as category codes with -1 for None,
+        other object columns are pickled.
+        """
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "keys.npy"), self.keys)
+        features = []
+        for i, name in enumerate(self.names):
+            column, default = self.columns[name], self.defaults[name]
+            feature = {"name": name, "values": f"{i}.values.npy", "mask": f"{i}.mask.npy"}
+            if column.dtype == object:
+                is_none = np.fromiter((value is None for value in column), dtype=bool, count=len(column))
+                if all(isinstance(value, str) for value in column[~is_none]):
+                    categories, codes = np.unique(column[~is_none].astype(str), return_inverse=True)
+                    np.save(os.path.join(path, f"{i}.categories.npy"), categories)
+                    feature["categories"] = f"{i}.categories.npy"
+                    column = np.full(len(column), -1, dtype=np.int32)
+                    column[~is_none] = codes.reshape(-1)
+                else:
+                    feature["pickled"] = True
+            np.save(os.path.join(path, feature["values"]), column, allow_pickle=feature.get("pickled", False))
+            np.save(os.path.join(path, feature["mask"]), self.masks[name])
+            if isinstance(default, np.ndarray):
+                np.save(os.path.join(path, f"{i}.default.npy"), default)
+                feature["default_file"] = f"{i}.default.npy"
+            else:
+                feature["default"] = default.item() if isinstance(default, np.generic) else default
+            features.append(feature)
+        manifest = {
+            "format": STORAGE_FORMAT,
+            "version": STORAGE_FORMAT_VERSION,
+            "pair_keys": self.pair_keys,
+            "num_keys": len(self.keys),
+            "features": features,
+        }
+        with open(os.path.join(path, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=2)
 
-    @staticmethod
-    def load(path: str):
-        with open(path, "rb") as f:
-            return joblib.load(f)
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "FeatureStorage":
+        """
+        Opens a storage written by `save`. With `mmap` the numeric columns are memory-mapped read-only,
+        so loading is near-instant and processes on one host share the page cache.
+        Legacy joblib files are still accepted, see `convert_joblib_artifact`.
+        """
+        if not os.path.isdir(path):
+            with open(path, "rb") as f:
+                return joblib.load(f)
+        with open(os.path.join(path, "manifest.json")) as f:
+            manifest = json.load(f)
+        if manifest.get("format") != STORAGE_FORMAT or manifest.get("version") != STORAGE_FORMAT_VERSION:
+            raise ValueError(f"unsupported feature storage format in {path}")
+        mmap_mode = "r" if mmap else None
+        storage = cls()
+        storage.pair_keys = manifest["pair_keys"]
+        storage.keys = np.load(os.path.join(path, "keys.npy"), mmap_mode=mmap_mode)
+        for feature in manifest["features"]:
+            name = feature["name"]
+            if feature.get("pickled"):
+                column = np.load(os.path.join(path, feature["values"]), allow_pickle=True)
+            else:
+                column = np.load(os.path.join(path, feature["values"]), mmap_mode=mmap_mode)
+            if "categories" in feature:
+                # code -1 picks the trailing None
+                categories = np.load(os.path.join(path, feature["categories"])).astype(object)
+                column = np.append(categories, None)[column]
+            if "default_file" in feature:
+                default = np.load(os.path.join(path, feature["default_file"]))
+            else:
+                default = feature["default"]
+            storage.names.append(name)
+            storage.columns[name] = column
+            storage.masks[name] = np.load(os.path.join(path, feature["mask"]), mmap_mode=mmap_mode)
+            storage.defaults[name] = default
+        return storage
 
 
 class FeatureExtractor(ABC):
@@ -47,9 +390,24 @@ class FeatureExtractor(ABC):
     def __call__(self, object_id: int, candidate: Candidate) -> Feature:
         pass
 
+    def extract_batch(self, object_ids: np.ndarray, candidate_ids: np.ndarray) -> dict[FeatureName, np.ndarray]:
+        """
+        Extracts the features for aligned arrays of object and candidate ids as one column per feature.
+        The default implementation calls `key` and `__call__` per candidate, extractors override it
+        with a vectorized version.
+        """
+        rows = [self(self.key(object_id, candidate_id)) for object_id, candidate_id in zip(object_ids, candidate_ids)]
+        names = list(dict.fromkeys(name for row in rows for name in row))
+        return {name: FeatureStorage._to_column([row.get(name) for row in rows], None) for name in names}
+
 
 class StaticFeatureExtractor(FeatureExtractor):
     def __init__(self, features: list[str], storage: FeatureStorage, key: Callable[[int, int], tuple[int, int] | int]):
+        """
+        Looks the features up in the storage by `key(object_id, candidate_id)`.
+        For `extract_batch` the key function is called once with id arrays, so it should only
+        select or pair its arguments, e.g. `lambda u, i: i` or `lambda u, i: (u, i)`.
+        """
         super().__init__()
         self.key = key
         if isinstance(features, str):
@@ -66,23 +424,60 @@ class StaticFeatureExtractor(FeatureExtractor):
             result[feature_name] = features.get(feature_name, default)
         return result
 
+    def extract_batch(self, object_ids: np.ndarray, candidate_ids: np.ndarray) -> dict[FeatureName, np.ndarray]:
+        keys = self.key(object_ids, candidate_ids)
+        if isinstance(keys, tuple):
+            keys = tuple(np.broadcast_to(k, candidate_ids.shape) for k in keys)
+        else:
+            keys = np.broadcast_to(keys, candidate_ids.shape)
+        return self.storage.get_columns(keys, self.feature_names)
+
 
 class EmbeddingScoreExtractor(FeatureExtractor):
     def __init__(self,
-                 left_storage: FeatureStorage,
-                 right_storage: FeatureStorage,
+                 left_storage: FeatureStorage | EmbeddingTable,
+                 right_storage: FeatureStorage | EmbeddingTable,
                  embedding_keys: list[str]):
+        """
+        Inner products of the left and right embeddings under every key. An `EmbeddingTable`
+        is used without copying as the embedding of all the keys.
+        """
         super().__init__()
-        self.left_storage = left_storage
-        self.right_storage = right_storage
+        self.left_storage = self._as_storage(left_storage, embedding_keys)
+        self.right_storage = self._as_storage(right_storage, embedding_keys)
         self.embedding_keys = embedding_keys
 
+    @staticmethod
+    def _as_storage(storage: FeatureStorage | EmbeddingTable, embedding_keys: list[str]) -> FeatureStorage:
+        if isinstance(storage, FeatureStorage):
+            return storage
+        table, storage = storage, FeatureStorage()
+        for name in embedding_keys:
+            storage.add_embedding_table(name, table)
+        return storage
+
+    @staticmethod
+    def key(object_id: int, candidate_id: int) -> tuple[int, int]:
+        return object_id, candidate_id
+
     def __call__(self, key: tuple[int, int]) -> dict[str, Feature]:
         object_id, candidate_id = key
         user_embs = self.left_storage[object_id]
         item_embs = self.right_storage[candidate_id]
         return {k: user_embs[k] @ item_embs[k] for k in self.embedding_keys}
 
+    def extract_batch(self, object_ids: np.ndarray, candidate_ids: np.ndarray) -> dict[FeatureName, np.ndarray]:
+        unique_objects, inverse = np.unique(object_ids, return_inverse=True)
+        user_embs = self.left_storage.get_columns(unique_objects, self.embedding_keys)
+        item_embs = self.right_storage.get_columns(candidate_ids, self.embedding_keys)
+        result = {}
+        for k in self.embedding_keys:
+            if len(unique_objects) == 1:
+                result[k] = item_embs[k] @ user_embs[k][0]
+            else:
+                result[k] = np.einsum("nd,nd->n", item_embs[k], user_embs[k][inverse])
+        return result
+
 
 class FeatureManager:
     def __init__(self, extractors: list[FeatureExtractor]):
@@ -91,7 +486,22 @@ class FeatureManager:
     def add_extractor(self, extractor: FeatureExtractor):
         self.extractors.append(extractor)
 
-    def extract(self, object_id: int, candidates: Iterator[Candidate]) -> Iterator[Candidate]:
+    def extract(self,
+                object_id: int,
+                candidates: Iterator[Candidate] | CandidateBatch,
+                ) -> Iterator[Candidate] | CandidateBatch:
+        """
+        Adds the features to the candidates. A `CandidateBatch` is extracted in one vectorized pass
+        and returned with the feature columns added, for a batch with `object_ids` those override `object_id`.
+        Other iterables are extracted lazily candidate by candidate.
+        """
+        if isinstance(candidates, CandidateBatch):
+            object_ids = candidates.candidate_object_ids if candidates.object_ids is not None else object_id
+            candidates.columns |= self.extract_columns(object_ids, candidates.ids)
+            return candidates
+        return self._extract_candidates(object_id, candidates)
+
+    def _extract_candidates(self, object_id: int, candidates: Iterator[Candidate]) -> Iterator[Candidate]:
         for candidate in candidates:
             if candidate.features is None:
                 candidate.features = {}
@@ -99,12 +509,100 @@ class FeatureManager:
                 key = extractor.key(object_id, candidate.id)
                 candidate.features |= extractor(key)
             yield candidate
-    
+
+    def extract_columns(self, object_ids: int | np.ndarray, candidate_ids: np.ndarray) -> dict[FeatureName, np.ndarray]:
+        """
+        Runs every extractor's `extract_batch` once over the whole candidate list.
+        Args:
+            object_ids (int | np.ndarray): one object id for all the candidates or one per candidate
+            candidate_ids (np.ndarray): candidate ids
+        Returns:
+            dict[FeatureName, np.ndarray]: one column per feature, aligned with `candidate_ids`
+        """
+        candidate_ids = np.asarray(candidate_ids, dtype=np.int64)
+        object_ids = np.broadcast_to(np.asarray(object_ids, dtype=np.int64), candidate_ids.shape)
+        columns = {}
+        for extractor in self.extractors:
+            columns |= extractor.extract_batch(object_ids, candidate_ids)
+        return columns
+
+    def extract_batch(self, object_ids: int | np.ndarray, candidate_ids: np.ndarray) -> tuple[np.ndarray, list[FeatureName]]:
+        """
+        Batch counterpart of `extract` returning a feature matrix instead of filling `Candidate.features`.
+        Embedding-valued features are skipped, only scalar columns go to the matrix.
+        Args:
+            object_ids (int | np.ndarray): one object id for all the candidates or one per candidate
+            candidate_ids (np.ndarray): candidate ids
+        Returns:
+            tuple[np.ndarray, list[FeatureName]]: matrix of shape (n_candidates, n_features) and its column names,
+            the matrix is numeric unless some feature holds strings
+        """
+        columns = {name: column for name, column in self.extract_columns(object_ids, candidate_ids).items()
+                   if column.ndim == 1}
+        names = list(columns)
+        if not names:
+            return np.empty((len(candidate_ids), 0), dtype=np.float32), names
+        return np.column_stack([columns[name] for name in names]), names
+
     def save(self, path: str):
-        with open(path, "wb") as f:
-            joblib.dump(self, f, compress=3)
+        """
+        Writes the manager as a directory: every `FeatureStorage` referenced by the extractors goes to
+        `storages/<i>` in the memory-mappable format, the rest of the object graph is pickled
+        with references to those storages.
+        """
+        os.makedirs(os.path.join(path, "storages"), exist_ok=True)
+        storages: dict[int, int] = {}
+
+        def persistent_id(obj):
+            if not isinstance(obj, FeatureStorage):
+                return None
+            if id(obj) not in storages:
+                storages[id(obj)] = len(storages)
+                obj.save(os.path.join(path, "storages", str(storages[id(obj)])))
+            return ("feature_storage", storages[id(obj)])
+
+        with open(os.path.join(path, "manager.pkl"), "wb") as f:
+            pickler = pickle.Pickler(f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickler.persistent_id = persistent_id
+            pickler.dump(self)
+        manifest = {
+            "format": MANAGER_FORMAT,
+            "version": STORAGE_FORMAT_VERSION,
+            "num_storages": len(storages),
+        }
+        with open(os.path.join(path, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=2)
 
     @staticmethod
-    def load(path: str):
-        with open(path, "rb") as f:
-            return joblib.load(f)
+    def load(path: str, mmap: bool = True) -> "FeatureManager":
+        if not os.path.isdir(path):
+            with open(path, "rb") as f:
+                return joblib.load(f)
+        with open(os.path.join(path, "manifest.json")) as f:
+            manifest = json.load(f)
+        if manifest.get("format") != MANAGER_FORMAT or manifest.get("version") != STORAGE_FORMAT_VERSION:
+            raise ValueError(f"unsupported feature manager format in {path}")
+        storages: dict[int, FeatureStorage] = {}
+
+        def persistent_load(pid):
+            kind, idx = pid
+            assert kind == "feature_storage"
+            if idx not in storages:
+                storages[idx] = FeatureStorage.load(os.path.join(path, "storages", str(idx)), mmap=mmap)
+            return storages[idx]
+
+        with open(os.path.join(path, "manager.pkl"), "rb") as f:
+            unpickler = pickle.Unpickler(f)
+            unpickler.persistent_load = persistent_load
+            return unpickler.load()
+
+
+def convert_joblib_artifact(source: str, destination: str):
+    """
+    Converts a `FeatureStorage` or `FeatureManager` saved with joblib into the memory-mappable layout.
+    """
+    with open(source, "rb") as f:
+        artifact = joblib.load(f)
+    if not isinstance(artifact, (FeatureStorage, FeatureManager)):
+        raise TypeError(f"{source} holds {type(artifact).__name__}, expected FeatureStorage or FeatureManager")
+    artifact.save(destination)
@@ -1,4 +1,5 @@
-from dataclasses import dataclass
+import os
+from dataclasses import dataclass, field
 from typing import TypeAlias
 
 import numpy as np
@@ -14,4 +15,331 @@ class Candidate:
     features: dict[str, Feature] | None = None
 
 
-__all__ = ["Candidate", "Embedding", "Feature"]
+def grouped_top_n(scores: np.ndarray, offsets: np.ndarray, n: int, descending: bool = True) -> list[np.ndarray]:
+    """
+    Vectorized top-n selection inside every group of a flat score array.
+    Args:
+        scores (np.ndarray): scores of all the groups concatenated
+        offsets (np.ndarray): group boundaries of length n_groups + 1
+        n (int): number of items to keep per group
+        descending (bool): keep the largest scores if True, the smallest otherwise
+    Returns:
+        list[np.ndarray]: per group, positions in `scores` ordered by score, ties in input order
+    """
+    lengths = np.diff(offsets)
+    if not len(lengths):
+        return []
+    width = int(lengths.max())
+    n = min(n, width)
+    valid = np.arange(width) < lengths[:, None]
+    positions = np.where(valid, offsets[:-1, None] + np.arange(width), 0)
+    padded = scores[positions]
+    keys = np.where(valid, -padded if descending else padded, np.inf)
+    if n < width:
+        threshold = np.partition(keys, n - 1, axis=1)[:, n - 1:n]
+        below = keys < threshold
+        tied = keys == threshold
+        keep = below | (tied & (np.cumsum(tied, axis=1) <= n - below.sum(axis=1, keepdims=True)))
+        part = np.nonzero(keep)[1].reshape(len(keys), n)
+    else:
+        part = np.broadcast_to(np.arange(width), keys.shape)
+    order = np.argsort(np.take_along_axis(keys, part, axis=1), axis=1, kind="stable")
+    top = np.take_along_axis(part, order, axis=1)
+    top_positions = np.take_along_axis(positions, top, axis=1)
+    counts = np.minimum(lengths, n)
+    return [top_positions[i, :count] for i, count in enumerate(counts)]
+
+
+@dataclass
+class CandidateBatch:
+    """
+    Columnar candidates of one or several requests. Candidates of group `g` occupy
+    positions `offsets[g]:offsets[g + 1]` of `ids` and of every column.
+    Args:
+        ids (np.ndarray): candidate ids of all the groups concatenated
+        offsets (np.ndarray): group boundaries of length n_groups + 1
+        object_ids (np.ndarray | None): request object id of every group
+        columns (dict[str, np.ndarray]): named scores and features aligned with `ids`
+    """
+    ids: np.ndarray
+    offsets: np.ndarray
+    object_ids: np.ndarray | None = None
+    columns: dict[str, np.ndarray] = field(default_factory=dict)
+
+    def __post_init__(self):
+        self.ids = np.asarray(self.ids, dtype=np.int64)
+        self.offsets = np.asarray(self.offsets, dtype=np.int64)
+        if self.object_ids is not None:
+            self.object_ids = np.asarray(self.object_ids, dtype=np.int64)
+            assert len(self.object_ids) == self.num_groups
+        assert self.offsets[-1] == len(self.ids)
+
+    @classmethod
+    def from_arrays(cls,
+                    ids: np.ndarray,
+                    object_ids: np.ndarray | None = None,
+                    columns: dict[str, np.ndarray] | None = None,
+                    ) -> "CandidateBatch":
+        """
+        Builds a batch from a dense (n_groups, n) id matrix, e.g. the output of `batch_top_k`.
+        Columns have the same (n_groups, n) shape.
+        """
+        ids = np.asarray(ids)
+        n_groups, width = ids.shape
+        return cls(
+            ids=ids.reshape(-1),
+            offsets=np.arange(n_groups + 1) * width,
+            object_ids=object_ids,
+            columns={name: np.asarray(column).reshape(n_groups * width, *np.shape(column)[2:])
+                     for name, column in (columns or {}).items()},
+        )
+
+    @classmethod
+    def from_candidates(cls,
+                        candidates: list[Candidate] | list[list[Candidate]],
+                        object_ids: list[int] | None = None,
+                        ) -> "CandidateBatch":
+        """
+        Converts a list of candidates (one group) or a list of candidate lists (one group each).
+        When `object_ids` are given, there is one group per object id.
+        Features present in `Candidate.features` become columns, missing values are None.
+        """
+        if object_ids is not None and len(object_ids) != 1:
+            groups = candidates
+        elif candidates and isinstance(candidates[0], list):
+            groups = candidates
+        else:
+            groups = [candidates]
+        flat = [candidate for group in groups for candidate in group]
+        names = list(dict.fromkeys(name for c in flat if c.features for name in c.features))
+        columns = {}
+        for name in names:
+            values = [c.features.get(name) if c.features else None for c in flat]
+            column = np.asarray(values, dtype=object)
+            if all(isinstance(v, (int, float, np.number)) for v in values):
+                column = np.asarray(values, dtype=np.float64)
+            elif all(isinstance(v, np.ndarray) for v in values):
+                column = np.stack(values)
+            columns[name] = column
+        return cls(
+            ids=np.fromiter((c.id for c in flat), dtype=np.int64, count=len(flat)),
+            offsets=np.concatenate([[0], np.cumsum([len(group) for group in groups], dtype=np.int64)]),
+            object_ids=object_ids,
+            columns=columns,
+        )
+
+    @classmethod
+    def concat(cls, batches: list["CandidateBatch"]) -> "CandidateBatch":
+        names = list(batches[0].columns) if batches else []
+        lengths = np.concatenate([np.diff(batch.offsets) for batch in batches]) if batches else np.empty(0)
+        with_objects = batches and all(batch.object_ids is not None for batch in batches)
+        return cls(
+            ids=np.concatenate([batch.ids for batch in batches]) if batches else np.empty(0),
+            offsets=np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)]),
+            object_ids=np.concatenate([batch.object_ids for batch in batches]) if with_objects else None,
+            columns={name: np.concatenate([batch.columns[name] for batch in batches]) for name in names},
+        )
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.columns[name]
+
+    def __setitem__(self, name: str, values: np.ndarray):
+        values = np.asarray(values)
+        assert len(values) == len(self.ids)
+        self.columns[name] = values
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.columns
+
+    @property
+    def num_groups(self) -> int:
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    @property
+    def group_index(self) -> np.ndarray:
+        """
+        Group number of every candidate.
+        """
+        return np.repeat(np.arange(self.num_groups), self.lengths)
+
+    @property
+    def candidate_object_ids(self) -> np.ndarray:
+        """
+        Request object id of every candidate.
+        """
+        assert self.object_ids is not None
+        return np.repeat(self.object_ids, self.lengths)
+
+    def take(self, positions: np.ndarray, offsets: np.ndarray | None = None) -> "CandidateBatch":
+        """
+        Reorders or filters candidates by flat positions. Without new `offsets` the positions
+        have to be given group by group, keeping the group sizes.
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        return CandidateBatch(
+            ids=self.ids[positions],
+            offsets=self.offsets if offsets is None else offsets,
+            object_ids=self.object_ids,
+            columns={name: column[positions] for name, column in self.columns.items()},
+        )
+
+    def take_groups(self, positions: list[np.ndarray]) -> "CandidateBatch":
+        """
+        Keeps `positions[g]` (flat positions, in that order) for every group `g`.
+        """
+        lengths = [len(p) for p in positions]
+        offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+        flat = np.concatenate(positions) if positions else np.empty(0, dtype=np.int64)
+        return self.take(flat, offsets)
+
+    def slice_groups(self, start: int, stop: int) -> "CandidateBatch":
+        lo, hi = self.offsets[start], self.offsets[stop]
+        return CandidateBatch(
+            ids=self.ids[lo:hi],
+            offsets=self.offsets[start:stop + 1] - lo,
+            object_ids=self.object_ids[start:stop] if self.object_ids is not None else None,
+            columns={name: column[lo:hi] for name, column in self.columns.items()},
+        )
+
+    def filter(self, mask: np.ndarray) -> "CandidateBatch":
+        """
+        Keeps the candidates where mask is True, groups keep their order and may become empty.
+        """
+        mask = np.asarray(mask, dtype=bool)
+        lengths = np.bincount(self.group_index[mask], minlength=self.num_groups)
+        return self.take(np.flatnonzero(mask), np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)]))
+
+    def head(self, n: int) -> "CandidateBatch":
+        """
+        Keeps the first n candidates of every group.
+        """
+        return self.filter(np.arange(len(self.ids)) - np.repeat(self.offsets[:-1], self.lengths) < n)
+
+    def group(self, i: int) -> "CandidateBatch":
+        return self.slice_groups(i, i + 1)
+
+    def top_n(self, column: str, n: int, descending: bool = True) -> "CandidateBatch":
+        """
+        Keeps the n best candidates of every group by a column, ordered by it.
+        """
+        return self.take_groups(grouped_top_n(self.columns[column], self.offsets, n, descending))
+
+    def to_candidates(self) -> list[Candidate]:
+        names = list(self.columns)
+        values = [list(self.columns[name]) if self.columns[name].ndim > 1 else self.columns[name].tolist()
+                  for name in names]
+        return [
+            Candidate(id=candidate_id, features=dict(zip(names, row)) if names else None)
+            for candidate_id, row in zip(self.ids.tolist(), zip(*values) if names else [()] * len(self.ids))
+        ]
+
+    def to_candidate_lists(self) -> list[list[Candidate]]:
+        candidates = self.to_candidates()
+        return [candidates[start:stop] for start, stop in zip(self.offsets[:-1], self.offsets[1:])]
+
+
+@dataclass
+class EmbeddingTable:
+    """
+    Embeddings of a set of objects: row `i` of `vectors` belongs to `ids[i]`. Ids are kept sorted,
+    so a batch of ids maps to rows with one `searchsorted`. Int64 ids that are already sorted and a
+    C-contiguous float32 matrix are used without copying, e.g. memory-mapped files from `load`.
+    Args:
+        ids (np.ndarray): unique object ids
+        vectors (np.ndarray): matrix of shape (len(ids), dim)
+    """
+    ids: np.ndarray
+    vectors: np.ndarray
+
+    def __post_init__(self):
+        self.ids = np.asarray(self.ids, dtype=np.int64)
+        self.vectors = np.ascontiguousarray(self.vectors, dtype=np.float32)
+        assert self.ids.ndim == 1 and self.vectors.ndim == 2 and len(self.ids) == len(self.vectors)
+        if len(self.ids) > 1 and not (self.ids[1:] > self.ids[:-1]).all():
+            order = np.argsort(self.ids, kind="stable")
+            self.ids, self.vectors = self.ids[order], self.vectors[order]
+            assert (self.ids[1:] > self.ids[:-1]).all(), "ids have to be unique"
+
+    @classmethod
+    def from_dict(cls, embeddings: dict[int, Embedding]) -> "EmbeddingTable":
+        ids = np.fromiter(embeddings.keys(), dtype=np.int64, count=len(embeddings))
+        vectors = np.stack(list(embeddings.values())) if embeddings else np.empty((0, 0), dtype=np.float32)
+        return cls(ids, vectors)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def dim(self) -> int:
+        return self.vectors.shape[1]
+
+    def rows(self, ids) -> np.ndarray:
+        """
+        Rows of the ids in `vectors`, -1 for unknown ids.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(self.ids):
+            return np.full(ids.shape, -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.ids, ids), len(self.ids) - 1)
+        return np.where(self.ids[positions] == ids, positions, -1)
+
+    def lookup(self, ids) -> np.ndarray:
+        """
+        Embeddings of a batch of ids as a (n_ids, dim) float32 matrix, raises KeyError for unknown ids.
+        """
+        rows = self.rows(ids)
+        if (rows < 0).any():
+            raise KeyError(np.asarray(ids)[rows < 0][0].item())
+        return self.vectors[rows]
+
+    def __getitem__(self, object_id: int) -> Embedding:
+        return self.lookup([object_id])[0]
+
+    def __contains__(self, object_id: int) -> bool:
+        return bool(self.rows([object_id])[0] >= 0)
+
+    def to_dict(self) -> dict[int, Embedding]:
+        return dict(zip(self.ids.tolist(), self.vectors))
+
+    def save(self, path: str):
+        """
+        Writes `ids.npy` and `vectors.npy` into the directory, see `load`.
+        """
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "ids.npy"), self.ids)
+        np.save(os.path.join(path, "vectors.npy"), self.vectors)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "EmbeddingTable":
+        """
+        Opens a table written by `save`, memory-mapped read-only with `mmap`.
+        """
+        mmap_mode = "r" if mmap else None
+        return cls(
+            np.load(os.path.join(path, "ids.npy"), mmap_mode=mmap_mode),
+            np.load(os.path.join(path, "vectors.npy"), mmap_mode=mmap_mode),
+        )
+
+
+def as_embedding_table(embeddings: EmbeddingTable | dict[int, Embedding]) -> EmbeddingTable:
+    if isinstance(embeddings, EmbeddingTable):
+        return embeddings
+    return EmbeddingTable.from_dict(embeddings)
+
+
+__all__ = [
+    "Candidate",
+    "CandidateBatch",
+    "Embedding",
+    "EmbeddingTable",
+    "Feature",
+    "as_embedding_table",
+    "grouped_top_n",
+]
@@ -1,6 +1,22 @@
 from abc import ABC, abstractmethod
 
-from grocery.recommender.primitives import Candidate
+import numpy as np
+import polars as pl
+
+from grocery.recommender.candidates import CandidateGenerator
+from grocery.recommender.features import PAIR_KEY_BITS, FeatureManager, encode_keys
+from grocery.recommender.primitives import Candidate, CandidateBatch
+from grocery.recommender.reranking import Ranker
+
+
+def _reorder_groups(batch: CandidateBatch, order: np.ndarray) -> CandidateBatch:
+    lengths = batch.lengths[order]
+    offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+    positions = np.repeat(batch.offsets[order] - offsets[:-1], lengths) + np.arange(offsets[-1])
+    batch = batch.take(positions, offsets)
+    if batch.object_ids is not None:
+        batch.object_ids = batch.object_ids[order]
+    return batch
 
 
 class BaseRecommender(ABC):
@@ -11,3 +27,105 @@ class BaseRecommender(ABC):
     @abstractmethod
     def recommend_batch(self, user_ids: list[int], n: int = 10) -> list[list[Candidate]]:
         pass
+
+
+class PipelineRecommender(BaseRecommender):
+    def __init__(self,
+                 candidate_generator: CandidateGenerator,
+                 ranker: Ranker | None = None,
+                 feature_manager: FeatureManager | None = None,
+                 num_candidates: int = 300,
+                 seen_items: pl.DataFrame | dict[int, list[int]] | None = None,
+                 batch_size: int = 4096,
+                 ):
+        """
+        Retrieval, feature extraction and ranking executed on whole batches of users.
+        Args:
+            candidate_generator (CandidateGenerator): first stage, retrieves `num_candidates` per user
+            ranker (Ranker | None): ranking stage, a `RankingPipeline` sets the candidate count of every
+            ranker; without it the retrieval order is kept
+            feature_manager (FeatureManager | None): features required by the ranker
+            num_candidates (int): number of retrieved candidates per user
+            seen_items (pl.DataFrame | dict[int, list[int]] | None): items to exclude per user,
+            as a dataframe with (user_id, item_id) columns or a dict
+            batch_size (int): maximal number of users processed at once, bounds the memory use
+        """
+        self.candidate_generator = candidate_generator
+        self.ranker = ranker
+        self.feature_manager = feature_manager
+        self.num_candidates = num_candidates
+        self.batch_size = batch_size
+        self.seen_keys = None
+        if seen_items is not None:
+            self.set_seen_items(seen_items)
+
+    def set_seen_items(self, seen_items: pl.DataFrame | dict[int, list[int]]):
+        if isinstance(seen_items, dict):
+            seen_items = pl.DataFrame(
+                {"user_id": list(seen_items.keys()), "item_id": list(seen_items.values())},
+                schema={"user_id": pl.Int64, "item_id": pl.List(pl.Int64)},
+            ).explode("item_id").drop_nulls()
+        users = seen_items["user_id"].to_numpy().astype(np.int64)
+        items = seen_items["item_id"].to_numpy().astype(np.int64)
+        codes, valid = encode_keys((users, items), pair=True)
+        assert valid.all(), "user and item ids have to be non-negative"
+        self.seen_keys = np.unique(codes)
+        self.seen_users, self.seen_counts = np.unique(self.seen_keys >> PAIR_KEY_BITS, return_counts=True)
+
+    def _seen_counts(self, user_ids: np.ndarray) -> np.ndarray:
+        if self.seen_keys is None or not len(self.seen_users):
+            return np.zeros(len(user_ids), dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.seen_users, user_ids), len(self.seen_users) - 1)
+        return np.where(self.seen_users[positions] == user_ids, self.seen_counts[positions], 0)
+
+    def _retrieve(self, user_ids: np.ndarray, num_retrieved: int) -> CandidateBatch:
+        """
+        Retrieves `num_retrieved` unseen candidates per user. Every user over-fetches by its own number
+        of seen items rounded up to a power of two, users with the same over-fetch share one generator
+        call, so a heavy user does not inflate the retrieval of the whole chunk.
+        """
+        counts = self._seen_counts(user_ids)
+        extra = np.where(counts > 0, 2 ** np.ceil(np.log2(np.maximum(counts, 1))), 0).astype(np.int64)
+        sizes, groups = np.unique(extra, return_inverse=True)
+        batches, members = [], []
+        for i, size in enumerate(sizes.tolist()):
+            rows = np.flatnonzero(groups == i)
+            batch = self.candidate_generator.extract_candidate_batch(user_ids[rows], num_retrieved + size)
+            if size:
+                batch = self._exclude_seen(batch)
+            batches.append(batch.head(num_retrieved))
+            members.append(rows)
+        if len(batches) == 1:
+            return batches[0]
+        return _reorder_groups(CandidateBatch.concat(batches), np.argsort(np.concatenate(members)))
+
+    def _exclude_seen(self, batch: CandidateBatch) -> CandidateBatch:
+        if self.seen_keys is None or not len(self.seen_keys):
+            return batch
+        codes, _ = encode_keys((batch.candidate_object_ids, batch.ids), pair=True)
+        positions = np.minimum(np.searchsorted(self.seen_keys, codes), len(self.seen_keys) - 1)
+        return batch.filter(self.seen_keys[positions] != codes)
+
+    def recommend_candidate_batch(self, user_ids: list[int], n: int = 10) -> CandidateBatch:
+        """
+        Recommends n items to every user, keeping the features and scores of all the stages as columns.
+        """
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        batches = []
+        for start in range(0, len(user_ids), self.batch_size):
+            chunk = user_ids[start:start + self.batch_size]
+            batch = self._retrieve(chunk, max(self.num_candidates, n))
+            if self.feature_manager is not None:
+                batch = self.feature_manager.extract(None, batch)
+            if self.ranker is not None:
+                batch = self.ranker.rank(None, batch, n)
+            batches.append(batch.head(n))
+        if not batches:
+            return CandidateBatch(ids=np.empty(0, dtype=np.int64), offsets=np.zeros(1, dtype=np.int64), object_ids=user_ids)
+        return CandidateBatch.concat(batches)
+
+    def recommend(self, user_id: int, n: int = 10) -> list[Candidate]:
+        return self.recommend_batch([user_id], n)[0]
+
+    def recommend_batch(self, user_ids: list[int], n: int = 10) -> list[list[Candidate]]:
+        return self.recommend_candidate_batch(user_ids, n).to_candidate_lists()
@@ -4,7 +4,7 @@ import heapq
 import numpy as np
 from catboost import CatBoostRanker, FeaturesData
 
-from grocery.recommender.primitives import Candidate
+from grocery.recommender.primitives import Candidate, CandidateBatch, grouped_top_n
 from grocery.recommender.features import FeatureManager
 
 
@@ -14,11 +14,17 @@ class Ranker(ABC):
         pass
         
     @abstractmethod
-    def rank(self, object_id: int, candidates: list[Candidate], n: int) -> list[Candidate]:
+    def rank(self, object_id: int, candidates: list[Candidate] | CandidateBatch, n: int) -> list[Candidate] | CandidateBatch:
+        """
+        Ranks the candidates and keeps the best n. A `CandidateBatch` may hold several requests,
+        then `object_id` is ignored in favour of `CandidateBatch.object_ids` and n is applied per request.
+        """
         pass
 
     @staticmethod
-    def select_top_n(candidates: list[Candidate], feature: str, n: int, descending: bool = True):
+    def select_top_n(candidates: list[Candidate] | CandidateBatch, feature: str, n: int, descending: bool = True):
+        if isinstance(candidates, CandidateBatch):
+            return candidates.top_n(feature, n, descending)
         if descending:
             return heapq.nlargest(n, candidates, key=lambda x: x.features[feature])
         else:
@@ -30,9 +36,8 @@ class FeatureRanker(Ranker):
         super().__init__()
         self.feature_name = feature_name
 
-    def rank(self, object_id: int, candidates: list[Candidate], n: int) -> list[Candidate]:
-        self.sort(candidates, self.feature_name)
-        return candidates[:n]
+    def rank(self, object_id: int, candidates: list[Candidate] | CandidateBatch, n: int) -> list[Candidate] | CandidateBatch:
+        return self.select_top_n(candidates, self.feature_name, n)
 
 
 class GroceryCatboostRanker(Ranker):
@@ -40,7 +45,8 @@ class GroceryCatboostRanker(Ranker):
                  model_path: str,
                  num_feature_schema: list[str],
                  cat_feature_schema: list[str] | None = None,
-                 score_feature_name: str = "cbm_relevance"
+                 score_feature_name: str = "cbm_relevance",
+                 thread_count: int = -1,
                  ):
         super().__init__()
         self.model = CatBoostRanker()
@@ -49,6 +55,7 @@ class GroceryCatboostRanker(Ranker):
         self.cat_feature_schema = cat_feature_schema or []
         self.score_feature_name = score_feature_name
         self.fill_value = -9999999.0
+        self.thread_count = thread_count
 
     def build_cbm_features(self, candidates: list[Candidate]) -> FeaturesData:
         num_feature_array = np.array([
@@ -66,13 +73,84 @@ class GroceryCatboostRanker(Ranker):
             cat_feature_names=self.cat_feature_schema,
         )
 
-    def rank(self, object_id: int, candidates: list[Candidate], n: int) -> list[Candidate]:
+    def build_cbm_features_from_columns(self, columns: dict[str, np.ndarray], num_rows: int) -> FeaturesData:
+        """
+        Builds CatBoost input from feature columns, e.g. `CandidateBatch.columns`.
+        Missing features get the fill values.
+        """
+        num_feature_array = np.full((num_rows, len(self.num_feature_schema)), self.fill_value, dtype=np.float32)
+        for j, feature in enumerate(self.num_feature_schema):
+            if feature in columns:
+                num_feature_array[:, j] = columns[feature]
+        cat_feature_array = np.full((num_rows, len(self.cat_feature_schema)), "EMPTY", dtype=object)
+        for j, feature in enumerate(self.cat_feature_schema):
+            if feature in columns:
+                cat_feature_array[:, j] = np.asarray(columns[feature]).astype(str)
+        return FeaturesData(
+            num_feature_data=num_feature_array,
+            cat_feature_data=cat_feature_array,
+            num_feature_names=self.num_feature_schema,
+            cat_feature_names=self.cat_feature_schema,
+        )
+
+    def build_cbm_features_from_matrix(self, matrix: np.ndarray, names: list[str]) -> FeaturesData:
+        """
+        Builds CatBoost input from a feature matrix, e.g. from `FeatureManager.extract_batch`.
+        """
+        return self.build_cbm_features_from_columns(
+            {name: matrix[:, i] for i, name in enumerate(names)}, len(matrix))
+
+    def rank(self, object_id: int, candidates: list[Candidate] | CandidateBatch, n: int) -> list[Candidate] | CandidateBatch:
+        if isinstance(candidates, CandidateBatch):
+            scores = np.empty(0, dtype=np.float64)
+            if len(candidates):
+                features = self.build_cbm_features_from_columns(candidates.columns, len(candidates))
+                scores = self.model.predict(features, thread_count=self.thread_count)
+            candidates[self.score_feature_name] = scores
+            return self.select_top_n(candidates, self.score_feature_name, n)
         features = self.build_cbm_features(candidates)
-        scores = self.model.predict(features)
+        scores = self.model.predict(features, thread_count=self.thread_count)
         for candidate, score in zip(candidates, scores):
             candidate.features[self.score_feature_name] = score
         return self.select_top_n(candidates, self.score_feature_name, n)
 
+    def rank_batch(self,
+                   object_ids: list[int],
+                   candidate_lists: list[list[Candidate]] | CandidateBatch,
+                   n: int,
+                   features: tuple[np.ndarray, list[str]] | None = None,
+                   ) -> list[list[Candidate]] | CandidateBatch:
+        """
+        Ranks the candidates of several requests with a single CatBoost call.
+        Args:
+            object_ids (list[int]): request object ids
+            candidate_lists (list[list[Candidate]]): candidates of every request
+            n (int): number of candidates to keep per request
+            features (tuple[np.ndarray, list[str]] | None): optional feature matrix and column names
+            for all the candidates concatenated in request order; when omitted the features are
+            read from `Candidate.features`
+        Returns:
+            list[list[Candidate]]: top-n candidates per request, with the score written to their features;
+            a `CandidateBatch` input is ranked by `rank` and returned as a batch
+        """
+        if isinstance(candidate_lists, CandidateBatch):
+            return self.rank(object_ids, candidate_lists, n)
+        assert len(object_ids) == len(candidate_lists)
+        offsets = np.concatenate([[0], np.cumsum([len(candidates) for candidates in candidate_lists])])
+        flat_candidates = [candidate for candidates in candidate_lists for candidate in candidates]
+        if not flat_candidates:
+            return [[] for _ in candidate_lists]
+        if features is not None:
+            cbm_features = self.build_cbm_features_from_matrix(*features)
+        else:
+            cbm_features = self.build_cbm_features(flat_candidates)
+        scores = self.model.predict(cbm_features, thread_count=self.thread_count)
+        for candidate, score in zip(flat_candidates, scores.tolist()):
+            if candidate.features is None:
+                candidate.features = {}
+            candidate.features[self.score_feature_name] = score
+        return [[flat_candidates[i] for i in top] for top in grouped_top_n(scores, offsets, n)]
+
 
 class SoftmaxSampler(Ranker):
     def __init__(self,
@@ -91,7 +169,11 @@ class SoftmaxSampler(Ranker):
         relevances = relevances + noise * self.temperature
         return relevances
 
-    def rank(self, object_id: int, candidates: list[Candidate], n: int) -> list[Candidate]:
+    def rank(self, object_id: int, candidates: list[Candidate] | CandidateBatch, n: int) -> list[Candidate] | CandidateBatch:
+        if isinstance(candidates, CandidateBatch):
+            relevances = np.asarray(candidates[self.relevance_feature_name], dtype=np.float64)
+            candidates[self.sampled_rank_feature_name] = self.gumbel_max_trick(relevances)
+            return self.select_top_n(candidates, self.sampled_rank_feature_name, n)
         relevances = np.array([candidate.features[self.relevance_feature_name] for candidate in candidates])
         probs = self.gumbel_max_trick(relevances)
         for candidate, prob in zip(candidates, probs):
@@ -110,7 +192,7 @@ class RankingPipeline(Ranker):
         self.n_candidates = num_candidates_by_ranker
 
 
-    def rank(self, object_id: int, candidates: list[Candidate], n: int) -> list[Candidate]:
+    def rank(self, object_id: int, candidates: list[Candidate] | CandidateBatch, n: int) -> list[Candidate] | CandidateBatch:
         for reranker, nc in zip(self.rerankers, self.n_candidates):
             candidates = reranker.rank(object_id, candidates, max(nc, n))
         return candidates
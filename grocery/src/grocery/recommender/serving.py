@@ -0,0 +1,207 @@
+import asyncio
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import dataclass
+
+from grocery.recommender.primitives import Candidate
+from grocery.recommender.recommender import BaseRecommender
+
+
+@dataclass
+class _Request:
+    user_id: int
+    n: int
+    future: asyncio.Future
+
+
+@dataclass
+class BatchingStats:
+    num_requests: int = 0
+    num_rejected: int = 0
+    num_timeouts: int = 0
+    num_failed: int = 0
+    num_batches: int = 0
+    num_batched_requests: int = 0
+    max_batch_size: int = 0
+    max_queue_depth: int = 0
+    total_queue_depth: int = 0
+
+    @property
+    def mean_batch_size(self) -> float:
+        return self.num_batched_requests / self.num_batches if self.num_batches else 0.0
+
+    @property
+    def mean_queue_depth(self) -> float:
+        """
+        Mean number of queued requests at the moment a batch is taken from the queue.
+        """
+        return self.total_queue_depth / self.num_batches if self.num_batches else 0.0
+
+    def as_dict(self) -> dict[str, float]:
+        return {
+            "num_requests": self.num_requests,
+            "num_rejected": self.num_rejected,
+            "num_timeouts": self.num_timeouts,
+            "num_failed": self.num_failed,
+            "num_batches": self.num_batches,
+            "mean_batch_size": self.mean_batch_size,
+            "max_batch_size": self.max_batch_size,
+            "mean_queue_depth": self.mean_queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+        }
+
+
+class BatchingRecommender:
+    def __init__(self,
+                 recommender: BaseRecommender,
+                 max_batch_size: int = 256,
+                 max_wait_ms: float = 5.0,
+                 max_queue_size: int = 10_000,
+                 timeout_ms: float | None = None,
+                 max_concurrent_batches: int = 1,
+                 executor: Executor | None = None,
+                 ):
+        """
+        Coalesces concurrent single-user `recommend` calls into `recommend_batch` calls.
+        A batch is flushed when it reaches `max_batch_size` requests or when its oldest request
+        has waited `max_wait_ms`. Batches run on executor threads, the event loop stays free.
+        Use as `async with BatchingRecommender(...) as service: await service.recommend(user_id, n)`.
+        Args:
+            recommender (BaseRecommender): recommender that does the work
+            max_batch_size (int): maximal number of requests in one batch
+            max_wait_ms (float): maximal time the first request of a batch waits for others
+            max_queue_size (int): number of queued requests after which new ones are rejected
+            with `asyncio.QueueFull`
+            timeout_ms (float | None): default per-request timeout, `TimeoutError` is raised after it
+            max_concurrent_batches (int): number of batches processed at the same time
+            executor (Executor | None): executor for `recommend_batch`, a thread pool
+            of `max_concurrent_batches` workers by default
+        """
+        assert max_batch_size > 0 and max_concurrent_batches > 0
+        self.recommender = recommender
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.max_queue_size = max_queue_size
+        self.timeout_ms = timeout_ms
+        self.max_concurrent_batches = max_concurrent_batches
+        self.executor = executor
+        self.stats = BatchingStats()
+        self._own_executor = executor is None
+        self._queue = None
+        self._batch_ready = None
+        self._slots = None
+        self._worker = None
+        self._running = set()
+
+    async def start(self):
+        assert self._worker is None, "already started"
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_concurrent_batches)
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._batch_ready = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.max_concurrent_batches)
+        self._worker = asyncio.create_task(self._collect())
+
+    async def stop(self):
+        """
+        Stops accepting batches, waits for the running ones and fails the queued requests.
+        """
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+        if self._running:
+            await asyncio.gather(*self._running, return_exceptions=True)
+        while not self._queue.empty():
+            request = self._queue.get_nowait()
+            if not request.future.done():
+                request.future.set_exception(RuntimeError("recommender is stopped"))
+        if self._own_executor:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    async def __aenter__(self) -> "BatchingRecommender":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def recommend(self, user_id: int, n: int = 10, timeout_ms: float | None = None) -> list[Candidate]:
+        assert self._worker is not None, "call start() first"
+        future = asyncio.get_running_loop().create_future()
+        self.stats.num_requests += 1
+        try:
+            self._queue.put_nowait(_Request(user_id, n, future))
+        except asyncio.QueueFull:
+            self.stats.num_rejected += 1
+            raise
+        depth = self._queue.qsize()
+        self.stats.max_queue_depth = max(self.stats.max_queue_depth, depth)
+        if depth >= self.max_batch_size - 1:
+            self._batch_ready.set()
+        timeout_ms = self.timeout_ms if timeout_ms is None else timeout_ms
+        try:
+            return await asyncio.wait_for(future, None if timeout_ms is None else timeout_ms / 1000)
+        except (asyncio.TimeoutError, TimeoutError):
+            self.stats.num_timeouts += 1
+            raise
+
+    async def _collect(self):
+        requests = []
+        try:
+            while True:
+                requests = [await self._queue.get()]
+                if self._queue.qsize() < self.max_batch_size - 1:
+                    self._batch_ready.clear()
+                    try:
+                        await asyncio.wait_for(self._batch_ready.wait(), self.max_wait_ms / 1000)
+                    except (asyncio.TimeoutError, TimeoutError):
+                        pass
+                depth = self._queue.qsize()
+                requests += [self._queue.get_nowait() for _ in range(min(depth, self.max_batch_size - 1))]
+                requests = [request for request in requests if not request.future.done()]
+                if not requests:
+                    continue
+                self.stats.total_queue_depth += depth + 1
+                await self._slots.acquire()
+                task = asyncio.create_task(self._flush(requests))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+                requests = []
+        except asyncio.CancelledError:
+            # requests taken from the queue but not handed to a batch are failed like the queued ones
+            for request in requests:
+                if not request.future.done():
+                    request.future.set_exception(RuntimeError("recommender is stopped"))
+            raise
+
+    async def _flush(self, requests: list[_Request]):
+        try:
+            self.stats.num_batches += 1
+            self.stats.num_batched_requests += len(requests)
+            self.stats.max_batch_size = max(self.stats.max_batch_size, len(requests))
+            n = max(request.n for request in requests)
+            user_ids = [request.user_id for request in requests]
+            try:
+                results = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self.recommender.recommend_batch, user_ids, n)
+            except Exception as error:
+                self.stats.num_failed += len(requests)
+                for request in requests:
+                    if not request.future.done():
+                        request.future.set_exception(error)
+                return
+            for request, result in zip(requests, results):
+                if not request.future.done():
+                    request.future.set_result(result[:request.n])
+        finally:
+            self._slots.release()
+
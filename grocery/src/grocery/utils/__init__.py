@@ -1,10 +1,14 @@
-from grocery.utils.dataset import download_and_extract, build_matrix_with_mappings, build_mappings
+from grocery.utils.dataset import download, download_and_extract, file_checksum, build_matrix_with_mappings, build_mappings, coordinates_to_matrix, ids_to_indices
 from grocery.utils.viewer import show_posters, build_item_data
 
 __all__ = [
+    "download",
     "download_and_extract",
+    "file_checksum",
     "build_matrix_with_mappings",
     "build_mappings",
+    "coordinates_to_matrix",
+    "ids_to_indices",
     "show_posters",
     "build_item_data",
 ]
@@ -0,0 +1,481 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import joblib
+import numpy as np
+import polars as pl
+from catboost import CatBoostRanker, Pool
+
+import grocery
+from grocery.metrics.aspects import CategoryDiversity, Novelty, Serendipity
+from grocery.recommender.candidates import CandidateGenerator, DotProductKNN, HNSWCandidateGenerator
+from grocery.recommender.features import EmbeddingScoreExtractor, FeatureManager, FeatureStorage, StaticFeatureExtractor
+from grocery.recommender.primitives import EmbeddingTable, as_embedding_table
+from grocery.recommender.recommender import BaseRecommender, PipelineRecommender
+from grocery.recommender.reranking import GroceryCatboostRanker, RankingPipeline, SoftmaxSampler
+from grocery.recommender.serving import BatchingRecommender
+
+
+def measure(function, *args, repeat: int = 1, **kwargs) -> tuple[float, object]:
+    """
+    Runs the function `repeat` times and returns the best wall time in seconds with the last result.
+    """
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def recall_at_k(approx_ids: np.ndarray, exact_ids: np.ndarray) -> float:
+    """
+    Mean share of the exact top-k ids found by the approximate retrieval, per query.
+    """
+    hits = [len(np.intersect1d(a, e)) / max(len(e), 1) for a, e in zip(approx_ids, exact_ids)]
+    return float(np.mean(hits)) if hits else 0.0
+
+
+def _latency_stats(generator, object_ids: list[int], n: int, num_latency_queries: int) -> dict[str, float]:
+    latencies = []
+    for object_id in object_ids[:num_latency_queries]:
+        elapsed, _ = measure(generator.batch_top_k, [object_id], n)
+        latencies.append(elapsed * 1000)
+    return {
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+    }
+
+
+def recall_latency_report(exact: DotProductKNN,
+                          approx: HNSWCandidateGenerator,
+                          object_ids: list[int],
+                          n: int = 10,
+                          ef_values: tuple[int, ...] = (10, 20, 50, 100, 200, 400),
+                          num_latency_queries: int = 1000,
+                          ) -> pl.DataFrame:
+    """
+    Compares approximate retrieval against brute force for a range of query `ef` values.
+    Single-query latencies (p50/p99) are measured on the first `num_latency_queries` ids,
+    batch throughput and recall@n on all of them.
+    Args:
+        exact (DotProductKNN): brute-force generator, used as ground truth
+        approx (HNSWCandidateGenerator): approximate generator, its `ef` is varied
+        object_ids (list[int]): query ids
+        n (int): number of retrieved items
+        ef_values (tuple[int, ...]): query search depths to evaluate
+        num_latency_queries (int): number of queries for the single-query latency percentiles
+    Returns:
+        pl.DataFrame: one row per setting with recall, latency percentiles and batch throughput
+    """
+    batch_time, (exact_ids, _) = measure(exact.batch_top_k, object_ids, n)
+    rows = [{
+        "method": "brute_force",
+        "ef": None,
+        f"recall@{n}": 1.0,
+        **_latency_stats(exact, object_ids, n, num_latency_queries),
+        "batch_qps": len(object_ids) / batch_time,
+    }]
+    initial_ef = approx.ef
+    try:
+        for ef in ef_values:
+            approx.ef = ef
+            batch_time, (approx_ids, _) = measure(approx.batch_top_k, object_ids, n)
+            rows.append({
+                "method": "hnsw",
+                "ef": ef,
+                f"recall@{n}": recall_at_k(approx_ids, exact_ids),
+                **_latency_stats(approx, object_ids, n, num_latency_queries),
+                "batch_qps": len(object_ids) / batch_time,
+            })
+    finally:
+        approx.ef = initial_ef
+    return pl.DataFrame(rows)
+
+
+def quantization_report(left_embeddings: EmbeddingTable | dict[int, np.ndarray],
+                        right_embeddings: EmbeddingTable | dict[int, np.ndarray],
+                        object_ids: list[int],
+                        n: int = 10,
+                        settings: tuple[tuple[str, str, int], ...] = (
+                            ("float16", "row", 0),
+                            ("int8", "row", 0),
+                            ("int8", "dim", 0),
+                            ("int8", "row", 4),
+                        ),
+                        repeat: int = 3,
+                        num_single: int = 100,
+                        ) -> pl.DataFrame:
+    """
+    Reports accuracy and speed of compressed `DotProductKNN` storage against float32.
+    Args:
+        left_embeddings (EmbeddingTable | dict[int, np.ndarray]): query embeddings
+        right_embeddings (EmbeddingTable | dict[int, np.ndarray]): item embeddings
+        object_ids (list[int]): query ids
+        n (int): number of retrieved items
+        settings (tuple[tuple[str, str, int], ...]): (storage, scale_mode, rescore) combinations
+        repeat (int): timing repetitions, the best one is reported
+        num_single (int): number of the object ids queried one at a time for the single-query throughput
+    Returns:
+        pl.DataFrame: one row per setting with the retained item-side size (`DotProductKNN.nbytes`),
+        recall@n, batch throughput and single-query throughput
+    """
+    single_ids = object_ids[:num_single]
+
+    def single_qps(knn: DotProductKNN) -> float:
+        elapsed, _ = measure(lambda: [knn.batch_top_k([object_id], n) for object_id in single_ids], repeat=repeat)
+        return len(single_ids) / elapsed
+
+    same = left_embeddings is right_embeddings
+    left_embeddings = as_embedding_table(left_embeddings)
+    right_embeddings = left_embeddings if same else as_embedding_table(right_embeddings)
+    exact = DotProductKNN(left_embeddings, right_embeddings)
+    exact_time, (exact_ids, _) = measure(exact.batch_top_k, object_ids, n, repeat=repeat)
+    rows = [{
+        "storage": "float32",
+        "scale_mode": None,
+        "rescore": 0,
+        "retained_mb": exact.nbytes / 2 ** 20,
+        f"recall@{n}": 1.0,
+        "batch_qps": len(object_ids) / exact_time,
+        "single_qps": single_qps(exact),
+    }]
+    for storage, scale_mode, rescore in settings:
+        knn = DotProductKNN(left_embeddings, right_embeddings, storage=storage, scale_mode=scale_mode, rescore=rescore)
+        elapsed, (ids, _) = measure(knn.batch_top_k, object_ids, n, repeat=repeat)
+        rows.append({
+            "storage": storage,
+            "scale_mode": scale_mode if storage == "int8" else None,
+            "rescore": rescore,
+            "retained_mb": knn.nbytes / 2 ** 20,
+            f"recall@{n}": recall_at_k(ids, exact_ids),
+            "batch_qps": len(object_ids) / elapsed,
+            "single_qps": single_qps(knn),
+        })
+    return pl.DataFrame(rows)
+
+
+def synthetic_feature_storage(num_keys: int,
+                              num_features: int,
+                              pair_keys: bool = True,
+                              seed: int = 0,
+                              ) -> FeatureStorage:
+    """
+    Builds a storage of `num_features` float features over `num_keys` random keys.
+    """
+    rng = np.random.default_rng(seed)
+    if pair_keys:
+        keys = (rng.integers(0, 2 ** 20, num_keys), rng.integers(0, 2 ** 20, num_keys))
+    else:
+        keys = rng.choice(2 ** 40, size=num_keys, replace=False)
+    storage = FeatureStorage()
+    for i in range(num_features):
+        storage.add_feature_array(f"feature_{i}", keys, rng.random(num_keys), default=0.0)
+    return storage
+
+
+_LOAD_SCRIPT = """
+import json, resource, sys, time
+import numpy as np
+from grocery.recommender.features import FeatureStorage, PAIR_KEY_BITS
+
+
+def memory_mb():
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+    except OSError:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        return {"rss_mb": rss, "anonymous_mb": rss}
+    return {
+        "rss_mb": int(fields["Rss"].split()[0]) / 1024,
+        "anonymous_mb": int(fields["Anonymous"].split()[0]) / 1024,
+    }
+
+
+path, mmap, num_lookups = sys.argv[1], sys.argv[2] == "1", int(sys.argv[3])
+baseline = memory_mb()
+start = time.perf_counter()
+storage = FeatureStorage.load(path, mmap=mmap)
+load_seconds = time.perf_counter() - start
+rng = np.random.default_rng(0)
+rows = rng.integers(0, len(storage.keys), num_lookups)
+keys = storage.keys[rows]
+if storage.pair_keys:
+    keys = np.stack([keys >> PAIR_KEY_BITS, keys & (2 ** PAIR_KEY_BITS - 1)], axis=1)
+start = time.perf_counter()
+storage.get_batch(keys, storage.names)
+lookup_seconds = time.perf_counter() - start
+print(json.dumps({
+    "load_seconds": load_seconds,
+    "lookup_seconds": lookup_seconds,
+    **{key: value - baseline[key] for key, value in memory_mb().items()},
+}))
+"""
+
+
+def storage_load_report(storage: FeatureStorage, directory: str, num_lookups: int = 100_000) -> pl.DataFrame:
+    """
+    Saves the storage as a joblib file and in the memory-mapped layout, then loads each one in a fresh
+    process and reports load time, time of one `get_batch` over all features, and the growth of RSS and
+    of anonymous (heap) memory over the process baseline. Heap memory is what every serving worker pays
+    separately, memory-mapped pages count towards RSS but are shared between processes via the page cache.
+    """
+    joblib_path = os.path.join(directory, "storage.joblib")
+    with open(joblib_path, "wb") as f:
+        joblib.dump(storage, f, compress=3)
+    mmap_path = os.path.join(directory, "storage")
+    storage.save(mmap_path)
+    package_root = os.path.dirname(os.path.dirname(grocery.__file__))
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [package_root, os.environ.get("PYTHONPATH")]))}
+    rows = []
+    for fmt, path, mmap in [("joblib", joblib_path, False), ("npy", mmap_path, False), ("npy+mmap", mmap_path, True)]:
+        output = subprocess.run(
+            [sys.executable, "-c", _LOAD_SCRIPT, path, str(int(mmap)), str(num_lookups)],
+            check=True, capture_output=True, text=True, env=env,
+        ).stdout
+        rows.append({"format": fmt, **json.loads(output)})
+    return pl.DataFrame(rows)
+
+
+def synthetic_recommender(directory: str,
+                          num_users: int = 100_000,
+                          num_items: int = 10_000,
+                          dim: int = 64,
+                          num_candidates: int = 300,
+                          num_ranked: int = 50,
+                          num_seen: int = 20,
+                          seed: int = 0,
+                          ) -> PipelineRecommender:
+    """
+    Builds a full pipeline over random embeddings: brute-force retrieval, a static item feature,
+    the embedding score, a small CatBoost model trained on random labels and softmax sampling,
+    with `num_seen` random seen items per user. The model file is written to `directory`.
+    """
+    rng = np.random.default_rng(seed)
+    user_matrix = rng.standard_normal((num_users, dim), dtype=np.float32)
+    item_matrix = rng.standard_normal((num_items, dim), dtype=np.float32)
+    users = EmbeddingTable(np.arange(num_users), user_matrix)
+    items = EmbeddingTable(np.arange(num_items), item_matrix)
+    item_features = FeatureStorage()
+    item_features.add_feature_array("item_popularity", np.arange(num_items), rng.random(num_items), default=0.0)
+    feature_names = [CandidateGenerator.score_feature_name, "item_popularity", "embedding"]
+    model = CatBoostRanker(iterations=100, verbose=0, random_seed=seed)
+    model.fit(Pool(rng.random((10_000, len(feature_names))), rng.integers(0, 2, 10_000),
+                   group_id=np.repeat(np.arange(100), 100), feature_names=feature_names))
+    model_path = os.path.join(directory, "ranker.cbm")
+    model.save_model(model_path)
+    seen_items = pl.DataFrame({
+        "user_id": np.repeat(np.arange(num_users), num_seen),
+        "item_id": rng.integers(0, num_items, num_users * num_seen),
+    })
+    return PipelineRecommender(
+        candidate_generator=DotProductKNN(users, items, remove_self=False),
+        feature_manager=FeatureManager([
+            StaticFeatureExtractor(["item_popularity"], item_features, lambda user_id, item_id: item_id),
+            EmbeddingScoreExtractor(users, items, ["embedding"]),
+        ]),
+        ranker=RankingPipeline(
+            [GroceryCatboostRanker(model_path, feature_names), SoftmaxSampler(random_state=seed)],
+            [num_ranked, num_ranked],
+        ),
+        num_candidates=num_candidates,
+        seen_items=seen_items,
+    )
+
+
+def recommender_throughput_report(recommender: BaseRecommender,
+                                  user_ids: list[int],
+                                  n: int = 10,
+                                  batch_sizes: tuple[int, ...] = (256, 1024, 4096),
+                                  num_loop_users: int = 200,
+                                  ) -> pl.DataFrame:
+    """
+    Compares a per-user `recommend` loop on the first `num_loop_users` users against
+    `recommend_batch` over all the users, called in chunks of every batch size.
+    Args:
+        recommender (BaseRecommender): recommender to measure
+        user_ids (list[int]): users to recommend to
+        n (int): number of recommendations per user
+        batch_sizes (tuple[int, ...]): numbers of users per `recommend_batch` call
+        num_loop_users (int): number of users for the per-user loop
+    Returns:
+        pl.DataFrame: one row per mode with total seconds and users per second
+    """
+    loop_users = user_ids[:num_loop_users]
+    elapsed, _ = measure(lambda: [recommender.recommend(user_id, n) for user_id in loop_users])
+    rows = [{"mode": "loop", "batch_size": 1, "num_users": len(loop_users),
+             "seconds": elapsed, "users_per_second": len(loop_users) / elapsed}]
+    for batch_size in batch_sizes:
+        elapsed, _ = measure(lambda: [
+            recommender.recommend_batch(user_ids[start:start + batch_size], n)
+            for start in range(0, len(user_ids), batch_size)
+        ])
+        rows.append({"mode": "batch", "batch_size": batch_size, "num_users": len(user_ids),
+                     "seconds": elapsed, "users_per_second": len(user_ids) / elapsed})
+    return pl.DataFrame(rows)
+
+
+async def _closed_loop_load(service: BatchingRecommender,
+                            user_ids: list[int],
+                            n: int,
+                            concurrency: int,
+                            ) -> tuple[float, list[float], int]:
+    latencies, errors = [], 0
+    next_request = iter(range(len(user_ids)))
+
+    async def client():
+        nonlocal errors
+        for i in next_request:
+            start = time.perf_counter()
+            try:
+                await service.recommend(user_ids[i], n)
+            except (asyncio.QueueFull, asyncio.TimeoutError, TimeoutError):
+                errors += 1
+                continue
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return time.perf_counter() - start, latencies, errors
+
+
+def batching_load_report(recommender: BaseRecommender,
+                         user_ids: list[int],
+                         n: int = 10,
+                         concurrency_values: tuple[int, ...] = (1, 16, 64, 256),
+                         max_wait_ms_values: tuple[float, ...] = (0.0, 2.0, 10.0),
+                         max_batch_size: int = 256,
+                         ) -> pl.DataFrame:
+    """
+    Local load generator for `BatchingRecommender`: `concurrency` clients send single-user requests
+    in a closed loop (the next one after the response) until `user_ids` are exhausted.
+    Args:
+        recommender (BaseRecommender): recommender behind the batching front-end
+        user_ids (list[int]): users of all the requests
+        n (int): number of recommendations per request
+        concurrency_values (tuple[int, ...]): numbers of concurrent clients
+        max_wait_ms_values (tuple[float, ...]): flush delays to evaluate
+        max_batch_size (int): flush size
+    Returns:
+        pl.DataFrame: throughput, latency percentiles and the mean batch size per setting
+    """
+    async def run(concurrency: int, max_wait_ms: float) -> dict:
+        async with BatchingRecommender(recommender, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms) as service:
+            elapsed, latencies, errors = await _closed_loop_load(service, user_ids, n, concurrency)
+            return {
+                "concurrency": concurrency,
+                "max_wait_ms": max_wait_ms,
+                "requests_per_second": len(latencies) / elapsed,
+                "p50_ms": float(np.percentile(latencies, 50)) if latencies else None,
+                "p99_ms": float(np.percentile(latencies, 99)) if latencies else None,
+                "mean_batch_size": service.stats.mean_batch_size,
+                "errors": errors,
+            }
+
+    rows = [
+        asyncio.run(run(concurrency, max_wait_ms))
+        for max_wait_ms in max_wait_ms_values
+        for concurrency in concurrency_values
+    ]
+    return pl.DataFrame(rows)
+
+
+def _dict_novelty(interactions: pl.DataFrame) -> dict:
+    num_users = interactions.select(pl.col("user_id").unique().count()).item()
+    novelty_df = (
+        interactions
+        .group_by("item_id")
+        .agg(pl.col("user_id").unique().count().alias("popularity"))
+        .with_columns((1 - (pl.col("popularity") / num_users)).alias("novelty"))
+        .select("item_id", "novelty")
+    )
+    return {item_id: value for item_id, value in novelty_df.iter_rows()}
+
+
+def _dict_serendipity(interactions: pl.DataFrame) -> dict:
+    return {
+        user_id: set(history)
+        for user_id, history in (
+            interactions
+            .group_by("user_id")
+            .agg(pl.col("item_id").unique().alias("history"))
+        ).iter_rows()
+    }
+
+
+def _dict_category_diversity(interactions: pl.DataFrame) -> dict:
+    return dict(interactions.select("item_id", "product_category").unique().iter_rows())
+
+
+_ASPECT_BUILDERS = [
+    ("novelty", "dict", _dict_novelty),
+    ("novelty", "array", Novelty),
+    ("serendipity", "dict", _dict_serendipity),
+    ("serendipity", "array", Serendipity),
+    ("category_diversity", "dict", _dict_category_diversity),
+    ("category_diversity", "array", CategoryDiversity),
+]
+
+
+_ASPECT_SCRIPT = """
+import json, resource, sys, time
+import polars as pl
+from grocery.utils.benchmark import _ASPECT_BUILDERS
+
+
+def memory_mb():
+    try:
+        with open("/proc/self/status") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+    except OSError:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        return {"retained_mb": rss, "peak_mb": rss}
+    return {"retained_mb": int(fields["VmRSS"].split()[0]) / 1024, "peak_mb": int(fields["VmHWM"].split()[0]) / 1024}
+
+
+path, index = sys.argv[1], int(sys.argv[2])
+interactions = pl.read_parquet(path)
+_, _, builder = _ASPECT_BUILDERS[index]
+try:
+    # resets the peak RSS, so that it covers the construction alone
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+except OSError:
+    pass
+baseline = memory_mb()["retained_mb"]
+start = time.perf_counter()
+result = builder(interactions)
+build_seconds = time.perf_counter() - start
+print(json.dumps({"build_seconds": build_seconds, **{key: value - baseline for key, value in memory_mb().items()}}))
+"""
+
+
+def aspect_metrics_report(interactions: pl.DataFrame) -> pl.DataFrame:
+    """
+    Construction time and memory of the aspect metrics against the dict-and-set lookup tables they
+    used to build with `iter_rows()`. Every construction runs in a fresh process, its peak and retained
+    RSS growth cover the allocations of polars as well as of Python.
+    Args:
+        interactions (pl.DataFrame): interactions with user_id, item_id and product_category columns
+    Returns:
+        pl.DataFrame: one row per metric and implementation
+    """
+    package_root = os.path.dirname(os.path.dirname(grocery.__file__))
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [package_root, os.environ.get("PYTHONPATH")]))}
+    rows = []
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "interactions.parquet")
+        interactions.write_parquet(path)
+        for index, (metric, implementation, _) in enumerate(_ASPECT_BUILDERS):
+            output = subprocess.run(
+                [sys.executable, "-c", _ASPECT_SCRIPT, path, str(index)],
+                check=True, capture_output=True, text=True, env=env,
+            ).stdout
+            rows.append({"metric": metric, "implementation": implementation, **json.loads(output)})
+    return pl.DataFrame(rows)
@@ -1,54 +1,303 @@
-import requests
+import hashlib
+import json
+import os
+import threading
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import polars as pl
+import requests
 import scipy as sp
 from tqdm import tqdm
 
+from grocery.utils.io import write_json
+
+
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+
+def file_checksum(path: str, algorithm: str = "sha256", chunk_size: int = DOWNLOAD_CHUNK_SIZE) -> str:
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _parse_checksum(checksum: str) -> tuple[str, str]:
+    algorithm, _, value = checksum.rpartition(":")
+    return algorithm or "sha256", value.lower()
 
-def download_and_extract(url: str, filename: str, chunk_size: int = 1024, dest_dir: str = "."):
-    response = requests.get(url, stream=True)
+
+def _remote_size(session: requests.Session, url: str, timeout: float) -> tuple[int | None, bool]:
+    response = session.get(url, headers={"Range": "bytes=0-0"}, stream=True, timeout=timeout)
     response.raise_for_status()
-    total_size = int(response.headers.get('content-length', 0))
-    with open(filename, "wb") as f:
-        with tqdm(
-            total=total_size,
-            unit='B',
-            unit_scale=True,
-            desc=filename,
-            bar_format='{l_bar}{bar:50}{r_bar}{bar:-50b}'
-        ) as pbar:
-            for chunk in response.iter_content(chunk_size=chunk_size):
-                if chunk:
+    response.close()
+    if response.status_code == 206 and "/" in response.headers.get("Content-Range", ""):
+        size = response.headers["Content-Range"].rsplit("/", 1)[1]
+        if size != "*":
+            return int(size), True
+    size = response.headers.get("Content-Length")
+    return (int(size) if size is not None else None), False
+
+
+class _DownloadState:
+    def __init__(self, path: str, url: str, segments: list[tuple[int, int]]):
+        """
+        Bytes written per segment of a partial download, persisted next to it as json.
+        """
+        self.path = path
+        self.url = url
+        self.segments = segments
+        self.done = [0] * len(segments)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str, url: str, segments: list[tuple[int, int]]) -> "_DownloadState":
+        state = cls(path, url, segments)
+        if os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if saved["url"] == url and [tuple(s) for s in saved["segments"]] == segments:
+                state.done = saved["done"]
+        return state
+
+    def update(self, segment: int, num_bytes: int):
+        with self.lock:
+            self.done[segment] += num_bytes
+            write_json(self.path, {"url": self.url, "segments": self.segments, "done": self.done})
+
+
+def _fetch_segment(session: requests.Session,
+                   url: str,
+                   part_path: str,
+                   state: _DownloadState,
+                   segment: int,
+                   chunk_size: int,
+                   max_retries: int,
+                   timeout: float,
+                   pbar: tqdm,
+                   ):
+    start, stop = state.segments[segment]
+    for attempt in range(max_retries + 1):
+        offset = start + state.done[segment]
+        if offset >= stop:
+            return
+        try:
+            response = session.get(url, headers={"Range": f"bytes={offset}-{stop - 1}"}, stream=True, timeout=timeout)
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise requests.HTTPError(f"server ignored the range request for {url}")
+            with response, open(part_path, "r+b") as f:
+                f.seek(offset)
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    chunk = chunk[:stop - f.tell()]
                     f.write(chunk)
+                    f.flush()
+                    state.update(segment, len(chunk))
                     pbar.update(len(chunk))
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError):
+            if attempt == max_retries:
+                raise
+    if start + state.done[segment] < stop:
+        raise IOError(f"segment {start}-{stop} of {url} is incomplete")
+
+
+def download(url: str,
+             filename: str,
+             checksum: str | None = None,
+             num_segments: int = 4,
+             chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+             max_retries: int = 3,
+             timeout: float = 60.0,
+             session: requests.Session | None = None,
+             ) -> str:
+    """
+    Downloads a file in `num_segments` parallel HTTP Range requests over one pooled session.
+    Progress is kept in `filename + ".part"` and a json state file, so an interrupted download
+    resumes where it stopped. A finished file gets a `filename + ".sha256"` digest and is not
+    downloaded again while it matches. Servers without Range support get one plain request.
+    Args:
+        url (str): file url
+        filename (str): destination path
+        checksum (str | None): expected digest as "hex" (sha256) or "algorithm:hex", e.g. "md5:..."
+        num_segments (int): number of parallel range requests
+        chunk_size (int): bytes read from the response at once
+        max_retries (int): retries of a failed segment, each one resumes from its last written byte
+        timeout (float): connect and read timeout in seconds
+        session (requests.Session | None): session to use, a pooled one by default
+    Returns:
+        str: the filename
+    """
+    algorithm, expected = _parse_checksum(checksum) if checksum else ("sha256", None)
+    digest_path = filename + ".sha256"
+    if os.path.exists(filename):
+        if expected is not None and file_checksum(filename, algorithm) == expected:
+            return filename
+        if expected is None and os.path.exists(digest_path):
+            with open(digest_path) as f:
+                if f.read().strip() == file_checksum(filename):
+                    return filename
+    if session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=num_segments)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+    part_path, state_path = filename + ".part", filename + ".part.json"
+    size, ranges = _remote_size(session, url, timeout)
+    with tqdm(total=size, unit='B', unit_scale=True, desc=filename, bar_format='{l_bar}{bar:50}{r_bar}{bar:-50b}') as pbar:
+        if ranges and size:
+            bounds = np.linspace(0, size, min(num_segments, size) + 1).astype(np.int64).tolist()
+            segments = list(zip(bounds[:-1], bounds[1:]))
+            state = _DownloadState.load(state_path, url, segments)
+            if not os.path.exists(part_path) or os.path.getsize(part_path) != size:
+                state.done = [0] * len(segments)
+                with open(part_path, "wb") as f:
+                    f.truncate(size)
+            pbar.update(sum(state.done))
+            with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+                futures = [
+                    executor.submit(_fetch_segment, session, url, part_path, state, i, chunk_size, max_retries, timeout, pbar)
+                    for i in range(len(segments))
+                ]
+                for future in futures:
+                    future.result()
+        else:
+            with session.get(url, stream=True, timeout=timeout) as response, open(part_path, "wb") as f:
+                response.raise_for_status()
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+                    pbar.update(len(chunk))
+    digest = file_checksum(part_path, algorithm)
+    if expected is not None and digest != expected:
+        os.remove(part_path)
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        raise ValueError(f"checksum mismatch for {url}: expected {expected}, got {digest}")
+    os.replace(part_path, filename)
+    if os.path.exists(state_path):
+        os.remove(state_path)
+    with open(digest_path, "w") as f:
+        f.write(digest if algorithm == "sha256" else file_checksum(filename))
+    return filename
+
+
+def download_and_extract(url: str,
+                         filename: str,
+                         chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+                         dest_dir: str = ".",
+                         members: list[str] | None = None,
+                         checksum: str | None = None,
+                         num_segments: int = 4,
+                         session: requests.Session | None = None,
+                         ) -> list[str]:
+    """
+    Downloads a zip archive with `download` and extracts it into `dest_dir`.
+    Args:
+        url (str): archive url
+        filename (str): archive path, a verified cached copy is reused
+        chunk_size (int): bytes read from the response at once
+        dest_dir (str): extraction directory
+        members (list[str] | None): archive members to extract, all of them by default
+        checksum (str | None): expected digest of the archive, see `download`
+        num_segments (int): number of parallel range requests
+        session (requests.Session | None): session to use, a pooled one by default
+    Returns:
+        list[str]: paths of the extracted files
+    """
+    download(url, filename, checksum=checksum, num_segments=num_segments, chunk_size=chunk_size, session=session)
     with zipfile.ZipFile(filename, "r") as zip_ref:
         print(f"Unpacking {filename}...")
-        zip_ref.extractall(dest_dir)
+        names = zip_ref.namelist() if members is None else members
+        paths = [zip_ref.extract(name, dest_dir) for name in names]
         print(f"Files from {filename} successfully unpacked\n")
+    return paths
 
 
-def build_matrix_with_mappings(ratings: pl.DataFrame, additive: bool = False):
-    mappings = build_mappings(ratings)
-    user_id2idx, item_id2idx, _, _ = mappings
-    num_users = len(user_id2idx)
-    num_items = len(item_id2idx)
-    R = sp.sparse.lil_array((num_users, num_items))
-    for row in ratings.iter_rows(named=True):
-        user_idx = user_id2idx[row["user_id"]]
-        item_idx = item_id2idx[row["item_id"]]
-        if additive:
-            R[user_idx, item_idx] += row["rating"]
-        else:
-            R[user_idx, item_idx] = row["rating"]
-    return R, mappings
-
-
-def build_mappings(ratings: pl.DataFrame):
-    users = ratings.select(pl.col("user_id").unique())
-    items = ratings.select(pl.col("item_id").unique())
-    user_id2idx = {row["user_id"]: i for i, row in enumerate(users.iter_rows(named=True))}
-    item_id2idx = {row["item_id"]: i for i, row in enumerate(items.iter_rows(named=True))}
-    user_idx2id = {v: k for k, v in user_id2idx.items()}
-    item_idx2id = {v: k for k, v in item_id2idx.items()}
-    return user_id2idx, item_id2idx, user_idx2id, item_idx2id
+def build_matrix_with_mappings(ratings: pl.DataFrame,
+                               additive: bool = False,
+                               dtype: np.dtype = np.float64,
+                               format: str = "csr",
+                               ) -> tuple[sp.sparse.sparray, tuple[np.ndarray, np.ndarray]]:
+    """
+    Builds the sparse (users x items) rating matrix. Ratings of a repeated (user, item) pair are
+    summed when `additive`, otherwise the last one wins. Zero values are not stored.
+    Args:
+        ratings (pl.DataFrame): dataframe with user_id, item_id and rating columns
+        additive (bool): sum the repeated ratings instead of keeping the last one
+        dtype (np.dtype): value type of the matrix, e.g. np.float32 to halve the memory
+        format (str): "csr" or "csc"
+    Returns:
+        tuple[sp.sparse.sparray, tuple[np.ndarray, np.ndarray]]: the matrix and the (user_ids, item_ids)
+        mappings from `build_mappings`, row i belongs to user_ids[i] and column j to item_ids[j]
+    """
+    user_ids, item_ids = build_mappings(ratings)
+    coordinates = ratings.select(
+        (pl.col("user_id").rank("dense") - 1).cast(pl.Int64).alias("user_idx"),
+        (pl.col("item_id").rank("dense") - 1).cast(pl.Int64).alias("item_idx"),
+        pl.col("rating"),
+    )
+    R = coordinates_to_matrix(
+        coordinates["user_idx"].to_numpy(),
+        coordinates["item_idx"].to_numpy(),
+        coordinates["rating"].to_numpy(),
+        shape=(len(user_ids), len(item_ids)),
+        additive=additive,
+        dtype=dtype,
+        format=format,
+    )
+    return R, (user_ids, item_ids)
+
+
+def coordinates_to_matrix(rows: np.ndarray,
+                          cols: np.ndarray,
+                          values: np.ndarray,
+                          shape: tuple[int, int],
+                          additive: bool = False,
+                          dtype: np.dtype = np.float64,
+                          format: str = "csr",
+                          ) -> sp.sparse.sparray:
+    """
+    Sparse matrix from coordinates, repeated coordinates are summed when `additive`,
+    otherwise the last one wins. Zero values are not stored.
+    """
+    assert format in ("csr", "csc")
+    rows, cols = np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+    values = np.asarray(values).astype(dtype, copy=False)
+    if not additive:
+        keys = rows * shape[1] + cols
+        _, last_reversed = np.unique(keys[::-1], return_index=True)
+        last = len(keys) - 1 - last_reversed
+        rows, cols, values = rows[last], cols[last], values[last]
+    # int32 coordinates make scipy keep int32 indices, half the index memory
+    index_dtype = np.int32 if max(*shape, len(values)) < np.iinfo(np.int32).max else np.int64
+    R = sp.sparse.coo_array((values, (rows.astype(index_dtype), cols.astype(index_dtype))), shape=shape, dtype=dtype)
+    R = R.tocsr() if format == "csr" else R.tocsc()
+    R.sum_duplicates()
+    R.eliminate_zeros()
+    return R
+
+
+def build_mappings(ratings: pl.DataFrame) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Sorted unique user and item ids. The position of an id is its index,
+    ids map to indices with `ids_to_indices`.
+    """
+    user_ids = ratings.select(pl.col("user_id").unique().sort())["user_id"].to_numpy()
+    item_ids = ratings.select(pl.col("item_id").unique().sort())["item_id"].to_numpy()
+    return user_ids, item_ids
+
+
+def ids_to_indices(mapping: np.ndarray, ids, sorter: np.ndarray | None = None) -> np.ndarray:
+    """
+    Indices of the ids in a mapping from `build_mappings`, -1 for unknown ids.
+    A mapping that is not sorted, e.g. after appending new ids, needs its argsort as `sorter`.
+    """
+    ids = np.asarray(ids)
+    if not len(mapping):
+        return np.full(ids.shape, -1, dtype=np.int64)
+    positions = np.minimum(np.searchsorted(mapping, ids, sorter=sorter), len(mapping) - 1)
+    if sorter is not None:
+        positions = sorter[positions]
+    return np.where(mapping[positions] == ids, positions, -1)
@@ -0,0 +1,12 @@
+import json
+import os
+
+
+def write_json(path: str | os.PathLike, content: dict):
+    """
+    Writes json through a temporary file and a rename, so readers never see a partially written file.
+    """
+    tmp = os.fspath(path) + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(content, f)
+    os.replace(tmp, path)
@@ -0,0 +1,94 @@
+import numpy as np
+import polars as pl
+import pytest
+
+from grocery.models import ALS, ImplicitALS
+from grocery.utils import ids_to_indices
+
+
+@pytest.fixture
+def ratings() -> pl.DataFrame:
+    rng = np.random.default_rng(0)
+    n = 5000
+    return pl.DataFrame({
+        "user_id": rng.integers(0, 300, n) * 3 + 1,
+        "item_id": rng.integers(0, 100, n) * 7,
+        "rating": rng.integers(1, 5, n).astype(float),
+    })
+
+
+def _check_consistent(model):
+    assert (abs(model.Rt - model.R.T.tocsr())).sum() == 0
+    for users, Y in [(True, model.user_vectors), (False, model.item_vectors)]:
+        if model._factor_grams and users in model._factor_grams:
+            Y = Y.astype(np.float64)
+            np.testing.assert_allclose(model._factor_grams[users], Y.T @ Y, rtol=1e-9, atol=1e-9)
+
+
+def test_als_fold_in_users_solves_exactly(ratings):
+    np.random.seed(0)
+    model = ALS(dim=8, max_iter=3, lr=0.1, reg_embeddings=0.1)
+    model.fit(ratings)
+    update = pl.DataFrame({"user_id": [1000, 4, 1000, 4, -5], "item_id": [0, 7, 14, 14, 21], "rating": [3.0, 0.0, 1.0, 2.0, 5.0]})
+    old = model.R[[ids_to_indices(model.user_ids, [4])[0]]].toarray()[0]
+    rows = model.fold_in_users(update)
+    assert set(model.user_ids[rows].tolist()) == {4, 1000, -5}
+    Y = model.item_vectors
+    for user_id in [4, 1000]:
+        row = ids_to_indices(model.user_ids, [user_id], model.user_sorter)[0]
+        r = model.R[[row]].toarray()[0]
+        np.testing.assert_allclose(model.user_vectors[row], np.linalg.solve(Y.T @ Y + model.lambda_eye, Y.T @ r), atol=1e-10)
+    new = model.R[[ids_to_indices(model.user_ids, [4])[0]]].toarray()[0]
+    expected = old.copy()
+    expected[[1, 2]] = [0.0, 2.0]
+    np.testing.assert_array_equal(new, expected)
+    _check_consistent(model)
+
+
+def test_repeated_fold_ins_keep_transposed_and_grams(ratings):
+    model = ImplicitALS(dim=8, max_iter=3, random_state=0).fit(ratings)
+    rng = np.random.default_rng(1)
+    for step in range(4):
+        update = pl.DataFrame({
+            "user_id": rng.integers(0, 320, 50) * 3 + 1,
+            "item_id": rng.integers(0, 110, 50) * 7,
+            "rating": rng.integers(1, 5, 50).astype(float),
+        })
+        if step % 2:
+            model.fold_in_items(update)
+        else:
+            model.fold_in_users(update)
+        assert model.R.shape == (len(model.user_ids), len(model.item_ids))
+        _check_consistent(model)
+
+
+def _implicit_loss(model) -> float:
+    R = model.R.toarray().astype(np.float64)
+    X, Y = model.user_vectors.astype(np.float64), model.item_vectors.astype(np.float64)
+    confidence = 1 + model.alpha * R
+    return float((confidence * ((R > 0) - X @ Y.T) ** 2).sum() + model.reg * ((X ** 2).sum() + (Y ** 2).sum()))
+
+
+def _closed_form(model, R: np.ndarray, Y: np.ndarray) -> np.ndarray:
+    rows = []
+    for r in R:
+        confidence = 1 + model.alpha * r
+        A = Y.T @ (confidence[:, None] * Y) + model.reg * np.eye(model.dim)
+        rows.append(np.linalg.solve(A, Y.T @ (confidence * (r > 0))))
+    return np.array(rows)
+
+
+def test_implicit_als_loss_decreases(ratings):
+    params = dict(dim=8, reg=0.1, alpha=5.0, cg_steps=3, num_threads=2, block_nnz=500, random_state=0)
+    losses = [_implicit_loss(ImplicitALS(max_iter=max_iter, **params).fit(ratings)) for max_iter in range(1, 7)]
+    assert all(later <= earlier * (1 + 1e-6) for earlier, later in zip(losses, losses[1:]))
+    assert losses[-1] < losses[0]
+
+
+def test_implicit_als_cg_matches_closed_form(ratings):
+    model = ImplicitALS(dim=8, max_iter=1, reg=0.1, alpha=5.0, cg_steps=8, num_threads=2, block_nnz=500,
+                        dtype=np.float64, random_state=0).fit(ratings)
+    R = model.R.toarray()
+    # the last half-step solved the items for the final user factors
+    expected = _closed_form(model, R.T, model.user_vectors)
+    np.testing.assert_allclose(model.item_vectors, expected, rtol=1e-6, atol=1e-8)
@@ -0,0 +1,22 @@
+import numpy as np
+import polars as pl
+
+from grocery.metrics import HitMatrix
+from grocery.metrics.aspects import CategoryDiversity
+from grocery.recommender.primitives import Candidate
+
+
+def test_null_categories_are_unknown():
+    interactions = pl.DataFrame({
+        "user_id": [0, 0, 1, 1],
+        "item_id": [1, 2, 3, 4],
+        "product_category": ["a", None, None, "b"],
+    })
+    metric = CategoryDiversity(interactions)
+    assert metric.categories[[2, 3]].tolist() == [metric.unknown_category] * 2
+    assert sorted(metric.categories[[1, 4]].tolist()) == [1, 2]
+    predictions = [[Candidate(1), Candidate(2), Candidate(3), Candidate(4)], [Candidate(2), Candidate(5)]]
+    hits = HitMatrix.build(predictions, [[1], [2]], [0, 1])
+    expected = [metric.compute(p, []) for p in predictions]
+    assert expected == [3 / 4, 1 / 2]
+    np.testing.assert_array_equal(metric.compute_batch(hits), expected)
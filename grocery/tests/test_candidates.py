@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+from grocery.recommender.candidates import DotProductKNN, HNSWCandidateGenerator, QuantizedMatrix, top_k
+from grocery.recommender.primitives import EmbeddingTable
+
+
+@pytest.fixture
+def items() -> EmbeddingTable:
+    rng = np.random.default_rng(0)
+    return EmbeddingTable(np.arange(0, 400, 2), rng.normal(size=(200, 16)))
+
+
+def _full_sort(queries: np.ndarray, matrix: np.ndarray, k: int, exclude: np.ndarray | None = None):
+    scores = queries @ matrix.T
+    if exclude is not None:
+        for row, item in enumerate(exclude):
+            if item >= 0:
+                scores[row, item] = -np.inf
+    rows = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+    return rows, np.take_along_axis(scores, rows, axis=1)
+
+
+@pytest.mark.parametrize("k", [1, 10, 199, 200, 500])
+@pytest.mark.parametrize("buffer_bytes", [1, 64 * 1024 * 1024])
+def test_top_k_matches_full_sort(items, k, buffer_bytes):
+    queries = np.random.default_rng(1).normal(size=(30, items.dim)).astype(np.float32)
+    exclude = np.random.default_rng(2).integers(-1, len(items.ids), size=30)
+    for mask in [None, exclude]:
+        rows, scores = top_k(queries, items.vectors, k, exclude=mask, buffer_bytes=buffer_bytes)
+        expected_rows, expected_scores = _full_sort(queries, items.vectors, k, mask)
+        assert rows.shape == (30, min(k, len(items.ids)))
+        np.testing.assert_array_equal(rows, expected_rows)
+        np.testing.assert_allclose(scores, expected_scores, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("remove_self", [False, True])
+def test_knn_matches_full_sort(items, remove_self):
+    query_ids = items.ids[::7]
+    knn = DotProductKNN(items, items, remove_self=remove_self, buffer_bytes=4096)
+    ids, scores = knn.batch_top_k(query_ids.tolist(), 10)
+    exclude = np.searchsorted(items.ids, query_ids) if remove_self else None
+    rows, expected_scores = _full_sort(items.lookup(query_ids), items.vectors, 10, exclude)
+    np.testing.assert_array_equal(ids, items.ids[rows])
+    np.testing.assert_allclose(scores, expected_scores, rtol=1e-5, atol=1e-5)
+    assert [[candidate.id for candidate in row] for row in knn.batch_extract_candidates(query_ids.tolist(), 10)] \
+        == ids.tolist()
+    assert [candidate.id for candidate in knn.extract_candidates(int(query_ids[0]), 10)] == ids[0].tolist()
+    all_ids, _ = knn.batch_top_k(query_ids.tolist(), len(items.ids))
+    assert all_ids.shape[1] == len(items.ids) - int(remove_self)
+
+
+@pytest.mark.parametrize("storage, rescore", [("float32", 0), ("float16", 0), ("int8", 0), ("int8", 4)])
+def test_retained_bytes(items, storage, rescore):
+    knn = DotProductKNN(items, items, storage=storage, rescore=rescore)
+    expected = {"float32": 4, "float16": 2, "int8": 1}[storage] * items.vectors.size + items.ids.nbytes
+    if storage == "int8":
+        expected += knn.matrix.scales.nbytes
+    assert knn.nbytes == expected
+
+
+@pytest.mark.parametrize("dtype, scale_mode", [("float16", "row"), ("int8", "row"), ("int8", "dim")])
+@pytest.mark.parametrize("num_queries", [1, 50])
+def test_quantized_scores(items, dtype, scale_mode, num_queries):
+    matrix = QuantizedMatrix(items.vectors, dtype, scale_mode, chunk_rows=64)
+    queries = np.random.default_rng(1).normal(size=(num_queries, items.dim)).astype(np.float32)
+    decoded = matrix.data.astype(np.float32)
+    if scale_mode == "row" and matrix.scales is not None:
+        decoded *= matrix.scales[:, None]
+    elif matrix.scales is not None:
+        decoded *= matrix.scales
+    np.testing.assert_allclose(matrix.score(queries), queries @ decoded.T, rtol=1e-5, atol=1e-5)
+
+
+def test_remove_self(items):
+    knn = DotProductKNN(items, items, storage="int8", rescore=4)
+    ids, _ = knn.batch_top_k(items.ids[:20].tolist(), 10)
+    assert ids.shape == (20, 10)
+    assert not (ids == items.ids[:20, None]).any()
+    exact, _ = DotProductKNN(items, items).batch_top_k(items.ids[:20].tolist(), 10)
+    assert (ids == exact).mean() > 0.9
+
+
+@pytest.mark.parametrize("same", [True, False])
+def test_hnsw_save_load(items, tmp_path, same):
+    right = items if same else EmbeddingTable(items.ids, items.vectors.copy())
+    hnsw = HNSWCandidateGenerator(items, right, num_threads=1)
+    path = str(tmp_path / "index.voy")
+    hnsw.save(path)
+    loaded = HNSWCandidateGenerator.load(path, items, num_threads=1)
+    assert loaded.remove_self == hnsw.remove_self == same
+    query_ids = items.ids[:20].tolist()
+    for expected, actual in zip(hnsw.batch_top_k(query_ids, 10), loaded.batch_top_k(query_ids, 10)):
+        np.testing.assert_array_equal(expected, actual)
+    assert not HNSWCandidateGenerator.load(path, items, remove_self=False).remove_self
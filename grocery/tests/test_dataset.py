@@ -0,0 +1,42 @@
+import os
+
+import polars as pl
+import pytest
+
+pytest.importorskip("torch")
+
+from grocery.nn import JaggedDataset
+
+
+def test_write_keeps_empty_and_null_lists(tmp_path):
+    frame = pl.DataFrame({"values": [[1, 2, 3], [], None, [4]]})
+    dataset = JaggedDataset.from_dataframe(frame, str(tmp_path))
+    assert [dataset[i]["values"].tolist() for i in range(len(dataset))] == [[1, 2, 3], [], [], [4]]
+
+
+def test_write_rejects_null_elements(tmp_path):
+    frame = pl.DataFrame({"values": [[1, None, 3], [4]]})
+    with pytest.raises(ValueError):
+        JaggedDataset.write(frame, str(tmp_path))
+
+
+def test_lazy_frame_runs_once(tmp_path):
+    calls = []
+
+    def history(column: pl.Series) -> pl.Series:
+        calls.append(len(column))
+        return column
+
+    frame = pl.DataFrame({
+        "history": [{"product_id": [1, 2], "action_type": [0, 1]}, {"product_id": [3], "action_type": [1]}],
+        "candidates": [[5, 6, 7], []],
+    })
+    lazy = frame.lazy().with_columns(pl.col("history").map_batches(history, return_dtype=frame.schema["history"]))
+    dataset = JaggedDataset.from_dataframe(lazy, str(tmp_path / "lazy"))
+    assert len(calls) == 1
+    expected = JaggedDataset.from_dataframe(frame, str(tmp_path / "eager"))
+    assert len(dataset) == len(expected) == 2
+    for i in range(2):
+        assert dataset[i]["history"]["product_id"].tolist() == expected[i]["history"]["product_id"].tolist()
+        assert dataset[i]["candidates"].tolist() == expected[i]["candidates"].tolist()
+    assert sorted(os.listdir(tmp_path / "lazy")) == sorted(os.listdir(tmp_path / "eager"))
@@ -0,0 +1,145 @@
+import hashlib
+import os
+
+import numpy as np
+import polars as pl
+import pytest
+import requests
+
+from grocery.utils.dataset import build_mappings, build_matrix_with_mappings, download, ids_to_indices
+
+
+def _lil_matrix(ratings: pl.DataFrame, additive: bool) -> np.ndarray:
+    # the row by row builder that the vectorized one replaced, with sorted ids
+    user_ids, item_ids = sorted(set(ratings["user_id"])), sorted(set(ratings["item_id"]))
+    user_idx = {user_id: i for i, user_id in enumerate(user_ids)}
+    item_idx = {item_id: i for i, item_id in enumerate(item_ids)}
+    R = np.zeros((len(user_ids), len(item_ids)))
+    for row in ratings.iter_rows(named=True):
+        position = user_idx[row["user_id"]], item_idx[row["item_id"]]
+        if additive:
+            R[position] += row["rating"]
+        else:
+            R[position] = row["rating"]
+    return R
+
+
+@pytest.fixture
+def ratings() -> pl.DataFrame:
+    rng = np.random.default_rng(0)
+    n = 2000
+    return pl.DataFrame({
+        "user_id": rng.integers(0, 100, size=n) * 7 + 3,
+        "item_id": rng.integers(0, 60, size=n) * 11,
+        "rating": rng.integers(-1, 4, size=n).astype(np.float64),
+    })
+
+
+@pytest.mark.parametrize("additive", [False, True])
+@pytest.mark.parametrize("format", ["csr", "csc"])
+def test_matrix_matches_row_by_row_builder(ratings, additive, format):
+    R, (user_ids, item_ids) = build_matrix_with_mappings(ratings, additive=additive, format=format)
+    assert R.format == format
+    np.testing.assert_array_equal(user_ids, np.unique(ratings["user_id"]))
+    np.testing.assert_array_equal(item_ids, np.unique(ratings["item_id"]))
+    np.testing.assert_array_equal(R.toarray(), _lil_matrix(ratings, additive))
+    assert (R.data != 0).all()
+
+
+def test_float32_matrix(ratings):
+    R, _ = build_matrix_with_mappings(ratings, additive=True, dtype=np.float32)
+    assert R.dtype == np.float32 and R.indices.dtype == np.int32
+    np.testing.assert_array_equal(R.toarray(), _lil_matrix(ratings, True))
+
+
+def test_ids_to_indices(ratings):
+    user_ids, _ = build_mappings(ratings)
+    np.testing.assert_array_equal(ids_to_indices(user_ids, user_ids[[5, 0, 9]]), [5, 0, 9])
+    np.testing.assert_array_equal(ids_to_indices(user_ids, [-1, 4, 10 ** 9]), [-1, -1, -1])
+    np.testing.assert_array_equal(ids_to_indices(user_ids[:0], [1, 2]), [-1, -1])
+
+
+class FakeResponse:
+    def __init__(self, body: bytes, status_code: int, headers: dict, fail_after: int | None):
+        self.body = body
+        self.status_code = status_code
+        self.headers = headers
+        self.fail_after = fail_after
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size: int):
+        for i, start in enumerate(range(0, len(self.body), chunk_size)):
+            if self.fail_after is not None and i == self.fail_after:
+                raise requests.ConnectionError("connection reset")
+            yield self.body[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FakeSession:
+    def __init__(self, data: bytes, fail_after: int | None = None):
+        """
+        Serves `data` with Range support, a range response is cut after `fail_after` chunks.
+        """
+        self.data = data
+        self.fail_after = fail_after
+        self.ranges = []
+
+    def get(self, url: str, headers: dict | None = None, stream: bool = False, timeout: float | None = None):
+        start, stop = map(int, headers["Range"].removeprefix("bytes=").split("-"))
+        self.ranges.append((start, stop))
+        headers = {"Content-Range": f"bytes {start}-{stop}/{len(self.data)}"}
+        fail_after = None if (start, stop) == (0, 0) else self.fail_after
+        return FakeResponse(self.data[start:stop + 1], 206, headers, fail_after)
+
+
+def test_download_resumes_segments(tmp_path):
+    data = np.random.default_rng(0).bytes(1000)
+    filename = str(tmp_path / "data.bin")
+    with pytest.raises(requests.ConnectionError):
+        download("http://host/data.bin", filename, num_segments=4, chunk_size=50, max_retries=0,
+                 session=FakeSession(data, fail_after=2))
+    assert not os.path.exists(filename) and os.path.exists(filename + ".part.json")
+    session = FakeSession(data)
+    download("http://host/data.bin", filename, num_segments=4, chunk_size=50, session=session)
+    # every segment continues after the two chunks it had written
+    assert sorted(session.ranges[1:]) == [(100, 249), (350, 499), (600, 749), (850, 999)]
+    with open(filename, "rb") as f:
+        assert f.read() == data
+    assert not os.path.exists(filename + ".part") and not os.path.exists(filename + ".part.json")
+    with open(filename + ".sha256") as f:
+        assert f.read() == hashlib.sha256(data).hexdigest()
+    cached = FakeSession(data)
+    download("http://host/data.bin", filename, session=cached)
+    assert cached.ranges == []
+
+
+def test_download_retries_from_last_byte(tmp_path):
+    data = np.random.default_rng(1).bytes(300)
+    session = FakeSession(data, fail_after=1)
+    filename = str(tmp_path / "data.bin")
+    with pytest.raises(requests.ConnectionError):
+        download("http://host/data.bin", filename, num_segments=1, chunk_size=100, max_retries=1, session=session)
+    assert session.ranges[1:] == [(0, 299), (100, 299)]
+
+
+def test_download_checksum_mismatch(tmp_path):
+    data = b"payload" * 100
+    filename = str(tmp_path / "data.bin")
+    with pytest.raises(ValueError):
+        download("http://host/data.bin", filename, checksum="md5:" + "0" * 32, session=FakeSession(data))
+    assert os.listdir(tmp_path) == []
+    checksum = "md5:" + hashlib.md5(data).hexdigest()
+    download("http://host/data.bin", filename, checksum=checksum, session=FakeSession(data))
+    cached = FakeSession(data)
+    download("http://host/data.bin", filename, checksum=checksum, session=cached)
+    assert cached.ranges == []
@@ -0,0 +1,121 @@
+import numpy as np
+import pytest
+
+from grocery.recommender.features import (
+    EmbeddingScoreExtractor, FeatureExtractor, FeatureManager, FeatureStorage, StaticFeatureExtractor,
+)
+from grocery.recommender.primitives import Candidate, EmbeddingTable
+
+
+@pytest.fixture
+def storage() -> FeatureStorage:
+    storage = FeatureStorage()
+    storage.add_feature("price", {1: 1.5, 2: 2.5}, None)
+    storage.add_feature("count", {1: 3}, None)
+    storage.add_feature("category", {3: "x"}, None)
+    storage.add_feature("orders", {2: 7}, 0)
+    return storage
+
+
+def test_batch_lookups_match_per_key_lookups(storage):
+    keys = [1, 2, 3, 9]
+    names = ["price", "count", "category", "orders"]
+    extractor = StaticFeatureExtractor(names, storage, lambda u, i: i)
+    columns = extractor.extract_batch(np.zeros(len(keys), dtype=np.int64), np.array(keys))
+    for row, key in enumerate(keys):
+        features = extractor(key)
+        for name in names:
+            if features[name] is None and columns[name].dtype.kind == "f":
+                assert np.isnan(columns[name][row])
+            else:
+                assert columns[name][row] == features[name]
+
+
+def test_none_default_of_integer_feature(storage):
+    assert storage.columns["count"].dtype == np.float64
+    np.testing.assert_array_equal(storage.get_column([1, 2, 9], "count"), [3.0, np.nan, np.nan])
+    np.testing.assert_array_equal(storage.get_batch([1, 2, 9], ["count", "orders"]), [[3, 0], [np.nan, 7], [np.nan, 0]])
+
+
+def test_get_batch_object_result(storage):
+    result = storage.get_batch([1, 3], ["category", "price"])
+    assert result.dtype == object
+    assert result.tolist() == [[None, 1.5], ["x", None]]
+
+
+def test_changed_default_applies_to_keys_without_value():
+    storage = FeatureStorage()
+    storage.add_feature("count", {1: 3, 2: 4}, None)
+    storage.add_feature("count", {3: 5}, 9)
+    storage.add_feature("other", {4: 1}, 0)
+    np.testing.assert_array_equal(storage.get_column([1, 2, 3, 4, 5], "count"), [3, 4, 5, 9, 9])
+    np.testing.assert_array_equal(storage.get_batch([1, 4], ["count"]).ravel(), [3, 9])
+
+
+@pytest.mark.parametrize("mmap", [True, False])
+def test_save_load_round_trip(storage, tmp_path, mmap):
+    storage.add_feature("brand", {1: "a", 2: "b"}, "unknown")
+    storage.add_feature("mixed", {1: 5, 2: None}, "none")
+    storage.save(str(tmp_path))
+    loaded = FeatureStorage.load(str(tmp_path), mmap=mmap)
+    keys = [1, 2, 3, 4]
+    for name in storage.names:
+        original, restored = storage.get_column(keys, name), loaded.get_column(keys, name)
+        assert restored.dtype == original.dtype
+        if original.dtype == object:
+            assert restored.tolist() == original.tolist()
+        else:
+            np.testing.assert_array_equal(restored, original)
+        assert loaded.get_feature_default(name) == storage.get_feature_default(name)
+    assert loaded.get_column(keys, "category").tolist() == [None, None, "x", None]
+    assert [loaded[key] for key in keys] == [storage[key] for key in keys]
+
+
+def test_lookup_rejects_mismatched_key_shapes(storage):
+    pairs = FeatureStorage()
+    pairs.add_feature("score", {(1, 2): 0.5, (3, 4): 1.5}, None)
+    np.testing.assert_array_equal(pairs.lookup(np.array([[1, 2], [3, 4], [1, 4]])), [0, 1, -1])
+    assert pairs[1] == {}
+    with pytest.raises(ValueError):
+        pairs.lookup(np.array([1, 2, 3, 4]))
+    with pytest.raises(ValueError):
+        pairs.get_column(np.array([[1, 2, 3]]), "score")
+    with pytest.raises(ValueError):
+        storage.lookup(np.array([[1, 2]]))
+    assert len(pairs.lookup(np.empty(0, dtype=np.int64))) == 0
+
+
+class ParityExtractor(FeatureExtractor):
+    def __init__(self):
+        super().__init__()
+
+    @staticmethod
+    def key(object_id: int, candidate_id: int) -> int:
+        return object_id + candidate_id
+
+    def __call__(self, key: int) -> dict:
+        return {"parity": key % 2}
+
+
+@pytest.mark.parametrize("per_candidate_users", [False, True])
+def test_extract_batch_matches_extract(storage, per_candidate_users):
+    rng = np.random.default_rng(0)
+    pairs = FeatureStorage()
+    pairs.add_feature("clicks", {(user, item): user * 10 + item for user in range(3) for item in range(0, 10, 2)}, 0)
+    users = EmbeddingTable(np.arange(3), rng.normal(size=(3, 4)))
+    items = EmbeddingTable(np.arange(10), rng.normal(size=(10, 4)))
+    manager = FeatureManager([
+        StaticFeatureExtractor(["price", "count", "orders"], storage, lambda u, i: i),
+        StaticFeatureExtractor("clicks", pairs, lambda u, i: (u, i)),
+        EmbeddingScoreExtractor(users, items, ["score"]),
+        ParityExtractor(),
+    ])
+    candidate_ids = np.array([1, 2, 3, 4, 9, 0])
+    object_ids = rng.integers(0, 3, size=len(candidate_ids)) if per_candidate_users else np.full(len(candidate_ids), 2)
+    matrix, names = manager.extract_batch(object_ids if per_candidate_users else 2, candidate_ids)
+    assert names == ["price", "count", "orders", "clicks", "score", "parity"]
+    assert matrix.shape == (len(candidate_ids), len(names))
+    for row, (object_id, candidate_id) in enumerate(zip(object_ids, candidate_ids)):
+        [candidate] = manager.extract(int(object_id), [Candidate(int(candidate_id))])
+        expected = [np.nan if candidate.features[name] is None else candidate.features[name] for name in names]
+        np.testing.assert_allclose(matrix[row], expected, rtol=1e-6)
@@ -0,0 +1,72 @@
+import numpy as np
+import polars as pl
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from grocery.nn import JaggedDataset, export_user_embeddings
+
+
+class RowTower:
+    def __init__(self, dim: int = 3, fail_from: int | None = None):
+        self.dim = dim
+        self.fail_from = fail_from
+        self.rows = []
+
+    def __call__(self, batch: dict) -> torch.Tensor:
+        rows = batch["row"]
+        if self.fail_from is not None and (rows >= self.fail_from).any():
+            raise KeyboardInterrupt
+        self.rows.extend(rows.tolist())
+        return rows.float()[:, None] + torch.arange(self.dim, dtype=torch.float32)
+
+
+@pytest.fixture
+def dataset(tmp_path) -> JaggedDataset:
+    frame = pl.DataFrame({
+        "row": [[i] for i in range(10)],
+        "history": [{"product_id": list(range(i % 4 + 1))} for i in range(10)],
+    })
+    return JaggedDataset.from_dataframe(frame, str(tmp_path / "dataset"))
+
+
+def test_resume_continues_after_last_chunk(dataset, tmp_path):
+    user_ids = np.arange(10) * 2
+    expected = export_user_embeddings(RowTower(), dataset, user_ids, str(tmp_path / "full"), chunk_size=4)
+    path = str(tmp_path / "resumed")
+    with pytest.raises(KeyboardInterrupt):
+        export_user_embeddings(RowTower(fail_from=4), dataset, user_ids, path, chunk_size=4)
+    tower = RowTower()
+    table = export_user_embeddings(tower, dataset, user_ids, path, chunk_size=4)
+    assert sorted(tower.rows) == list(range(4, 10))
+    np.testing.assert_array_equal(table.ids, expected.ids)
+    np.testing.assert_array_equal(table.vectors, expected.vectors)
+
+
+@pytest.mark.parametrize("change", ["version", "dim", "user_ids", "chunk_size"])
+def test_resume_rejects_another_job(dataset, tmp_path, change):
+    user_ids = np.arange(10)
+    path = str(tmp_path / "embeddings")
+    with pytest.raises(KeyboardInterrupt):
+        export_user_embeddings(RowTower(fail_from=4), dataset, user_ids, path, chunk_size=4, version="a")
+    kwargs = {"chunk_size": 4, "version": "a"}
+    tower = RowTower()
+    if change == "version":
+        kwargs["version"] = "b"
+    elif change == "dim":
+        tower = RowTower(dim=5)
+    elif change == "user_ids":
+        user_ids = user_ids + 1
+    else:
+        kwargs["chunk_size"] = 5
+    with pytest.raises(ValueError):
+        export_user_embeddings(tower, dataset, user_ids, path, **kwargs)
+    table = export_user_embeddings(tower, dataset, user_ids, path, resume=False, **kwargs)
+    assert table.vectors.shape == (10, tower.dim)
+
+
+def test_invalid_user_ids(dataset, tmp_path):
+    with pytest.raises(ValueError):
+        export_user_embeddings(RowTower(), dataset, np.arange(9), str(tmp_path / "short"))
+    with pytest.raises(ValueError):
+        export_user_embeddings(RowTower(), dataset, np.arange(10)[::-1], str(tmp_path / "decreasing"))
@@ -0,0 +1,97 @@
+import math
+
+import numpy as np
+import polars as pl
+import pytest
+from catboost.utils import eval_metric
+
+from grocery.metrics import AUC, DCG, MAP, NDCG, Evaluator, HitMatrix, Precision, Recall
+from grocery.recommender.primitives import Candidate
+
+METRICS = [Precision, Recall, MAP, DCG, NDCG, AUC]
+KS = [1, 5, 10, 20, None]
+
+
+def _requests(seed: int, num_requests: int = 500) -> tuple[list[list[Candidate]], list[list[int]]]:
+    # small id range so that predictions and positives have duplicates
+    rng = np.random.default_rng(seed)
+    predictions = [[Candidate(int(i)) for i in rng.integers(0, 30, rng.integers(1, 25))] for _ in range(num_requests)]
+    positives = [rng.integers(0, 30, rng.integers(1, 12)).tolist() for _ in range(num_requests)]
+    # all-positive and all-negative requests
+    predictions[0], positives[0] = [Candidate(1), Candidate(2), Candidate(1)], [1, 2]
+    predictions[1], positives[1] = [Candidate(3), Candidate(4)], [5]
+    return predictions, positives
+
+
+def _per_request(metric, predictions, positives) -> np.ndarray:
+    return np.array([metric.compute(p, q, user_id) for user_id, (p, q) in enumerate(zip(predictions, positives))])
+
+
+@pytest.mark.parametrize("seed", [0, 1])
+@pytest.mark.parametrize("k", KS)
+@pytest.mark.parametrize("metric_class", METRICS)
+def test_batch_equals_per_request(metric_class, k, seed):
+    if metric_class is MAP and k is None:
+        pytest.skip("MAP.compute needs k")
+    predictions, positives = _requests(seed)
+    metric = metric_class(k)
+    hits = HitMatrix.build(predictions, positives, list(range(len(predictions))))
+    np.testing.assert_array_equal(metric.compute_batch(hits), _per_request(metric, predictions, positives))
+
+
+@pytest.mark.parametrize("k", [5, 10, None])
+def test_auc_matches_catboost(k):
+    predictions, positives = _requests(2, num_requests=200)
+    values = AUC(k).compute_batch(HitMatrix.build(predictions, positives))
+    for value, prediction, request_positives in zip(values, predictions, positives):
+        prediction = prediction[:k]
+        relevance = [int(p.id in request_positives) for p in prediction]
+        expected = eval_metric(relevance, list(range(len(prediction), 0, -1)), "AUC:type=Ranking")[0]
+        assert value == pytest.approx(expected, abs=1e-12)
+
+
+@pytest.mark.parametrize("metric_class", [Recall, MAP, DCG, NDCG])
+def test_empty_predictions(metric_class):
+    predictions, positives = [[], [Candidate(1)]], [[1, 2], [1]]
+    metric = metric_class(5)
+    hits = HitMatrix.build(predictions, positives)
+    np.testing.assert_array_equal(metric.compute_batch(hits), _per_request(metric, predictions, positives))
+
+
+@pytest.mark.parametrize("metric_class", [Precision, MAP, DCG, NDCG, AUC])
+def test_empty_positives(metric_class):
+    predictions, positives = [[Candidate(1), Candidate(2)], [Candidate(1)]], [[], [1]]
+    metric = metric_class(5)
+    hits = HitMatrix.build(predictions, positives)
+    np.testing.assert_array_equal(metric.compute_batch(hits), _per_request(metric, predictions, positives))
+
+
+def test_undefined_values_raise_in_both_paths():
+    hits = HitMatrix.build([[], [Candidate(1)]], [[1], []])
+    for metric, prediction, positives in [(Precision(5), [], [1]), (Recall(5), [Candidate(1)], [])]:
+        with pytest.raises(ZeroDivisionError):
+            metric.compute(prediction, positives)
+        with pytest.raises(ZeroDivisionError):
+            metric.compute_batch(hits)
+
+
+def test_evaluator_matches_per_request_loop():
+    predictions, positives = _requests(3)
+    metrics = [metric_class(k) for metric_class in METRICS for k in [5, 10]]
+    evaluator = Evaluator(metrics)
+    evaluator.requests = list(enumerate(positives))
+    vectorized = evaluator.compute_metrics(predictions)
+    for metric in metrics:
+        metric.vectorized = False
+    assert evaluator.compute_metrics(predictions) == vectorized
+
+
+def test_evaluate_stream_empty_test_set():
+    metrics = [NDCG(10), Precision(10), AUC(10)]
+    actions = pl.DataFrame(
+        {"request_id": [], "user_id": [], "item_id": []},
+        schema={"request_id": pl.Int64, "user_id": pl.Int64, "item_id": pl.Int64},
+    )
+    result = Evaluator(metrics).evaluate_stream(actions, lambda user_id, n: [])
+    assert list(result) == [metric.name for metric in metrics]
+    assert all(math.isnan(value) for value in result.values())
@@ -0,0 +1,46 @@
+import numpy as np
+import polars as pl
+import pytest
+
+from grocery.models import DiskCSR, OutOfCoreALS
+from grocery.utils.dataset import build_matrix_with_mappings
+
+
+@pytest.fixture
+def ratings() -> pl.DataFrame:
+    rng = np.random.default_rng(0)
+    n = 3000
+    return pl.DataFrame({
+        "user_id": rng.integers(0, 200, n) * 3 + 1,
+        "item_id": rng.integers(0, 80, n) * 7,
+        "rating": rng.integers(0, 5, n).astype(float),
+    })
+
+
+@pytest.mark.parametrize("additive", [False, True])
+def test_disk_csr_matches_in_memory_matrix(ratings, tmp_path, additive):
+    R, (user_ids, item_ids) = build_matrix_with_mappings(ratings, additive=additive, dtype=np.float32)
+    disk = DiskCSR.build(ratings, tmp_path / "R", user_ids, item_ids, additive=additive, chunk_size=500)
+    assert disk.shape == R.shape and disk.nnz == R.nnz
+    assert abs(disk.rows(0, disk.shape[0]) - R).sum() == 0
+    assert abs(disk.rows(10, 50) - R[10:50]).sum() == 0
+    transposed = DiskCSR.build(ratings, tmp_path / "Rt", item_ids, user_ids, row="item_id", col="user_id", additive=additive)
+    assert abs(transposed.rows(0, transposed.shape[0]) - R.T.tocsr()).sum() == 0
+
+
+def test_resume_matches_uninterrupted_training(ratings, tmp_path):
+    full = OutOfCoreALS(tmp_path / "full", dim=8, max_iter=4, random_state=0).fit(ratings)
+    OutOfCoreALS(tmp_path / "resumed", dim=8, max_iter=2, random_state=0).fit(ratings)
+    resumed = OutOfCoreALS(tmp_path / "resumed", dim=8, max_iter=4, random_state=0).fit(ratings)
+    np.testing.assert_allclose(resumed.user_vectors, full.user_vectors, rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(resumed.item_vectors, full.item_vectors, rtol=1e-5, atol=1e-6)
+    OutOfCoreALS(tmp_path / "resumed", dim=8, max_iter=4).fit()
+
+
+def test_resume_rejects_other_ratings(ratings, tmp_path):
+    OutOfCoreALS(tmp_path, dim=8, max_iter=1, random_state=0).fit(ratings)
+    changed = ratings.with_columns(pl.col("rating") + 1)
+    with pytest.raises(ValueError):
+        OutOfCoreALS(tmp_path, dim=8, max_iter=2).fit(changed)
+    model = OutOfCoreALS(tmp_path, dim=8, max_iter=2).fit(changed, resume=False)
+    assert model.fingerprint["rating_sum"] == changed["rating"].sum()
@@ -0,0 +1,59 @@
+import polars as pl
+import pytest
+
+from grocery.data.preprocessing import SECONDS_PER_DAY, Preprocessor
+
+
+def _events(with_catalog: bool) -> pl.DataFrame:
+    rows = [
+        # a train request with views and a cart update
+        ("AT_View", 1, "ST_Search", 0, 10, 100),
+        ("AT_View", 2, "ST_Search", 1, 10, 100),
+        ("AT_CartUpdate", 2, "ST_Search", 2, 10, 100),
+        ("AT_View", 3, "ST_Search", 3, 10, 100),
+        # a request with views only is not a target
+        ("AT_View", 1, "ST_Search", 10, 11, 101),
+        ("AT_View", 2, "ST_Search", 11, 11, 101),
+        # history without requests
+        ("AT_Purchase", 2, None, 100, 10, None),
+        ("AT_Click", 3, None, 45 * SECONDS_PER_DAY - 1, 11, None),
+        # a validation request
+        ("AT_View", 1, "ST_Search", 45 * SECONDS_PER_DAY, 11, 102),
+        ("AT_CartUpdate", 4, "ST_Search", 45 * SECONDS_PER_DAY + 1, 11, 102),
+    ]
+    if with_catalog:
+        rows += [
+            ("AT_View", 1, "ST_Catalog", 20, 11, 103),
+            ("AT_CartUpdate", 4, "ST_Catalog", 21, 11, 103),
+        ]
+    return pl.DataFrame(
+        rows,
+        schema={"action_type": pl.String, "product_id": pl.Int64, "source_type": pl.String,
+                "timestamp": pl.Int64, "user_id": pl.Int64, "request_id": pl.Int64},
+        orient="row",
+    )
+
+
+def _targets(frame: pl.DataFrame) -> list[tuple]:
+    return sorted(
+        (row["request_id"], tuple(sorted(zip(row["product_id"], row["action_type"]))))
+        for row in frame.iter_rows(named=True)
+    )
+
+
+@pytest.mark.parametrize("with_catalog", [False, True])
+def test_run_and_write(tmp_path, with_catalog):
+    preprocessor = Preprocessor(_events(with_catalog), min_request_length=2)
+    train_history, valid_history, train_targets, valid_targets = preprocessor.run()
+    product = {raw: code for code, raw in enumerate(preprocessor.mapping_product_ids.tolist())}
+    assert _targets(train_targets) == [(100, ((product[1], 0), (product[2], 1), (product[3], 0)))]
+    assert _targets(valid_targets) == [(102, ((product[1], 0), (product[4], 1)))]
+    assert (train_history["action_type"] != 0).all() and len(train_history) == 2 + with_catalog
+    assert len(valid_history) == 2
+
+    Preprocessor(_events(with_catalog), min_request_length=2).write(str(tmp_path))
+    for name, frame in zip(["train_history", "valid_history", "train_targets", "valid_targets"],
+                           [train_history, valid_history, train_targets, valid_targets]):
+        written = pl.read_parquet(tmp_path / f"{name}.parquet")
+        assert written.schema == frame.schema and len(written) == len(frame)
+    assert (tmp_path / "mappings" / "source_types.npy").exists()
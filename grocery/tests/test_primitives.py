@@ -0,0 +1,98 @@
+import heapq
+
+import numpy as np
+import pytest
+
+from grocery.recommender.primitives import Candidate, CandidateBatch, EmbeddingTable
+
+
+def _lists() -> list[list[Candidate]]:
+    rng = np.random.default_rng(0)
+    return [
+        [Candidate(int(item_id), {"score": float(rng.integers(0, 5)), "price": float(rng.normal())})
+         for item_id in rng.choice(100, size=size, replace=False)]
+        for size in [6, 0, 1, 9]
+    ]
+
+
+def _as_lists(batch: CandidateBatch) -> list[list[tuple]]:
+    return [[(candidate.id, candidate.features["score"], candidate.features["price"]) for candidate in group]
+            for group in batch.to_candidate_lists()]
+
+
+def _expected(lists: list[list[Candidate]]) -> list[list[tuple]]:
+    return [[(candidate.id, candidate.features["score"], candidate.features["price"]) for candidate in group]
+            for group in lists]
+
+
+@pytest.fixture
+def batch() -> CandidateBatch:
+    return CandidateBatch.from_candidates(_lists(), object_ids=[10, 11, 12, 13])
+
+
+def test_from_candidates_round_trip(batch):
+    assert batch.num_groups == 4
+    assert batch.lengths.tolist() == [6, 0, 1, 9]
+    assert batch.candidate_object_ids.tolist() == [10] * 6 + [12] + [13] * 9
+    assert _as_lists(batch) == _expected(_lists())
+
+
+def test_take_reverses_groups(batch):
+    bounds = zip(batch.offsets[:-1], batch.offsets[1:])
+    positions = np.concatenate([np.arange(start, stop)[::-1] for start, stop in bounds])
+    assert _as_lists(batch.take(positions)) == [group[::-1] for group in _expected(_lists())]
+
+
+def test_filter(batch):
+    mask = batch["price"] > 0
+    expected = [[candidate for candidate in group if candidate[2] > 0] for group in _expected(_lists())]
+    assert _as_lists(batch.filter(mask)) == expected
+    assert batch.filter(np.zeros(len(batch), dtype=bool)).lengths.tolist() == [0, 0, 0, 0]
+    assert _as_lists(batch.head(2)) == [group[:2] for group in _expected(_lists())]
+
+
+@pytest.mark.parametrize("n", [1, 3, 20])
+@pytest.mark.parametrize("descending", [True, False])
+def test_top_n_matches_heapq(batch, n, descending):
+    # ties are kept in input order, as heapq does
+    select = heapq.nlargest if descending else heapq.nsmallest
+    expected = [select(n, group, key=lambda candidate: candidate[1]) for group in _expected(_lists())]
+    assert _as_lists(batch.top_n("score", n, descending)) == expected
+
+
+def test_concat_and_slice(batch):
+    parts = [batch.slice_groups(0, 1), batch.slice_groups(1, 3), batch.group(3)]
+    concatenated = CandidateBatch.concat(parts)
+    assert _as_lists(concatenated) == _expected(_lists())
+    assert concatenated.object_ids.tolist() == [10, 11, 12, 13]
+    np.testing.assert_array_equal(concatenated.offsets, batch.offsets)
+    empty = CandidateBatch.concat([])
+    assert len(empty) == 0 and empty.num_groups == 0
+
+
+@pytest.mark.parametrize("mmap", [True, False])
+def test_embedding_table_save_load_lookup(tmp_path, mmap):
+    rng = np.random.default_rng(0)
+    embeddings = {int(object_id): rng.normal(size=4) for object_id in rng.choice(1000, size=50, replace=False)}
+    table = EmbeddingTable.from_dict(embeddings)
+    assert (np.diff(table.ids) > 0).all() and table.dim == 4
+    table.save(str(tmp_path))
+    loaded = EmbeddingTable.load(str(tmp_path), mmap=mmap)
+    # read-only memory maps are used without a copy
+    assert loaded.ids.flags.writeable != mmap and loaded.vectors.flags.writeable != mmap
+    np.testing.assert_array_equal(loaded.ids, table.ids)
+    np.testing.assert_array_equal(loaded.vectors, table.vectors)
+    query = list(embeddings)[::-3]
+    np.testing.assert_allclose(loaded.lookup(query), np.array([embeddings[i] for i in query]), rtol=1e-6)
+    np.testing.assert_array_equal(loaded[query[0]], loaded.lookup([query[0]])[0])
+    assert query[0] in loaded and -1 not in loaded
+    assert loaded.rows([-1, query[1]]).tolist() == [-1, table.ids.tolist().index(query[1])]
+    with pytest.raises(KeyError):
+        loaded.lookup([query[0], -1])
+    assert {key: value.tolist() for key, value in loaded.to_dict().items()} \
+        == {key: value.astype(np.float32).tolist() for key, value in embeddings.items()}
+
+
+def test_embedding_table_rejects_duplicate_ids():
+    with pytest.raises(AssertionError):
+        EmbeddingTable([3, 1, 3], np.zeros((3, 2)))
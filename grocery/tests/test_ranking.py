@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+sklearn_metrics = pytest.importorskip("sklearn.metrics")
+
+from grocery.nn.ranking import make_groups, make_pairs, make_ranked_pairs, segmented_ndcg
+
+
+def _groups(seed: int) -> tuple[torch.Tensor, torch.Tensor]:
+    generator = torch.Generator().manual_seed(seed)
+    lengths = torch.tensor([5, 1, 0, 12, 3, 30, 2])
+    targets = torch.randint(0, 4, (int(lengths.sum()),), generator=generator)
+    return targets, lengths
+
+
+def _pair_set(pairs: torch.Tensor) -> list[tuple[int, int]]:
+    return sorted(map(tuple, pairs.T.tolist()))
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_ranked_pairs_match_filtered_pairs(seed):
+    targets, lengths = _groups(seed)
+    pairs = make_pairs(lengths)
+    expected = pairs[:, targets[pairs[0]] > targets[pairs[1]]]
+    ranked = make_ranked_pairs(targets, lengths)
+    assert ranked.shape[1] == expected.shape[1]
+    assert _pair_set(ranked) == _pair_set(expected)
+
+
+def test_sampled_pairs_are_capped_per_group():
+    targets, lengths = _groups(0)
+    groups = make_groups(lengths)
+    all_pairs = make_ranked_pairs(targets, lengths)
+    counts = torch.bincount(groups[all_pairs[0]], minlength=len(lengths))
+    sampled = make_ranked_pairs(targets, lengths, max_pairs_per_group=10, generator=torch.Generator().manual_seed(0))
+    assert (groups[sampled[0]] == groups[sampled[1]]).all()
+    assert (targets[sampled[0]] > targets[sampled[1]]).all()
+    np.testing.assert_array_equal(torch.bincount(groups[sampled[0]], minlength=len(lengths)), counts.clamp(max=10))
+    uncapped = counts <= 10
+    assert _pair_set(sampled[:, uncapped[groups[sampled[0]]]]) == _pair_set(all_pairs[:, uncapped[groups[all_pairs[0]]]])
+
+
+def test_no_pairs():
+    lengths = torch.tensor([3, 0, 1])
+    assert make_ranked_pairs(torch.zeros(4, dtype=torch.long), lengths).shape == (2, 0)
+    assert make_ranked_pairs(torch.zeros(0, dtype=torch.long), torch.tensor([0, 0])).shape == (2, 0)
+
+
+@pytest.mark.parametrize("k", [1, 3, 10])
+def test_segmented_ndcg_matches_sklearn(k):
+    targets, lengths = _groups(3)
+    targets[:5] = 0
+    scores = torch.randperm(len(targets), generator=torch.Generator().manual_seed(0)).double()
+    ndcg = segmented_ndcg(scores, targets, lengths, k=k)
+    assert ndcg.shape == (len(lengths),)
+    for group, (start, length) in enumerate(zip((torch.cumsum(lengths, 0) - lengths).tolist(), lengths.tolist())):
+        if length < 2:
+            continue
+        group_targets, group_scores = targets[start:start + length], scores[start:start + length]
+        expected = sklearn_metrics.ndcg_score(
+            group_targets[None].numpy(), group_scores[None].numpy(), k=k, ignore_ties=True)
+        assert ndcg[group].item() == pytest.approx(expected, abs=1e-12)
+    assert ndcg[0] == 0
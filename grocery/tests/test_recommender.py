@@ -0,0 +1,61 @@
+import numpy as np
+import polars as pl
+import pytest
+
+from grocery.recommender.candidates import CandidateGenerator, DotProductKNN
+from grocery.recommender.primitives import EmbeddingTable
+from grocery.recommender.recommender import PipelineRecommender
+
+
+@pytest.fixture
+def knn() -> DotProductKNN:
+    rng = np.random.default_rng(0)
+    users = EmbeddingTable(np.arange(5), rng.normal(size=(5, 8)))
+    items = EmbeddingTable(np.arange(100, 120), rng.normal(size=(20, 8)))
+    return DotProductKNN(users, items)
+
+
+@pytest.mark.parametrize("seen_items", [
+    {},
+    pl.DataFrame(schema={"user_id": pl.Int64, "item_id": pl.Int64}),
+])
+def test_empty_seen_items(knn, seen_items):
+    expected = PipelineRecommender(knn).recommend_batch([0, 1], 5)
+    assert PipelineRecommender(knn, seen_items=seen_items).recommend_batch([0, 1], 5) == expected
+
+
+def test_seen_items_are_excluded(knn):
+    top = [candidate.id for candidate in PipelineRecommender(knn).recommend(0, 5)]
+    recommender = PipelineRecommender(knn, seen_items={0: top[:2]})
+    assert [candidate.id for candidate in recommender.recommend(0, 3)] == top[2:5]
+
+
+def test_no_users(knn):
+    batch = PipelineRecommender(knn).recommend_candidate_batch([], 5)
+    assert batch.ids.dtype == np.int64 and batch.offsets.dtype == np.int64 and batch.num_groups == 0
+
+
+class CountingGenerator(CandidateGenerator):
+    def __init__(self, knn: DotProductKNN):
+        self.knn = knn
+        self.requested = []
+
+    def extract_candidates(self, object_id: int, n: int = 10):
+        return self.knn.extract_candidates(object_id, n)
+
+    def extract_candidate_batch(self, object_ids, n: int = 10):
+        self.requested.extend([n] * len(object_ids))
+        return self.knn.extract_candidate_batch(object_ids, n)
+
+
+def test_over_fetch_per_user(knn):
+    ranking = {user_id: [c.id for c in PipelineRecommender(knn).recommend(user_id, 20)] for user_id in range(5)}
+    seen_items = {0: ranking[0][:15], 2: ranking[2][:1], 3: ranking[3][1:4]}
+    generator = CountingGenerator(knn)
+    recommender = PipelineRecommender(generator, num_candidates=3, seen_items=seen_items)
+    recommendations = recommender.recommend_candidate_batch([4, 3, 2, 1, 0], 3)
+    assert recommendations.object_ids.tolist() == [4, 3, 2, 1, 0]
+    for user_id, candidates in zip([4, 3, 2, 1, 0], recommendations.to_candidate_lists()):
+        unseen = [item_id for item_id in ranking[user_id] if item_id not in seen_items.get(user_id, [])]
+        assert [c.id for c in candidates] == unseen[:3]
+    assert sorted(generator.requested) == [3, 3, 4, 7, 19]
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from catboost import CatBoostRanker, Pool
+
+from grocery.recommender.primitives import Candidate, CandidateBatch
+from grocery.recommender.reranking import GroceryCatboostRanker
+
+FEATURES = ["a", "b", "c"]
+
+
+@pytest.fixture(scope="module")
+def ranker(tmp_path_factory) -> GroceryCatboostRanker:
+    rng = np.random.default_rng(0)
+    features = rng.normal(size=(600, len(FEATURES)))
+    labels = (features @ [1.0, -0.5, 0.2] + rng.normal(size=600) > 0).astype(float)
+    directory = tmp_path_factory.mktemp("ranker")
+    model = CatBoostRanker(iterations=30, depth=4, verbose=False, random_seed=0, train_dir=str(directory))
+    model.fit(Pool(features, labels, group_id=np.repeat(np.arange(60), 10)))
+    model.save_model(str(directory / "model.cbm"))
+    return GroceryCatboostRanker(str(directory / "model.cbm"), FEATURES, thread_count=1)
+
+
+def _requests(seed: int) -> list[list[Candidate]]:
+    rng = np.random.default_rng(seed)
+    return [
+        [Candidate(int(item_id), dict(zip(FEATURES, rng.normal(size=len(FEATURES)).tolist())))
+         for item_id in rng.choice(1000, size=size, replace=False)]
+        for size in [12, 0, 3, 25]
+    ]
+
+
+def _ranked(candidates: list[Candidate]) -> list[tuple[int, float]]:
+    return [(candidate.id, candidate.features["cbm_relevance"]) for candidate in candidates]
+
+
+def test_rank_batch_matches_rank_loop(ranker):
+    object_ids = [1, 2, 3, 4]
+    expected = [_ranked(ranker.rank(object_id, candidates, 5)) if candidates else []
+                for object_id, candidates in zip(object_ids, _requests(0))]
+    actual = [_ranked(candidates) for candidates in ranker.rank_batch(object_ids, _requests(0), 5)]
+    assert [[item_id for item_id, _ in request] for request in actual] \
+        == [[item_id for item_id, _ in request] for request in expected]
+    for actual_request, expected_request in zip(actual, expected):
+        np.testing.assert_allclose([score for _, score in actual_request], [score for _, score in expected_request])
+
+    requests = _requests(0)
+    flat = [candidate for candidates in requests for candidate in candidates]
+    matrix = np.array([[candidate.features[name] for name in FEATURES] for candidate in flat])
+    from_matrix = ranker.rank_batch(object_ids, requests, 5, features=(matrix, FEATURES))
+    assert [_ranked(candidates) for candidates in from_matrix] == actual
+
+    batch = ranker.rank_batch(object_ids, CandidateBatch.from_candidates(_requests(0), object_ids=object_ids), 5)
+    assert [_ranked(candidates) for candidates in batch.to_candidate_lists()] == actual
+
+
+def test_rank_batch_without_candidates(ranker):
+    assert ranker.rank_batch([1, 2], [[], []], 5) == [[], []]
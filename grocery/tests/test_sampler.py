@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+
+from grocery.nn.sampler import TokenBudgetBatchSampler
+
+
+@pytest.fixture
+def lengths() -> np.ndarray:
+    return np.random.default_rng(0).integers(1, 200, size=1000)
+
+
+def _tokens(lengths: np.ndarray, padded: bool) -> int:
+    return len(lengths) * lengths.max() if padded else lengths.sum()
+
+
+@pytest.mark.parametrize("padded", [True, False])
+@pytest.mark.parametrize("bucket_size, max_batch_size", [(64, None), (1000, 7), (4096, None)])
+def test_batches_stay_under_budget(lengths, padded, bucket_size, max_batch_size):
+    lengths = np.append(lengths, 5000)
+    sampler = TokenBudgetBatchSampler(lengths, 1000, bucket_size=bucket_size, padded=padded,
+                                      max_batch_size=max_batch_size)
+    num_batches = len(sampler)
+    batches = list(sampler)
+    assert len(batches) == num_batches
+    assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+    for batch in batches:
+        # a sample over the budget is alone in its batch
+        assert len(batch) == 1 or _tokens(lengths[batch], padded) <= 1000
+        assert max_batch_size is None or len(batch) <= max_batch_size
+    assert [len(lengths) - 1] in batches
+
+
+def test_new_order_every_epoch(lengths):
+    sampler = TokenBudgetBatchSampler(lengths, 2000, bucket_size=128, seed=3)
+    first, second = list(sampler), list(sampler)
+    assert first != second
+    assert sorted(map(sorted, first)) != sorted(map(sorted, second))
+    assert sorted(i for batch in second for i in batch) == list(range(len(lengths)))
+    replay = TokenBudgetBatchSampler(lengths, 2000, bucket_size=128, seed=3)
+    replay.set_epoch(1)
+    assert list(replay) == second
+    assert list(TokenBudgetBatchSampler(lengths, 2000, bucket_size=128, seed=4)) != first
+
+
+def test_unshuffled_batches_follow_lengths(lengths):
+    sampler = TokenBudgetBatchSampler(lengths, 2000, bucket_size=len(lengths), shuffle=False)
+    first = list(sampler)
+    assert list(sampler) == first
+    flat = [i for batch in first for i in batch]
+    assert flat == np.argsort(lengths, kind="stable").tolist()
@@ -0,0 +1,38 @@
+import polars as pl
+import pytest
+
+from grocery.data.sequences import build_candidates
+
+
+def _history() -> pl.DataFrame:
+    return pl.DataFrame({
+        "user_id": [1] * 8,
+        "timestamp": list(range(0, 800, 100)),
+        "source_type": [0] * 8,
+        "action_type": [1] * 8,
+        "product_id": list(range(8)),
+    })
+
+
+def _targets(request_ids: list) -> pl.DataFrame:
+    n = len(request_ids)
+    return pl.DataFrame({
+        "user_id": [1] * n,
+        "request_id": request_ids,
+        "timestamp": [150 + 100 * i for i in range(n)],
+        "source_type": [0] * n,
+        "product_id": [[1, 2]] * n,
+        "action_type": [[0, 1]] * n,
+    })
+
+
+@pytest.mark.parametrize("request_ids", [
+    [0, 1, 2, 3, 4, 5],
+    ["", "a", "b", "c", "d", "e"],
+    [None, 1, 2, 3, 4, 5],
+])
+def test_unset_request_ids_are_dropped(request_ids):
+    result = build_candidates(_history(), _targets(request_ids), min_length=2)
+    candidates = result["candidates"].struct.field("num_requests").to_list()
+    assert candidates == [[5]]
+    assert result["history"].struct.field("targets_inds").to_list() == [[2, 3, 4, 5, 6]]
@@ -0,0 +1,53 @@
+import asyncio
+
+from grocery.recommender.primitives import Candidate
+from grocery.recommender.recommender import BaseRecommender
+from grocery.recommender.serving import BatchingRecommender
+
+
+class EchoRecommender(BaseRecommender):
+    def recommend(self, user_id: int, n: int = 10) -> list[Candidate]:
+        return self.recommend_batch([user_id], n)[0]
+
+    def recommend_batch(self, user_ids: list[int], n: int = 10) -> list[list[Candidate]]:
+        return [[Candidate(user_id * 100 + i) for i in range(n)] for user_id in user_ids]
+
+
+def test_requests_are_batched():
+    async def run():
+        async with BatchingRecommender(EchoRecommender(), max_batch_size=4, max_wait_ms=50) as service:
+            results = await asyncio.gather(*(service.recommend(user_id, 2) for user_id in range(8)))
+            return results, service.stats
+
+    results, stats = asyncio.run(run())
+    assert [[candidate.id for candidate in result] for result in results] == [[u * 100, u * 100 + 1] for u in range(8)]
+    assert stats.num_batched_requests == 8 and stats.max_batch_size <= 4
+
+
+def test_stop_while_collecting_fails_pending_requests():
+    async def run():
+        service = BatchingRecommender(EchoRecommender(), max_batch_size=16, max_wait_ms=500)
+        await service.start()
+        pending = [asyncio.create_task(service.recommend(user_id)) for user_id in range(3)]
+        await asyncio.sleep(0.05)
+        assert service.queue_depth < 3, "the worker has to hold dequeued requests while waiting"
+        await service.stop()
+        return await asyncio.wait_for(asyncio.gather(*pending, return_exceptions=True), 1)
+
+    results = asyncio.run(run())
+    assert len(results) == 3
+    for result in results:
+        assert isinstance(result, RuntimeError)
+
+
+def test_stop_fails_queued_requests():
+    async def run():
+        service = BatchingRecommender(EchoRecommender(), max_batch_size=16, max_wait_ms=500)
+        await service.start()
+        pending = [asyncio.create_task(service.recommend(user_id)) for user_id in range(3)]
+        await asyncio.sleep(0)
+        await service.stop()
+        return await asyncio.wait_for(asyncio.gather(*pending, return_exceptions=True), 1)
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, RuntimeError) for result in results)